@@ -2,6 +2,45 @@
 
 __version__ = "0.2.3"
 
-from .modbus_server import Server
+import importlib
 
-from .modbus_datastore import DictDatastore, RedisDatastore
+# The public classes are imported on first access, so that importing the package is fast:
+_EXPORTS = {
+    "Server": "modbus_server",
+    "SerialServer": "modbus_server",
+    "DictDatastore": "modbus_datastore",
+    "ArrayDatastore": "modbus_datastore",
+    "SharedMemoryDatastore": "modbus_datastore",
+    "RedisDatastore": "modbus_datastore",
+    "PooledRedisDatastore": "modbus_datastore",
+    "Codec": "modbus_codec",
+}
+
+_SUBMODULES = (
+    "modbus_server",
+    "modbus_datastore",
+    "modbus_metrics",
+    "modbus_changes",
+    "modbus_device",
+    "modbus_codec",
+    "modbus_pdu",
+    "modbus_rtu",
+    "benchmark",
+)
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        module = importlib.import_module(f".{_EXPORTS[name]}", __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    if name in _SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS) | set(_SUBMODULES))
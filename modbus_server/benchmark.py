@@ -0,0 +1,427 @@
+"""Load generator and benchmark suite for the modbus_server
+
+Drives a Server with concurrent Modbus/TCP clients over loopback, across a matrix of
+function codes, request sizes, datastores and serving modes:
+
+    python -m modbus_server.benchmark --clients 10 --duration 2
+
+With --concurrency, it instead measures datastore reads from several threads while
+another thread updates 2-register values at 1 kHz. With --startup, it instead measures how long a fresh interpreter takes to import the
+package and to start and stop a Server.
+
+Clients and server run in the same process, so the numbers are meant for comparing
+revisions and configurations on the same machine, not as absolute capacity figures.
+"""
+
+import sys
+import time
+import socket
+import struct
+import argparse
+import statistics
+import threading
+import subprocess
+import tracemalloc
+
+from . import modbus_datastore
+from .modbus_server import Server
+
+# Request sizes (number of coils or registers) per function code:
+REQUEST_SIZES = {
+    1: (1, 100, 2000),
+    2: (1, 100, 2000),
+    3: (1, 10, 125),
+    4: (1, 10, 125),
+    5: (1,),
+    6: (1,),
+    15: (1, 100, 1968),
+    16: (1, 10, 123),
+}
+
+DATASTORES = ("DictDatastore", "ArrayDatastore", "RedisDatastore")
+MODES = ("threading", "asyncio")
+
+MBAP_HEADER = struct.Struct("!HHHB")
+
+# Statements run in a fresh interpreter by the startup benchmark, the interpreter alone is the baseline:
+STARTUP_STAGES = {
+    "interpreter": "pass",
+    "import": "import modbus_server",
+    "server": (
+        "import modbus_server; "
+        "server = modbus_server.Server(port=0, loglevel='WARNING'); "
+        "server.start(); server.stop()"
+    ),
+}
+
+
+def build_request_pdu(function_code, size):
+    """Build the request PDU for a benchmark request of size coils/registers at address 0"""
+    if function_code in (1, 2, 3, 4):
+        return struct.pack("!BHH", function_code, 0, size)
+    if function_code == 5:
+        return struct.pack("!BHH", function_code, 0, 0xFF00)
+    if function_code == 6:
+        return struct.pack("!BHH", function_code, 0, 1234)
+    if function_code == 15:
+        byte_count = (size + 7) // 8
+        return struct.pack("!BHHB", function_code, 0, size, byte_count) + (
+            b"\x55" * byte_count
+        )
+    if function_code == 16:
+        return struct.pack("!BHHB", function_code, 0, size, 2 * size) + (
+            b"\x00\x01" * size
+        )
+    raise ValueError(f"No benchmark request for function code {function_code}")
+
+
+class BenchmarkClient:
+    """Minimal blocking Modbus/TCP client, one request in flight at a time"""
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.transaction_id = 0
+
+    def request(self, pdu):
+        self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+        self.sock.sendall(
+            MBAP_HEADER.pack(self.transaction_id, 0, len(pdu) + 1, 0) + pdu
+        )
+        header = self._recv_exactly(7)
+        transaction_id, _, length, _ = MBAP_HEADER.unpack(header)
+        response_pdu = self._recv_exactly(length - 1)
+        if transaction_id != self.transaction_id:
+            raise RuntimeError(f"Unexpected transaction id {transaction_id}")
+        if response_pdu[0] & 0x80:
+            raise RuntimeError(f"Exception response {response_pdu[1]} for {pdu}")
+        return response_pdu
+
+    def _recv_exactly(self, number_of_bytes):
+        data = b""
+        while len(data) < number_of_bytes:
+            chunk = self.sock.recv(number_of_bytes - len(data))
+            if not chunk:
+                raise ConnectionError("Server closed the connection")
+            data += chunk
+        return data
+
+    def close(self):
+        self.sock.close()
+
+
+def create_datastore(name, shared=False):
+    """Create a datastore by class name, RedisDatastore runs against a local stand-in"""
+    if name == "RedisDatastore":
+        try:
+            import fakeredis
+        except ImportError:
+            return None
+        return modbus_datastore.RedisDatastore(redis_client=fakeredis.FakeRedis())
+    if name == "ArrayDatastore":
+        return modbus_datastore.ArrayDatastore(shared=shared)
+    return getattr(modbus_datastore, name)()
+
+
+def populate(server):
+    """Map all addresses that the benchmark requests touch"""
+    server.set_coils(0, [True, False] * 1000)
+    server.set_discrete_inputs(0, [False, True] * 1000)
+    server.set_input_registers(0, list(range(125)), "H")
+    server.set_holding_registers(0, list(range(125)), "H")
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[
+        min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    ]
+
+
+def run_load(host, port, pdu, clients=10, duration=1.0):
+    """Send pdu from concurrent clients for duration seconds
+
+    Returns a dict with requests_per_second, p50_ms and p99_ms.
+    """
+    connections = [BenchmarkClient(host, port) for _ in range(clients)]
+    latencies = [[] for _ in range(clients)]
+    barrier = threading.Barrier(clients + 1)
+
+    def client_loop(client, client_latencies):
+        barrier.wait()
+        deadline = time.perf_counter() + duration
+        now = time.perf_counter()
+        while now < deadline:
+            client.request(pdu)
+            finished = time.perf_counter()
+            client_latencies.append(finished - now)
+            now = finished
+
+    threads = [
+        threading.Thread(target=client_loop, args=(client, client_latencies))
+        for client, client_latencies in zip(connections, latencies)
+    ]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    for client in connections:
+        client.close()
+
+    all_latencies = sorted(latency for values in latencies for latency in values)
+    return {
+        "requests": len(all_latencies),
+        "requests_per_second": len(all_latencies) / elapsed,
+        "p50_ms": percentile(all_latencies, 0.50) * 1000,
+        "p99_ms": percentile(all_latencies, 0.99) * 1000,
+    }
+
+
+def measure_memory_per_connection(host, port, connections=100):
+    """Python heap allocated per open connection (server and client side), in bytes"""
+    pdu = build_request_pdu(3, 1)
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        clients = [BenchmarkClient(host, port) for _ in range(connections)]
+        for client in clients:
+            client.request(pdu)
+        time.sleep(0.1)
+        allocated = tracemalloc.get_traced_memory()[0] - baseline
+        for client in clients:
+            client.close()
+    finally:
+        tracemalloc.stop()
+    return allocated / connections
+
+
+def measure_accept_rate(host, port, connections=1000):
+    """Connections per second for connecting, requesting one register and disconnecting"""
+    pdu = build_request_pdu(3, 1)
+    start = time.perf_counter()
+    for _ in range(connections):
+        client = BenchmarkClient(host, port)
+        client.request(pdu)
+        client.close()
+    return connections / (time.perf_counter() - start)
+
+
+def measure_concurrent_reads(datastore, readers=4, duration=1.0, write_rate=1000):
+    """Read a 2-register value from reader threads while a writer updates it write_rate times per second
+
+    Every written value has equal high and low registers, so a torn read (registers of
+    two different writes) is detected. With write_rate=0 there is no writer. Returns a
+    dict with reads_per_second, writes and torn_reads.
+    """
+    datastore.write("input_registers", 0, 0, "I")
+    stop = threading.Event()
+    reads = [0] * readers
+    torn_reads = [0] * readers
+    writes = 0
+
+    def reader_loop(index):
+        read = datastore.read
+        count = torn = 0
+        while not stop.is_set():
+            for _ in range(100):
+                high, low = read("input_registers", 0, 2)
+                if high != low:
+                    torn += 1
+            count += 100
+        reads[index] = count
+        torn_reads[index] = torn
+
+    def writer_loop():
+        nonlocal writes
+        next_write = time.perf_counter()
+        while not stop.is_set():
+            writes += 1
+            datastore.write("input_registers", 0, (writes & 0xFFFF) * 0x10001, "I")
+            next_write += 1 / write_rate
+            time.sleep(max(0, next_write - time.perf_counter()))
+
+    threads = [threading.Thread(target=reader_loop, args=(i,)) for i in range(readers)]
+    if write_rate:
+        threads.append(threading.Thread(target=writer_loop))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "reads_per_second": sum(reads) / elapsed,
+        "writes": writes,
+        "torn_reads": sum(torn_reads),
+    }
+
+
+def run_concurrency_benchmarks(
+    datastores=("DictDatastore", "ArrayDatastore"), readers=(1, 4), duration=1.0
+):
+    """Yield one result dict per datastore, number of readers and with/without writer"""
+    for datastore_name in datastores:
+        for number_of_readers in readers:
+            for write_rate in (0, 1000):
+                datastore = create_datastore(datastore_name)
+                if datastore is None:
+                    continue
+                yield {
+                    "benchmark": "concurrency",
+                    "datastore": datastore_name,
+                    "readers": number_of_readers,
+                    "write_rate": write_rate,
+                    **measure_concurrent_reads(
+                        datastore, number_of_readers, duration, write_rate
+                    ),
+                }
+
+
+def measure_startup(statement, runs=20):
+    """Median wall time of a fresh interpreter that runs statement, in seconds"""
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def run_startup_benchmarks(runs=20):
+    """Yield one result dict per stage in STARTUP_STAGES"""
+    for stage, statement in STARTUP_STAGES.items():
+        yield {
+            "benchmark": "startup",
+            "stage": stage,
+            "seconds": measure_startup(statement, runs),
+        }
+
+
+def run_benchmarks(
+    datastores=DATASTORES,
+    modes=MODES,
+    function_codes=tuple(REQUEST_SIZES),
+    clients=10,
+    duration=1.0,
+    workers=1,
+):
+    """Run the benchmark matrix and yield one result dict per configuration"""
+    for datastore_name in datastores:
+        for mode in modes:
+            datastore = create_datastore(datastore_name, shared=workers > 1)
+            if datastore is None:
+                continue
+            server = Server(
+                port=0,
+                datastore=datastore,
+                mode=mode,
+                loglevel="WARNING",
+                workers=workers,
+            )
+            # Populate before starting, so that forked workers start with the data:
+            populate(server)
+            server.start()
+            try:
+                configuration = {"datastore": datastore_name, "mode": mode}
+                if workers == 1:
+                    # tracemalloc only sees this process:
+                    yield {
+                        **configuration,
+                        "benchmark": "memory",
+                        "bytes_per_connection": measure_memory_per_connection(
+                            "localhost", server.port
+                        ),
+                    }
+                yield {
+                    **configuration,
+                    "benchmark": "accept",
+                    "connections_per_second": measure_accept_rate(
+                        "localhost", server.port, connections=200
+                    ),
+                }
+                for function_code in function_codes:
+                    for size in REQUEST_SIZES[function_code]:
+                        pdu = build_request_pdu(function_code, size)
+                        result = run_load(
+                            "localhost", server.port, pdu, clients, duration
+                        )
+                        yield {
+                            **configuration,
+                            "benchmark": "load",
+                            "function_code": function_code,
+                            "size": size,
+                            **result,
+                        }
+            finally:
+                server.stop()
+
+
+def format_result(result):
+    if result["benchmark"] == "startup":
+        return f"startup {result['stage']:<12} {result['seconds'] * 1000:8.1f} ms"
+    if result["benchmark"] == "concurrency":
+        return (
+            f"{result['datastore']:<15} {result['readers']:>2} readers, "
+            f"{result['write_rate']:>4} writes/s: "
+            f"{result['reads_per_second']:10.0f} reads/s   "
+            f"{result['torn_reads']} torn reads"
+        )
+    prefix = f"{result['datastore']:<15} {result['mode']:<10}"
+    if result["benchmark"] == "memory":
+        return f"{prefix} memory per connection: {result['bytes_per_connection'] / 1024:8.1f} KiB"
+    if result["benchmark"] == "accept":
+        return f"{prefix} accept rate: {result['connections_per_second']:10.0f} connections/s"
+    return (
+        f"{prefix} FC {result['function_code']:>2} x {result['size']:>4}: "
+        f"{result['requests_per_second']:10.0f} req/s   "
+        f"p50 {result['p50_ms']:7.3f} ms   p99 {result['p99_ms']:7.3f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=1.0)
+    parser.add_argument("--datastores", nargs="+", default=DATASTORES)
+    parser.add_argument("--modes", nargs="+", default=MODES)
+    parser.add_argument(
+        "--function-codes", nargs="+", type=int, default=tuple(REQUEST_SIZES)
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--concurrency", action="store_true")
+    parser.add_argument("--readers", nargs="+", type=int, default=(1, 4))
+    parser.add_argument("--startup", action="store_true")
+    parser.add_argument("--startup-runs", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.concurrency:
+        for result in run_concurrency_benchmarks(
+            [name for name in args.datastores if name != "RedisDatastore"],
+            args.readers,
+            args.duration,
+        ):
+            print(format_result(result), flush=True)
+        return
+
+    if args.startup:
+        for result in run_startup_benchmarks(args.startup_runs):
+            print(format_result(result), flush=True)
+        return
+
+    for result in run_benchmarks(
+        args.datastores,
+        args.modes,
+        args.function_codes,
+        args.clients,
+        args.duration,
+        args.workers,
+    ):
+        print(format_result(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
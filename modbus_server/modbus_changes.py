@@ -0,0 +1,168 @@
+"""Notifications about values that Modbus clients write, e.g. setpoints from an HMI
+
+The Server routes requests through a NotifyingDatastore that records the written address
+ranges in a ChangeNotifier. A dispatcher thread calls the subscribed callbacks, so the
+request handlers never wait for application code.
+"""
+
+import logging
+import threading
+import collections
+
+from .modbus_pdu import write_bits_to_datastore, write_registers_to_datastore
+
+logger = logging.getLogger("modbus_server_logger")
+
+Change = collections.namedtuple(
+    "Change", "unit_id object_reference first_address number_of_records"
+)
+
+
+class Subscription:
+    """A callback for the changes of one object reference, address range and unit ID
+
+    None for object_reference or unit_id matches all of them.
+    """
+
+    def __init__(
+        self,
+        callback,
+        object_reference=None,
+        first_address=0,
+        number_of_records=65536,
+        unit_id=None,
+    ):
+        self.callback = callback
+        self.object_reference = object_reference
+        self.first_address = first_address
+        self.number_of_records = number_of_records
+        self.unit_id = unit_id
+        self.queue = None  # Set by Server.subscribe_queue()
+
+    def matches(self, change):
+        if self.object_reference not in (None, change.object_reference):
+            return False
+        if self.unit_id not in (None, change.unit_id):
+            return False
+        return (
+            change.first_address < self.first_address + self.number_of_records
+            and self.first_address < change.first_address + change.number_of_records
+        )
+
+
+def merge_range(ranges, first, end):
+    """Add the range [first, end) to a list of ranges, merged with all it overlaps or touches"""
+    merged = []
+    for range_first, range_end in ranges:
+        if range_end < first or range_first > end:
+            merged.append((range_first, range_end))
+        else:
+            first = min(first, range_first)
+            end = max(end, range_end)
+    merged.append((first, end))
+    return merged
+
+
+class ChangeNotifier:
+    """Collects written address ranges and calls the matching subscriptions
+
+    Writes only record their range. The dispatcher thread waits coalesce_interval seconds
+    after the first pending write, then calls every matching callback once per range, so
+    a burst of writes (or writes that arrive while callbacks run) is merged per unit ID
+    and object reference into as few ranges as possible.
+    """
+
+    def __init__(self, coalesce_interval=0.0):
+        self.coalesce_interval = coalesce_interval
+        self.subscriptions = []
+        self._pending = {}  # (unit_id, object_reference) -> list of (first, end)
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def subscribe(self, subscription):
+        self.subscriptions = self.subscriptions + [subscription]
+        self.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+
+    def record(self, unit_id, object_reference, first_address, number_of_records):
+        key = (unit_id, object_reference)
+        with self._condition:
+            self._pending[key] = merge_range(
+                self._pending.get(key, ()),
+                first_address,
+                first_address + number_of_records,
+            )
+            self._condition.notify()
+
+    def start(self):
+        if self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(target=self._dispatch, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            with self._condition:
+                self._stopped = True
+                self._condition.notify()
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._stopped)
+                if not self._pending:
+                    return  # Stopped, after the last pending changes were delivered
+            if self.coalesce_interval:
+                # Wait for the rest of the burst:
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: self._stopped, self.coalesce_interval
+                    )
+            with self._condition:
+                pending, self._pending = self._pending, {}
+            self._notify(
+                Change(unit_id, object_reference, first, end - first)
+                for (unit_id, object_reference), ranges in pending.items()
+                for first, end in sorted(ranges)
+            )
+
+    def _notify(self, changes):
+        changes = list(changes)
+        for subscription in self.subscriptions:
+            for change in changes:
+                if not subscription.matches(change):
+                    continue
+                try:
+                    subscription.callback(change)
+                except Exception:
+                    logger.exception(f"Change callback failed for {change}")
+
+
+class NotifyingDatastore:
+    """Wraps a datastore and records the ranges that requests for unit_id write"""
+
+    def __init__(self, datastore, notifier, unit_id):
+        self.datastore = datastore
+        self.notifier = notifier
+        self.unit_id = unit_id
+
+    def __getattr__(self, name):
+        return getattr(self.datastore, name)
+
+    def write_bits(self, object_reference, first_address, values):
+        write_bits_to_datastore(self.datastore, object_reference, first_address, values)
+        self.notifier.record(self.unit_id, object_reference, first_address, len(values))
+
+    def write_registers(self, object_reference, first_address, register_bytes):
+        write_registers_to_datastore(
+            self.datastore, object_reference, first_address, register_bytes
+        )
+        self.notifier.record(
+            self.unit_id, object_reference, first_address, len(register_bytes) // 2
+        )
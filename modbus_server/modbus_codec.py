@@ -0,0 +1,133 @@
+"""Conversion between Python values and the register bytes of Modbus
+
+An encoding is a struct format character for a number (h, H, i, I, q, Q, e, f, d) or a
+string of n bytes ("10s"), stored in 2-byte registers. Every encoding (with its word and
+byte order) is compiled once into a Codec that all datastores and setters share:
+
+    codec = get_codec("f", word_order="little")
+    register_bytes = codec.encode(1.5)
+    register_bytes = codec.encode_many([1.5, 2.5, 3.5])
+
+Register bytes are always in wire order. The default word and byte order (both "big")
+is the Modbus convention, other orders are common for 32 and 64 bit values of PLCs.
+"""
+
+import struct
+import functools
+
+NUMBER_ENCODINGS = "hHiIqQefd"
+FLOAT_ENCODINGS = "efd"
+ORDERS = ("big", "little")
+
+
+def swap_register_bytes(data):
+    """Swap the two bytes of every register"""
+    swapped = bytearray(len(data))
+    swapped[0::2] = data[1::2]
+    swapped[1::2] = data[0::2]
+    return bytes(swapped)
+
+
+class Codec:
+    """A compiled encoding, with the number of registers that one value occupies
+
+    word_order is the order of the registers of a multi-register value, byte_order is
+    the order of the two bytes within each register. Strings are padded with zero bytes
+    to whole registers, only their byte_order applies.
+    """
+
+    def __init__(self, encoding, word_order="big", byte_order="big"):
+        if word_order not in ORDERS or byte_order not in ORDERS:
+            raise ValueError(
+                f'word_order and byte_order must be "big" or "little", not {word_order}, {byte_order}'
+            )
+        self.encoding = encoding
+        self.word_order = word_order
+        self.byte_order = byte_order
+
+        if encoding in NUMBER_ENCODINGS and len(encoding) == 1:
+            self.is_string = False
+            # Packing the registers in little endian order reverses words and bytes,
+            # the bytes are swapped back if only one of them is little endian:
+            self._format_prefix = ">" if word_order == "big" else "<"
+            self._swap_bytes = word_order != byte_order
+            self.parse = float if encoding in FLOAT_ENCODINGS else int
+        elif encoding.endswith("s") and encoding[:-1].isdigit() and int(encoding[:-1]):
+            self.is_string = True
+            self._format_prefix = ">"
+            self._swap_bytes = byte_order == "little"
+            self.parse = str
+            length = int(encoding[:-1])
+            encoding = f"{length + length % 2}s"
+        else:
+            raise ValueError(
+                f'encoding must be one of "h", "H", "i", "I", "q", "Q", "e", "f", "d" '
+                f'or a string like "10s", not {encoding}'
+            )
+        self._format = encoding
+        self.struct = struct.Struct(self._format_prefix + encoding)
+        self.size = self.struct.size
+        self.registers = self.size // 2
+
+    def __repr__(self):
+        return f"Codec({self.encoding!r}, word_order={self.word_order!r}, byte_order={self.byte_order!r})"
+
+    def _prepare(self, value):
+        if self.is_string and isinstance(value, str):
+            return value.encode()
+        return value
+
+    def encode(self, value):
+        """Register bytes of one value"""
+        data = self.struct.pack(self._prepare(value))
+        return swap_register_bytes(data) if self._swap_bytes else data
+
+    def encode_many(self, values):
+        """Register bytes of a sequence of values, packed with one struct call"""
+        if self.is_string:
+            data = b"".join(map(self.struct.pack, map(self._prepare, values)))
+        else:
+            data = struct.pack(
+                f"{self._format_prefix}{len(values)}{self._format}", *values
+            )
+        return swap_register_bytes(data) if self._swap_bytes else data
+
+    def decode(self, register_bytes):
+        """The value of the register bytes of one value"""
+        if self._swap_bytes:
+            register_bytes = swap_register_bytes(register_bytes)
+        value = self.struct.unpack(register_bytes)[0]
+        if self.is_string:
+            return value.rstrip(b"\x00").decode()
+        return value
+
+    def decode_many(self, register_bytes):
+        """The list of values in register bytes, unpacked with one struct call"""
+        if self._swap_bytes:
+            register_bytes = swap_register_bytes(register_bytes)
+        if self.is_string:
+            return [
+                value.rstrip(b"\x00").decode()
+                for (value,) in self.struct.iter_unpack(register_bytes)
+            ]
+        number_of_values = len(register_bytes) // self.size
+        return list(
+            struct.unpack(
+                f"{self._format_prefix}{number_of_values}{self._format}",
+                register_bytes,
+            )
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_codec(encoding, word_order, byte_order):
+    return Codec(encoding, word_order, byte_order)
+
+
+def get_codec(encoding, word_order="big", byte_order="big"):
+    """The shared Codec for an encoding, a Codec is returned as it is"""
+    if isinstance(encoding, Codec):
+        return encoding
+    if not isinstance(encoding, str):
+        raise ValueError(f"encoding must be a str or a Codec, not {encoding}")
+    return _compiled_codec(encoding, word_order, byte_order)
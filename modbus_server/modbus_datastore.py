@@ -1,75 +1,853 @@
+import os
+import math
+import mmap
+import time
 import struct
-import distutils.util
+import itertools
+import threading
+import contextlib
 import warnings
 import logging
 
+from .modbus_codec import get_codec
+from .modbus_pdu import DatastoreUnavailableError
+
 logger = logging.getLogger("modbus_server_logger")
 
 try:
-    import redis
+    import fcntl
 except ImportError:
-    logging.info("Could not import redis, RedisDatastore is not available")
+    logging.info("Could not import fcntl, SharedMemoryDatastore is not available")
+
+
+def __getattr__(name):
+    # redis is only imported when a RedisDatastore connects, it dominates the import time:
+    if name == "redis":
+        import redis
+
+        return redis
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+TRUE_STRINGS = ("y", "yes", "t", "true", "on", "1")
+FALSE_STRINGS = ("n", "no", "f", "false", "off", "0")
+
+
+def parse_bool(value):
+    """Cast a string like "1", "true" or "off" to bool (like the removed distutils.util.strtobool)"""
+    value = value.lower()
+    if value in TRUE_STRINGS:
+        return True
+    if value in FALSE_STRINGS:
+        return False
+    raise ValueError(f"invalid truth value {value}")
+
+
+# Translation table from bytes with values 0/1 to the characters "0"/"1":
+BIT_CHARACTERS = bytes.maketrans(b"\x00\x01", b"01")
+BIT_VALUES = bytes.maketrans(b"01", b"\x00\x01")
+
+OBJECT_REFERENCES = ("coils", "discrete_inputs", "input_registers", "holding_registers")
+
+
+def check_address_range(first_address, number_of_records):
+    """Raise a ValueError if the range doesn't fit into the addresses 0 to 65535"""
+    if first_address < 0 or first_address + number_of_records > 65536:
+        raise ValueError(
+            f"addresses {first_address} to {first_address + number_of_records - 1} must be between 0 and 65535"
+        )
 
-# 32 and 64 bit values work differently between the two datastores!
+
+class AddressSpace:
+    """Marks the mapped addresses of the four object references, one byte per address
+
+    A requested range is validated with one find() over the mask, independent of the
+    storage of the values. The mask can live in a given buffer (e.g. the buffer of an
+    ArrayDatastore), offsets gives the start of the 65536 byte mask of every object
+    reference in it.
+    """
+
+    def __init__(self, buffer=None, offsets=None):
+        if buffer is None:
+            buffer = bytearray(len(OBJECT_REFERENCES) * 65536)
+            offsets = {
+                object_reference: i * 65536
+                for i, object_reference in enumerate(OBJECT_REFERENCES)
+            }
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def map(self, object_reference, first_address, number_of_records=1):
+        check_address_range(first_address, number_of_records)
+        start = self.offsets[object_reference] + first_address
+        self.buffer[start : start + number_of_records] = b"\x01" * number_of_records
+
+    def unmap(self, object_reference, first_address, number_of_records=1):
+        start = self.offsets[object_reference] + first_address
+        self.buffer[start : start + number_of_records] = bytes(number_of_records)
+
+    def is_mapped(self, object_reference, first_address, number_of_records):
+        if first_address < 0 or first_address + number_of_records > 65536:
+            return False
+        start = self.offsets[object_reference] + first_address
+        return self.buffer.find(b"\x00", start, start + number_of_records) == -1
+
+    def check(self, object_reference, first_address, number_of_records):
+        """Raise a KeyError if any address of the range is not mapped"""
+        if not self.is_mapped(object_reference, first_address, number_of_records):
+            raise KeyError(
+                f"{object_reference}:{first_address}+{number_of_records} is not mapped"
+            )
+
+    def mapped_addresses(self, object_reference):
+        start = self.offsets[object_reference]
+        mask = self.buffer[start : start + 65536]
+        return [address for address in range(65536) if mask[address]]
+
+    def clear(self):
+        for start in self.offsets.values():
+            self.buffer[start : start + 65536] = bytes(65536)
 
 
 class DictDatastore:
+    """Values in one dict per object reference, registers as 2 bytes each
+
+    Writes are guarded by a sequence number like in the SharedMemoryDatastore: writers
+    make it odd while they change the dicts (seqlock), readers retry until they read a
+    range while the number was even and unchanged. So a value that spans several
+    registers is never read half-written, and readers never block writers. batch()
+    makes several writes visible at once, reads of the thread in the batch see them
+    right away.
+    """
+
     def __init__(self):
-        self.empty_datadict = {
-            "coils": {},
-            "discrete_inputs": {},
-            "input_registers": {},
-            "holding_registers": {},
-        }
-        self.datadict = dict(self.empty_datadict)
+        self.datadict = {object_reference: {} for object_reference in OBJECT_REFERENCES}
+        self.address_space = AddressSpace()
+        self._sequence = 0
+        self._lock = threading.RLock()
+        self._write_depth = 0
+        self._writer = None  # Thread ID of the writer in progress
         logger.debug("Initialized empty DictDatastore")
 
+    ## Seqlock
+    ## =======
+
+    def _begin_write(self):
+        self._lock.acquire()
+        self._write_depth += 1
+        if self._write_depth == 1:
+            self._writer = threading.get_ident()
+            self._sequence += 1
+
+    def _end_write(self):
+        self._write_depth -= 1
+        if self._write_depth == 0:
+            self._writer = None
+            self._sequence += 1
+        self._lock.release()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group several writes, readers see either none or all of them"""
+        self._begin_write()
+        try:
+            yield self
+        finally:
+            self._end_write()
+
     def read(self, object_reference, first_address, number_of_records):
-        data = []
-        for address in range(first_address, first_address + number_of_records):
-            data.append(self.datadict[object_reference][address])
-        return data
+        if self._writer == threading.get_ident():
+            # In a batch() of this thread, no other writer can run meanwhile:
+            return self._read(object_reference, first_address, number_of_records)
+        while True:
+            sequence = self._sequence
+            if not sequence & 1:
+                try:
+                    values = self._read(
+                        object_reference, first_address, number_of_records
+                    )
+                except KeyError:
+                    if self._sequence == sequence:
+                        raise
+                else:
+                    if self._sequence == sequence:
+                        return values
+            # Writers are threads of this process, give the one in progress the CPU:
+            time.sleep(0)
+
+    def _read(self, object_reference, first_address, number_of_records):
+        # Validate the whole range at once, then no lookup can fail:
+        self.address_space.check(object_reference, first_address, number_of_records)
+        table = self.datadict[object_reference]
+        return [
+            table[address]
+            for address in range(first_address, first_address + number_of_records)
+        ]
+
+    ## Writes
+    ## ======
 
     def write(self, object_reference, address, value, encoding):
+        with self.batch():
+            self._write(object_reference, address, value, encoding)
 
+    def _write(self, object_reference, address, value, encoding):
         if object_reference in ("input_registers", "holding_registers"):
-            if struct.calcsize(encoding) == 2:
-                value = struct.pack(f"!{encoding}", value)
-            elif struct.calcsize(encoding) > 2:
-                number_of_registers = struct.calcsize(encoding) // 2
-                value_as_bytes = struct.pack(f"!{encoding}", value)
-                for chunk_number in range(0, number_of_registers):
-                    byte_chunk = value_as_bytes[chunk_number * 2 : chunk_number * 2 + 2]
-                    self.datadict[object_reference][address + chunk_number] = byte_chunk
-                return
+            value_as_bytes = get_codec(encoding).encode(value)
+            number_of_registers = len(value_as_bytes) // 2
+            check_address_range(address, number_of_registers)
+            self.datadict[object_reference].update(
+                (address + i, value_as_bytes[2 * i : 2 * i + 2])
+                for i in range(number_of_registers)
+            )
+            self.address_space.map(object_reference, address, number_of_registers)
+            return
 
+        check_address_range(address, 1)
         self.datadict[object_reference][address] = value
+        self.address_space.map(object_reference, address)
+
+    def write_bits(self, object_reference, first_address, values):
+        """Write a list of bools to mapped coils or discrete inputs in one update"""
+        addresses = range(first_address, first_address + len(values))
+        with self.batch():
+            self.address_space.check(object_reference, first_address, len(values))
+            self.datadict[object_reference].update(zip(addresses, values))
+
+    def write_registers(self, object_reference, first_address, register_bytes):
+        """Write big-endian register bytes to mapped registers in one update"""
+        # Split before the write begins, so that readers retry as briefly as possible:
+        registers = [
+            bytes(register_bytes[i : i + 2]) for i in range(0, len(register_bytes), 2)
+        ]
+        addresses = range(first_address, first_address + len(registers))
+        with self.batch():
+            self.address_space.check(object_reference, first_address, len(registers))
+            self.datadict[object_reference].update(zip(addresses, registers))
+
+    def set_registers(self, object_reference, first_address, values, encoding):
+        """Pack values with encoding in one go and map the registers they occupy"""
+        register_bytes = get_codec(encoding).encode_many(values)
+        registers = [
+            register_bytes[i : i + 2] for i in range(0, len(register_bytes), 2)
+        ]
+        check_address_range(first_address, len(registers))
+        addresses = range(first_address, first_address + len(registers))
+        with self.batch():
+            self.datadict[object_reference].update(zip(addresses, registers))
+            self.address_space.map(object_reference, first_address, len(registers))
+
+    def set_bits(self, object_reference, first_address, values):
+        """Set coils or discrete inputs and map their addresses"""
+        check_address_range(first_address, len(values))
+        addresses = range(first_address, first_address + len(values))
+        with self.batch():
+            self.datadict[object_reference].update(zip(addresses, values))
+            self.address_space.map(object_reference, first_address, len(values))
 
     def dump(self):
         return self.datadict
 
     def empty(self):
-        self.datadict = dict(self.empty_datadict)
+        with self.batch():
+            self.datadict = {
+                object_reference: {} for object_reference in OBJECT_REFERENCES
+            }
+            self.address_space.clear()
+
+    def snapshot(self, path):
+        """Write all values to path, in the snapshot format of the ArrayDatastore"""
+        # The whole address space is converted with map() and join(), without a Python loop per address:
+        image = bytearray(ArrayDatastore.SIZE)
+        all_addresses = range(65536)
+        tables = self._copy_tables()
+        for object_reference in OBJECT_REFERENCES:
+            table = tables[object_reference]
+            mask_offset = ArrayDatastore.MASK_OFFSETS[object_reference]
+            offset = ArrayDatastore.DATA_OFFSETS[object_reference]
+            image[mask_offset : mask_offset + 65536] = bytes(
+                map(table.__contains__, all_addresses)
+            )
+            if object_reference in ("input_registers", "holding_registers"):
+                values = map(table.get, all_addresses, itertools.repeat(b"\x00\x00"))
+                image[offset : offset + 2 * 65536] = b"".join(values)
+            else:
+                values = bytes(map(table.get, all_addresses, itertools.repeat(False)))
+                bits = int(values[::-1].translate(BIT_CHARACTERS), 2)
+                image[offset : offset + 8192] = bits.to_bytes(8192, "little")
+        write_snapshot(path, image)
+
+    def _copy_tables(self):
+        if self._writer == threading.get_ident():
+            # In a batch() of this thread, like read():
+            return self._copy_tables_unguarded()
+        # Copy all dicts without blocking writers, like read():
+        while True:
+            sequence = self._sequence
+            if not sequence & 1:
+                tables = self._copy_tables_unguarded()
+                if self._sequence == sequence:
+                    return tables
+            time.sleep(0)
+
+    def _copy_tables_unguarded(self):
+        return {
+            object_reference: dict(table)
+            for object_reference, table in self.datadict.items()
+        }
+
+    def restore(self, path):
+        """Replace all values with the values of a snapshot"""
+        with open_snapshot(path) as image:
+            address_space = AddressSpace()
+            address_space.buffer[:] = image[: len(address_space.buffer)]
+            datadict = {}
+            for object_reference in OBJECT_REFERENCES:
+                mask_offset = ArrayDatastore.MASK_OFFSETS[object_reference]
+                mask = image[mask_offset : mask_offset + 65536]
+                addresses = itertools.compress(range(65536), mask)
+                offset = ArrayDatastore.DATA_OFFSETS[object_reference]
+                if object_reference in ("input_registers", "holding_registers"):
+                    register_image = image[offset : offset + 2 * 65536]
+                    registers = [
+                        register_image[i : i + 2] for i in range(0, 2 * 65536, 2)
+                    ]
+                    values = itertools.compress(registers, mask)
+                else:
+                    bits = int.from_bytes(image[offset : offset + 8192], "little")
+                    bit_values = f"{bits:065536b}".encode()[::-1].translate(BIT_VALUES)
+                    values = map(bool, itertools.compress(bit_values, mask))
+                datadict[object_reference] = dict(zip(addresses, values))
+        with self.batch():
+            self.datadict = datadict
+            self.address_space = address_space
+
+    @classmethod
+    def from_snapshot(cls, path):
+        datastore = cls()
+        datastore.restore(path)
+        return datastore
+
+
+# Snapshots are the ArrayDatastore layout, followed by: magic, version, creation time in ns
+SNAPSHOT_MAGIC = b"MBSS"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_TRAILER = struct.Struct("=4sIQ")
+
+
+def write_snapshot(path, image):
+    """Write an ArrayDatastore image to path, atomically replacing an older snapshot"""
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(image)
+        f.write(SNAPSHOT_TRAILER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, time.time_ns()))
+    os.replace(temporary_path, path)
+
+
+def open_snapshot(path, access=mmap.ACCESS_READ):
+    """Memory-map a snapshot, pages are only read from the file when they are accessed"""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size != ArrayDatastore.SIZE + SNAPSHOT_TRAILER.size:
+            raise ValueError(f"{path} is not a modbus_server snapshot")
+        image = mmap.mmap(f.fileno(), 0, access=access)
+    magic, version, _ = SNAPSHOT_TRAILER.unpack_from(image, ArrayDatastore.SIZE)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        image.close()
+        raise ValueError(f"{path} is not a modbus_server snapshot (version 1)")
+    return image
+
+
+class ArrayDatastore:
+    """Datastore backed by one preallocated buffer that holds all four address spaces
+
+    Registers are stored as a 65536 * 2 byte big-endian image, coils and discrete inputs
+    as a 65536 bit bitset (LSB first, like on the wire). A mask with one byte per address
+    marks the mapped addresses, unmapped addresses are answered with exception 02.
+    Bits share their byte with 7 others, so bit writes (read-modify-write of the bytes)
+    are serialized with a lock, like all other writes. batch() holds the lock for a
+    read-modify-write of registers, readers see the writes in it one by one. With
+    shared=True the lock is shared with forked worker processes as well.
+    """
+
+    # Layout of the buffer: 4 masks, 2 register images, 2 bitsets
+    MASK_OFFSETS = {
+        "coils": 0,
+        "discrete_inputs": 65536,
+        "input_registers": 2 * 65536,
+        "holding_registers": 3 * 65536,
+    }
+    DATA_OFFSETS = {
+        "input_registers": 4 * 65536,
+        "holding_registers": 6 * 65536,
+        "coils": 8 * 65536,
+        "discrete_inputs": 8 * 65536 + 8192,
+    }
+    SIZE = 8 * 65536 + 2 * 8192
+
+    def __init__(self, buffer=None, shared=False):
+        if buffer is None:
+            if shared:
+                # Anonymous shared mapping, stays shared with forked worker processes:
+                buffer = mmap.mmap(-1, self.SIZE)
+            else:
+                buffer = bytearray(self.SIZE)
+        elif len(buffer) < self.SIZE:
+            raise ValueError(f"buffer must have at least {self.SIZE} bytes")
+        self.buffer = buffer
+        self.address_space = AddressSpace(buffer, self.MASK_OFFSETS)
+        self.process_shared = isinstance(buffer, mmap.mmap)
+        self._lock = self._create_lock()
+        logger.debug("Initialized empty ArrayDatastore")
+
+    def _create_lock(self):
+        if self.process_shared:
+            import multiprocessing
+
+            # A semaphore, inherited by the worker processes forked later:
+            return multiprocessing.RLock()
+        return threading.RLock()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group several writes, other writers wait until the batch is done"""
+        with self._lock:
+            yield self
+
+    def read_bytes(self, object_reference, first_address, number_of_records):
+        """Return the requested range in wire format (register bytes or packed bits)"""
+        self.address_space.check(object_reference, first_address, number_of_records)
+        offset = self.DATA_OFFSETS[object_reference]
+
+        if object_reference in ("input_registers", "holding_registers"):
+            start = offset + 2 * first_address
+            return self.buffer[start : start + 2 * number_of_records]
+
+        # Shift the bitset so that first_address ends up in bit 0 of the first byte:
+        start = offset + (first_address >> 3)
+        end = offset + ((first_address + number_of_records + 7) >> 3)
+        bits = int.from_bytes(self.buffer[start:end], "little") >> (first_address & 7)
+        bits &= (1 << number_of_records) - 1
+        return bits.to_bytes((number_of_records + 7) >> 3, "little")
+
+    def read(self, object_reference, first_address, number_of_records):
+        data_bytes = self.read_bytes(object_reference, first_address, number_of_records)
+        if object_reference in ("input_registers", "holding_registers"):
+            return [data_bytes[i : i + 2] for i in range(0, len(data_bytes), 2)]
+        bits = int.from_bytes(data_bytes, "little")
+        return [bool(bits >> i & 1) for i in range(number_of_records)]
+
+    def write(self, object_reference, address, value, encoding):
+        buffer = self.buffer
+        offset = self.DATA_OFFSETS[object_reference]
+
+        if object_reference in ("input_registers", "holding_registers"):
+            value_as_bytes = get_codec(encoding).encode(value)
+            number_of_registers = len(value_as_bytes) // 2
+            # The tables share one buffer, a range beyond 65535 would overwrite the next one:
+            check_address_range(address, number_of_registers)
+            start = offset + 2 * address
+            with self._lock:
+                buffer[start : start + len(value_as_bytes)] = value_as_bytes
+            self.address_space.map(object_reference, address, number_of_registers)
+            return
+
+        check_address_range(address, 1)
+        byte_index = offset + (address >> 3)
+        with self._lock:
+            if value:
+                buffer[byte_index] |= 1 << (address & 7)
+            else:
+                buffer[byte_index] &= ~(1 << (address & 7)) & 0xFF
+        self.address_space.map(object_reference, address)
+
+    def write_bits(self, object_reference, first_address, values):
+        """Write a list of bools to mapped coils or discrete inputs in one update"""
+        number_of_records = len(values)
+        self.address_space.check(object_reference, first_address, number_of_records)
+        offset = self.DATA_OFFSETS[object_reference]
+        start = offset + (first_address >> 3)
+        end = offset + ((first_address + number_of_records + 7) >> 3)
+        shift = first_address & 7
+
+        # Convert the bools to an int (first bool -> lowest bit) without a Python loop:
+        new_bits = int(bytes(values[::-1]).translate(BIT_CHARACTERS) or b"0", 2)
+        mask = ((1 << number_of_records) - 1) << shift
+        with self._lock:
+            bits = int.from_bytes(self.buffer[start:end], "little")
+            bits = (bits & ~mask) | (new_bits << shift)
+            self.buffer[start:end] = bits.to_bytes(end - start, "little")
+
+    def write_registers(self, object_reference, first_address, register_bytes):
+        """Write big-endian register bytes to mapped registers in one update"""
+        self.address_space.check(
+            object_reference, first_address, len(register_bytes) // 2
+        )
+        start = self.DATA_OFFSETS[object_reference] + 2 * first_address
+        with self._lock:
+            self.buffer[start : start + len(register_bytes)] = register_bytes
+
+    def set_registers(self, object_reference, first_address, values, encoding):
+        """Pack values with encoding in one go and map the registers they occupy"""
+        register_bytes = get_codec(encoding).encode_many(values)
+        number_of_registers = len(register_bytes) // 2
+        check_address_range(first_address, number_of_registers)
+        start = self.DATA_OFFSETS[object_reference] + 2 * first_address
+        with self._lock:
+            self.buffer[start : start + len(register_bytes)] = register_bytes
+        self.address_space.map(object_reference, first_address, number_of_registers)
+
+    def set_bits(self, object_reference, first_address, values):
+        """Set coils or discrete inputs and map their addresses"""
+        self.address_space.map(object_reference, first_address, len(values))
+        self.write_bits(object_reference, first_address, values)
+
+    def dump(self):
+        datadict = {}
+        for object_reference in self.MASK_OFFSETS:
+            datadict[object_reference] = {
+                address: self.read(object_reference, address, 1)[0]
+                for address in self.address_space.mapped_addresses(object_reference)
+            }
+        return datadict
+
+    def empty(self):
+        self.buffer[:] = bytes(len(self.buffer))
+
+    def after_fork(self):
+        if not self.process_shared:
+            # The lock may have been held by a thread that doesn't exist in the worker:
+            self._lock = threading.RLock()
+
+    def _image(self):
+        # One copy of the buffer, consistent because no other thread runs meanwhile:
+        return self.buffer[: self.SIZE]
+
+    def snapshot(self, path):
+        """Write the buffer to path, while serving"""
+        write_snapshot(path, self._image())
+
+    def restore(self, path):
+        """Replace all values with the values of a snapshot"""
+        with open_snapshot(path) as image:
+            self.buffer[: self.SIZE] = image[: self.SIZE]
+
+    @classmethod
+    def from_snapshot(cls, path):
+        """Serve a snapshot directly from a private (copy-on-write) memory map of the file
+
+        Loading takes no time, pages are read when they are accessed. Writes are not
+        written to the file and are not shared with forked worker processes.
+        """
+        datastore = cls(buffer=open_snapshot(path, access=mmap.ACCESS_COPY))
+        datastore.process_shared = False
+        datastore._lock = datastore._create_lock()
+        return datastore
+
+
+class SharedMemoryDatastore(ArrayDatastore):
+    """ArrayDatastore in a memory-mapped file, shared with producer processes
+
+    The file holds the register images, bitsets and masks of the ArrayDatastore, followed
+    by a header with a sequence number. Writers make the sequence number odd while they
+    change the data (seqlock), readers retry until they copied a range while the number
+    was even and unchanged. So readers never block writers and never see a value that is
+    only partly written. Writers exclude each other with flock() on the file. If a writer
+    dies while writing, the next writer or a waiting reader makes the number even again.
+
+    Producer processes open the same path and use set_registers(), set_bits() or a
+    batch() of several writes:
+
+        datastore = SharedMemoryDatastore("/dev/shm/modbus_server")
+        datastore.set_registers("input_registers", 0, [1.5, 2.5], "f")
+    """
+
+    MAGIC = b"MBSM"
+    VERSION = 1
+    # Header after the ArrayDatastore layout: magic, version, sequence number
+    HEADER = struct.Struct("=4sIQ")
+    SEQUENCE = struct.Struct("=Q")
+    SEQUENCE_OFFSET = ArrayDatastore.SIZE + 8
+
+    def __init__(self, path="/dev/shm/modbus_server", create=True):
+        self.path = path
+        flags = os.O_RDWR | (os.O_CREAT if create else 0)
+        self._fd = os.open(path, flags, 0o600)
+        file_size = ArrayDatastore.SIZE + self.HEADER.size
+        if os.fstat(self._fd).st_size < file_size:
+            if not create:
+                os.close(self._fd)
+                raise ValueError(f"{path} is not a SharedMemoryDatastore")
+            os.ftruncate(self._fd, file_size)
+        super().__init__(buffer=mmap.mmap(self._fd, file_size))
+
+        magic, version, _ = self.HEADER.unpack_from(self.buffer, ArrayDatastore.SIZE)
+        if magic == b"\x00" * 4:
+            self.HEADER.pack_into(
+                self.buffer, ArrayDatastore.SIZE, self.MAGIC, self.VERSION, 0
+            )
+        elif magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f"{path} is not a SharedMemoryDatastore (version 1)")
+
+        self._write_depth = 0
+        self._writer = None  # Thread ID of the writer in progress
+
+    def _create_lock(self):
+        # Other processes are excluded with flock(), the lock is for the threads:
+        return threading.RLock()
+
+    ## Seqlock
+    ## =======
+
+    def _sequence(self):
+        return self.SEQUENCE.unpack_from(self.buffer, self.SEQUENCE_OFFSET)[0]
+
+    def _begin_write(self):
+        self._lock.acquire()
+        self._write_depth += 1
+        if self._write_depth == 1:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            self._writer = threading.get_ident()
+            sequence = self._sequence()
+            if sequence & 1:
+                # The previous writer died in its write, its flock() was released with
+                # its file. The number stays odd until this write ends:
+                logger.warning(f"Writer of {self.path} died while writing, recovering")
+            else:
+                self.SEQUENCE.pack_into(self.buffer, self.SEQUENCE_OFFSET, sequence + 1)
+
+    def _end_write(self):
+        self._write_depth -= 1
+        if self._write_depth == 0:
+            self._writer = None
+            self.SEQUENCE.pack_into(
+                self.buffer, self.SEQUENCE_OFFSET, self._sequence() + 1
+            )
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def _recover_crashed_writer(self):
+        """Make the sequence number even again if its writer died while writing
+
+        Only a writer holds the flock() while the number is odd, so if it can be taken
+        without waiting, the writer is gone.
+        """
+        if not self._lock.acquire(blocking=False):
+            return  # Another thread of this process is writing
+        try:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # Another process is writing
+            sequence = self._sequence()
+            if sequence & 1:
+                logger.warning(f"Writer of {self.path} died while writing, recovering")
+                self.SEQUENCE.pack_into(self.buffer, self.SEQUENCE_OFFSET, sequence + 1)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group several writes, readers see either none or all of them"""
+        self._begin_write()
+        try:
+            yield self
+        finally:
+            self._end_write()
+
+    def read_bytes(self, object_reference, first_address, number_of_records):
+        if self._writer == threading.get_ident():
+            # In a batch() of this thread, other writers wait for its flock():
+            return super().read_bytes(
+                object_reference, first_address, number_of_records
+            )
+        attempts = 0
+        while True:
+            sequence = self._sequence()
+            if not sequence & 1:
+                try:
+                    data = super().read_bytes(
+                        object_reference, first_address, number_of_records
+                    )
+                except KeyError:
+                    if self._sequence() == sequence:
+                        raise
+                else:
+                    if self._sequence() == sequence:
+                        return data
+            attempts += 1
+            if attempts % 100 == 0:
+                # A writer holds the lock for longer, give it the CPU:
+                time.sleep(0)
+                if attempts % 10000 == 0:
+                    self._recover_crashed_writer()
+
+    ## Writes
+    ## ======
+
+    def write(self, object_reference, address, value, encoding):
+        with self.batch():
+            super().write(object_reference, address, value, encoding)
+
+    def write_bits(self, object_reference, first_address, values):
+        with self.batch():
+            super().write_bits(object_reference, first_address, values)
+
+    def write_registers(self, object_reference, first_address, register_bytes):
+        with self.batch():
+            super().write_registers(object_reference, first_address, register_bytes)
+
+    def set_registers(self, object_reference, first_address, values, encoding):
+        with self.batch():
+            super().set_registers(object_reference, first_address, values, encoding)
+
+    def set_bits(self, object_reference, first_address, values):
+        with self.batch():
+            super().set_bits(object_reference, first_address, values)
+
+    def empty(self):
+        with self.batch():
+            self.buffer[: ArrayDatastore.SIZE] = bytes(ArrayDatastore.SIZE)
+
+    def _image(self):
+        if self._writer == threading.get_ident():
+            return self.buffer[: ArrayDatastore.SIZE]
+        # Copy without blocking writers, like read_bytes():
+        attempts = 0
+        while True:
+            sequence = self._sequence()
+            if not sequence & 1:
+                image = self.buffer[: ArrayDatastore.SIZE]
+                if self._sequence() == sequence:
+                    return image
+            time.sleep(0)
+            attempts += 1
+            if attempts % 100 == 0:
+                self._recover_crashed_writer()
+
+    def restore(self, path):
+        with self.batch():
+            super().restore(path)
+
+    @classmethod
+    def from_snapshot(cls, snapshot_path, path="/dev/shm/modbus_server"):
+        datastore = cls(path)
+        datastore.restore(snapshot_path)
+        return datastore
+
+    def after_fork(self):
+        # flock() locks belong to the open file, so every process needs its own:
+        os.close(self._fd)
+        self._fd = os.open(self.path, os.O_RDWR)
+        self._lock = threading.RLock()
+        self._write_depth = 0
+        self._writer = None
+
+    def close(self):
+        self.buffer.close()
+        os.close(self._fd)
+
+    def unlink(self):
+        os.unlink(self.path)
 
 
 class RedisDatastore:
+    """Datastore that serves values from redis keys, as configured in a modbus_address_map
+
+    An existing client (e.g. a fakeredis stand-in) can be passed as redis_client, it is
+    used instead of connecting to redis_host:redis_port.
+
+    With cache_ttl or cache_keyspace_notifications set, the cast and packed values are
+    cached in-process. Cached values expire after cache_ttl seconds and/or are invalidated
+    by redis keyspace notifications as soon as another process changes the key.
+    """
+
+    # All processes see the same data in redis:
+    process_shared = True
+    # Requests wait for redis, so the asyncio mode processes them outside its event loop:
+    blocking_io = True
+
     def __init__(
-        self, modbus_address_map={}, redis_host="localhost", redis_port=6379, redis_db=0
+        self,
+        modbus_address_map={},
+        redis_host="localhost",
+        redis_port=6379,
+        redis_db=0,
+        cache_ttl=None,
+        cache_keyspace_notifications=False,
+        redis_client=None,
     ):
 
         self.host = redis_host
         self.port = redis_port
         self.db = redis_db
         self.modbus_address_map = modbus_address_map
-        self.r = None
+        self.r = redis_client
+        self.cache_enabled = cache_ttl is not None or cache_keyspace_notifications
+        self.cache_ttl = cache_ttl
+        self.cache = {}  # key -> (cast and packed value, expiry time)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache_invalidations = 0
+        self._pubsub_thread = None
         self._verify_modbus_address_map()
+        self.rebuild_index()
         self._connect()
+        if cache_keyspace_notifications:
+            self._subscribe_keyspace_notifications()
         logger.debug("Initialized RedisDatastore")
 
     def _connect(self):
-        self.r = redis.Redis(self.host, self.port, self.db)
+        if self.r is None:
+            import redis
+
+            self.r = redis.Redis(self.host, self.port, self.db)
         self.r.ping()  # Check the connection
 
+    def _subscribe_keyspace_notifications(self):
+        import redis
+
+        try:
+            self.r.config_set("notify-keyspace-events", "KA")
+        except redis.exceptions.ResponseError as e:
+            # e.g. managed redis instances that forbid CONFIG, notifications must be enabled there
+            logger.warning(f"Could not enable keyspace notifications: {e}")
+
+        pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(**{f"__keyspace@{self.db}__:*": self._invalidate_message})
+        self._pubsub_thread = pubsub.run_in_thread(
+            sleep_time=0.1,
+            daemon=True,
+            exception_handler=self._handle_pubsub_exception,
+        )
+
+    def _invalidate_message(self, message):
+        # Channel is __keyspace@<db>__:<key>
+        key = message["channel"].split(b":", 1)[1].decode()
+        self._cache_invalidations += 1
+        self.cache.pop(key, None)
+
+    def _handle_pubsub_exception(self, exception, pubsub, thread):
+        # Notifications may have been missed, so no cached value can be trusted:
+        logger.warning(f"Keyspace notification subscription failed: {exception}")
+        self.clear_cache()
+        time.sleep(1)
+
+    def clear_cache(self):
+        self.cache.clear()
+
+    def after_fork(self):
+        """Called in forked worker processes, where the notification thread is gone"""
+        self.clear_cache()
+        if self._pubsub_thread is not None:
+            self._subscribe_keyspace_notifications()
+
+    def close(self):
+        if self._pubsub_thread is not None:
+            self._pubsub_thread.stop()
+            self._pubsub_thread = None
+
     def _verify_modbus_address_map(self):
         for key in self.modbus_address_map.keys():
             if key not in (
@@ -88,6 +866,47 @@ class RedisDatastore:
             if std_key not in self.modbus_address_map:
                 self.modbus_address_map[std_key] = {}
 
+    def rebuild_index(self):
+        """Compile the modbus_address_map into the index used on every request
+
+        Call this after changing the modbus_address_map of a running datastore.
+        """
+        index = {}
+        for object_reference in (
+            "coils",
+            "discrete_inputs",
+            "input_registers",
+            "holding_registers",
+        ):
+            entries = [None] * 65536
+            for address, props in self.modbus_address_map[object_reference].items():
+                entries[int(address)] = self._compile_entry(object_reference, props)
+            index[object_reference] = entries
+        self.index = index
+        self.address_space = AddressSpace()
+        for object_reference, entries in index.items():
+            for address, entry in enumerate(entries):
+                if entry is not None:
+                    self.address_space.map(object_reference, address)
+
+    def _compile_entry(self, object_reference, props):
+        # Index entry: (key, codec of the encoding, cast from string, byte offset of the part)
+        if object_reference in ("coils", "discrete_inputs"):
+            return (props["key"], None, parse_bool, 0)
+        codec = get_codec(
+            props["encoding"],
+            props.get("word_order", "big"),
+            props.get("byte_order", "big"),
+        )
+        offset = (props.get("part", 1) - 1) * 2
+        return (props["key"], codec, codec.parse, offset)
+
+    def _lookup(self, object_reference, first_address, number_of_records):
+        self.address_space.check(object_reference, first_address, number_of_records)
+        return self.index[object_reference][
+            first_address : first_address + number_of_records
+        ]
+
     def apply_initial_values(self):
         for object_reference, addresses in self.modbus_address_map.items():
             for address, props in addresses.items():
@@ -105,57 +924,286 @@ class RedisDatastore:
                 )
 
     def read(self, object_reference, first_address, number_of_records):
-        data = []
-        for address in range(first_address, first_address + number_of_records):
-            address_properties = self.modbus_address_map[object_reference][str(address)]
-            key = address_properties["key"]
+        # Resolve all addresses first, unmapped addresses raise a KeyError:
+        entries = self._lookup(object_reference, first_address, number_of_records)
+        key_entries = {entry[0]: entry for entry in entries}
 
-            raw_value = self.r.get(key)
+        # Take what is still valid from the cache:
+        values = {}  # Cast and packed value per key
+        if self.cache_enabled:
+            now = time.monotonic()
+            for key in key_entries:
+                cached = self.cache.get(key)
+                if cached is not None and cached[1] > now:
+                    values[key] = cached[0]
+            self.cache_hits += len(values)
+            self.cache_misses += len(key_entries) - len(values)
 
-            if raw_value is None:
-                logger.warning(
-                    f"Key {key} for {object_reference}:{address} not found in redis"
+        # Fetch every remaining key only once, with a single round-trip:
+        keys = [key for key in key_entries if key not in values]
+        if keys:
+            invalidations = self._cache_invalidations
+            raw_values = self.r.mget(keys)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    f"Getting {len(keys)} keys for {object_reference}:{first_address}+{number_of_records} from redis"
                 )
-                raise KeyError(f"Key {key} could not be found in redis datastore")
+            for key, raw_value in zip(keys, raw_values):
+                if raw_value is None:
+                    logger.warning(
+                        f"Key {key} for {object_reference} not found in redis"
+                    )
+                    raise KeyError(f"Key {key} could not be found in redis datastore")
+                _, codec, cast, _ = key_entries[key]
+                if codec is None:
+                    values[key] = cast(raw_value.decode())
+                else:
+                    values[key] = codec.encode(cast(raw_value.decode()))
 
-            unicode_value = raw_value.decode()
-            logger.debug(
-                f"Getting {key} for {object_reference}:{address} from redis -> {unicode_value}"
-            )
+            # Don't cache values that may have been changed while they were fetched:
+            if self.cache_enabled and invalidations == self._cache_invalidations:
+                expiry = (
+                    now + self.cache_ttl if self.cache_ttl is not None else math.inf
+                )
+                for key in keys:
+                    self.cache[key] = (values[key], expiry)
+
+        data = []
+        for key, codec, cast, offset in entries:
+            if codec is None:
+                data.append(values[key])
+            else:
+                data.append(values[key][offset : offset + 2])
 
+        return data
+
+    def _key_for(self, object_reference, address, encoding):
+        # Unmapped addresses are mapped to a new key, with one part per register:
+        try:
+            return self.modbus_address_map[object_reference][str(address)]["key"]
+        except KeyError:
+            key = f"{object_reference}:{address}"
             if object_reference in ("coils", "discrete_inputs"):
-                # Cast value from string to bool:
-                value = bool(distutils.util.strtobool(unicode_value))
+                number_of_registers = 1
+                encoding_props = {}
+            else:
+                codec = get_codec(encoding)
+                number_of_registers = codec.registers
+                encoding_props = {"encoding": codec.encoding}
+                if codec.word_order != "big":
+                    encoding_props["word_order"] = codec.word_order
+                if codec.byte_order != "big":
+                    encoding_props["byte_order"] = codec.byte_order
+            check_address_range(address, number_of_registers)
+            for part in range(1, number_of_registers + 1):
+                props = {"key": key, **encoding_props}
+                if number_of_registers > 1:
+                    props["part"] = part
+                part_address = address + part - 1
+                self.modbus_address_map[object_reference][str(part_address)] = props
+                self.index[object_reference][part_address] = self._compile_entry(
+                    object_reference, props
+                )
+                self.address_space.map(object_reference, part_address)
+            return key
+
+    def write(self, object_reference, address, value, encoding):
+
+        if type(value) == bool:
+            value = str(value)
 
-            elif object_reference in ("input_registers", "holding_registers"):
-                encoding = address_properties["encoding"]
+        key = self._key_for(object_reference, address, encoding)
+        self.r.set(key, value)
+        self.cache.pop(key, None)
 
-                if encoding in ("h", "H", "i", "I"):  # ints
-                    value = struct.pack(f"!{encoding}", int(unicode_value))
-                if encoding in ("e", "f", "d"):  # floats
-                    value = struct.pack(f"!{encoding}", float(unicode_value))
+    def set_registers(self, object_reference, first_address, values, encoding):
+        """Set values with one round-trip, unmapped addresses are mapped to new keys"""
+        registers_per_value = get_codec(encoding).registers
+        check_address_range(first_address, len(values) * registers_per_value)
+        mapping = {
+            self._key_for(
+                object_reference, first_address + i * registers_per_value, encoding
+            ): value
+            for i, value in enumerate(values)
+        }
+        self.r.mset(mapping)
+        for key in mapping:
+            self.cache.pop(key, None)
 
-                if encoding in ("i", "I", "f", "d"):
-                    # >2 bytes: Find out which part is requested:
-                    part = address_properties["part"]
-                    value = value[(part - 1) * 2 : part * 2]
+    def set_bits(self, object_reference, first_address, values):
+        """Set coils or discrete inputs with one round-trip, unmapped addresses are mapped to new keys"""
+        check_address_range(first_address, len(values))
+        mapping = {
+            self._key_for(object_reference, first_address + i, None): str(value)
+            for i, value in enumerate(values)
+        }
+        self.r.mset(mapping)
+        for key in mapping:
+            self.cache.pop(key, None)
 
-            data.append(value)
+    def write_bits(self, object_reference, first_address, values):
+        """Write a list of bools to mapped coils or discrete inputs with one round-trip"""
+        entries = self._lookup(object_reference, first_address, len(values))
+        mapping = {entry[0]: str(value) for entry, value in zip(entries, values)}
+        self.r.mset(mapping)
+        for key in mapping:
+            self.cache.pop(key, None)
 
-        return data
+    def write_registers(self, object_reference, first_address, register_bytes):
+        """Write big-endian register bytes to the mapped keys with one round-trip
 
-    def write(self, object_reference, address, value, encoding):
+        Values spanning several registers (e.g. floats) are re-assembled from their parts.
+        If only some parts of such a value are written, the other parts are taken from the
+        current value in redis.
+        """
+        entries = self._lookup(
+            object_reference, first_address, len(register_bytes) // 2
+        )
+
+        # Collect the written register parts (by byte offset) for every key:
+        keys = {}
+        for i, (key, codec, cast, offset) in enumerate(entries):
+            key_entry = keys.setdefault(key, (codec, cast, {}))
+            key_entry[2][offset] = register_bytes[2 * i : 2 * i + 2]
+
+        # Fetch the current values of keys where not all parts are written:
+        incomplete_keys = [
+            key
+            for key, (codec, cast, parts) in keys.items()
+            if 2 * len(parts) < codec.size
+        ]
+        current_values = {}
+        if incomplete_keys:
+            current_values = dict(zip(incomplete_keys, self.r.mget(incomplete_keys)))
+
+        mapping = {}
+        for key, (codec, cast, parts) in keys.items():
+            if key in current_values:
+                current_value = current_values[key]
+                if current_value is None:
+                    raise KeyError(f"Key {key} could not be found in redis datastore")
+                value_bytes = codec.encode(cast(current_value.decode()))
+                for offset in range(0, codec.size, 2):
+                    parts.setdefault(offset, value_bytes[offset : offset + 2])
+            joined = b"".join(parts[offset] for offset in range(0, codec.size, 2))
+            mapping[key] = codec.decode(joined)
+
+        self.r.mset(mapping)
+        for key in mapping:
+            self.cache.pop(key, None)
 
-        if type(value) == bool:
-            value = str(value)
 
+class PooledRedisDatastore(RedisDatastore):
+    """RedisDatastore with a bounded connection pool, timeouts and reconnects
+
+    The request handlers share at most max_connections connections, a request waits up
+    to pool_timeout seconds for a free one. Failed commands are retried on a new
+    connection up to retries times, with exponential backoff (with jitter) of at most
+    max_backoff seconds. If redis is still unavailable, the request is answered with
+    exception 04 (Server Device Failure) instead of closing the connection, and the next
+    request reconnects.
+
+    The commands block the handler that waits for them, in asyncio mode the Server
+    processes the requests for this datastore in a thread pool with max_connections
+    threads, apart from the event loop.
+
+    An existing client (e.g. fakeredis.FakeRedis) can be passed as redis_client.
+    Keyspace notifications are not supported, cache_ttl is.
+    """
+
+    def __init__(
+        self,
+        modbus_address_map={},
+        redis_host="localhost",
+        redis_port=6379,
+        redis_db=0,
+        cache_ttl=None,
+        redis_client=None,
+        max_connections=10,
+        pool_timeout=1.0,
+        socket_timeout=1.0,
+        retries=3,
+        max_backoff=0.5,
+    ):
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.socket_timeout = socket_timeout
+        self.retries = retries
+        self.max_backoff = max_backoff
+        self._owns_client = redis_client is None
+        super().__init__(
+            modbus_address_map,
+            redis_host,
+            redis_port,
+            redis_db,
+            cache_ttl=cache_ttl,
+            redis_client=redis_client,
+        )
+
+    def _create_client(self):
+        import redis
+        from redis.retry import Retry
+        from redis.backoff import ExponentialWithJitterBackoff
+
+        pool = redis.BlockingConnectionPool(
+            max_connections=self.max_connections,
+            timeout=self.pool_timeout,
+            host=self.host,
+            port=self.port,
+            db=self.db,
+            socket_timeout=self.socket_timeout,
+            socket_connect_timeout=self.socket_timeout,
+            retry=Retry(
+                ExponentialWithJitterBackoff(cap=self.max_backoff), self.retries
+            ),
+        )
+        return redis.Redis(connection_pool=pool)
+
+    def _connect(self):
+        if self.r is None:
+            self.r = self._create_client()
         try:
-            key = self.modbus_address_map[object_reference][str(address)]["key"]
-        except KeyError:
-            key = f"{object_reference}:{address}"
-            self.modbus_address_map[object_reference][str(address)] = {
-                "key": key,
-                "encoding": encoding,
-            }
+            with self._unavailable_on_connection_errors():
+                self.r.ping()  # Check the connection
+        except DatastoreUnavailableError as e:
+            # The server can start before redis, requests are answered with exception 04 until then:
+            logger.warning(f"PooledRedisDatastore: {e}")
 
-        self.r.set(key, value)
+    @contextlib.contextmanager
+    def _unavailable_on_connection_errors(self):
+        import redis
+
+        try:
+            yield
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            raise DatastoreUnavailableError(f"redis is unavailable: {e}") from e
+
+    def read(self, object_reference, first_address, number_of_records):
+        with self._unavailable_on_connection_errors():
+            return super().read(object_reference, first_address, number_of_records)
+
+    def write(self, object_reference, address, value, encoding):
+        with self._unavailable_on_connection_errors():
+            super().write(object_reference, address, value, encoding)
+
+    def write_bits(self, object_reference, first_address, values):
+        with self._unavailable_on_connection_errors():
+            super().write_bits(object_reference, first_address, values)
+
+    def write_registers(self, object_reference, first_address, register_bytes):
+        with self._unavailable_on_connection_errors():
+            super().write_registers(object_reference, first_address, register_bytes)
+
+    def set_registers(self, object_reference, first_address, values, encoding):
+        with self._unavailable_on_connection_errors():
+            super().set_registers(object_reference, first_address, values, encoding)
+
+    def set_bits(self, object_reference, first_address, values):
+        with self._unavailable_on_connection_errors():
+            super().set_bits(object_reference, first_address, values)
+
+    def close(self):
+        # Forked worker processes get new connections from the pool by themselves:
+        if self._owns_client:
+            self.r.connection_pool.disconnect()
+        super().close()
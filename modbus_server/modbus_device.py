@@ -0,0 +1,200 @@
+"""Read Device Identification (FC 43 / MEI 14) and Diagnostics (FC 8) of a Server
+
+The identification objects don't change while serving, so every possible response is
+encoded once when the DeviceInformation is created and a request is answered with a dict lookup.
+The diagnostics counters are derived from the request metrics of the Server.
+"""
+
+import struct
+
+from .modbus_pdu import ModbusError
+
+# Names of the standard objects, by object ID:
+OBJECT_NAMES = (
+    "VendorName",
+    "ProductCode",
+    "MajorMinorRevision",
+    "VendorUrl",
+    "ProductName",
+    "ModelName",
+    "UserApplicationName",
+)
+
+# Read Device ID codes for stream access: basic, regular, extended
+STREAM_CATEGORIES = {
+    1: range(0x00, 0x03),
+    2: range(0x00, 0x80),
+    3: range(0x00, 0x100),
+}
+INDIVIDUAL_ACCESS = 4
+
+MEI_TYPE = 0x0E
+# MEI type, Read Device ID code, conformity level, more follows, next object ID, number of objects:
+IDENTIFICATION_HEADER = struct.Struct("!BBBBBB")
+# A response PDU has at most 253 bytes, including the function code:
+MAX_OBJECTS_LENGTH = 253 - 1 - IDENTIFICATION_HEADER.size
+
+SUB_FUNCTION_AND_DATA = struct.Struct("!HH")
+
+
+def encode_object_value(value):
+    if isinstance(value, str):
+        value = value.encode()
+    if len(value) > MAX_OBJECTS_LENGTH - 2:
+        raise ValueError(f"Identification object value {value} is too long")
+    return bytes(value)
+
+
+class DeviceInformation:
+    """Identification objects and diagnostics counters of a Server
+
+    identification maps object IDs (0x00 - 0x06 also by name, e.g. "VendorName") to str or
+    bytes values. The basic objects VendorName, ProductCode and MajorMinorRevision are
+    always present. Diagnostics counters need metrics, otherwise those sub-functions are
+    answered with exception 01 (Illegal Function).
+    """
+
+    def __init__(self, identification=None, metrics=None):
+        from . import __version__
+
+        objects = {
+            "VendorName": "modbus_server",
+            "ProductCode": "modbus_server",
+            "MajorMinorRevision": __version__,
+            **(identification or {}),
+        }
+        self.objects = {}
+        for object_id, value in objects.items():
+            if isinstance(object_id, str):
+                object_id = OBJECT_NAMES.index(object_id)
+            if not 0 <= object_id <= 0xFF:
+                raise ValueError(f"Invalid identification object ID {object_id}")
+            self.objects[object_id] = encode_object_value(value)
+        self.objects = dict(sorted(self.objects.items()))
+
+        if any(object_id >= 0x80 for object_id in self.objects):
+            conformity_level = 0x83
+        elif any(object_id >= 0x03 for object_id in self.objects):
+            conformity_level = 0x82
+        else:
+            conformity_level = 0x81
+        self.conformity_level = conformity_level
+        self.identification_responses = self._encode_identification_responses()
+
+        self.metrics = metrics
+        self._counter_baseline = {}
+
+    ## Read Device Identification (43 / 14):
+    ## ======================================
+
+    def _encode_identification_responses(self):
+        # Response data (after the function code) for every (Read Device ID code, object ID):
+        responses = {}
+        for read_code, category in STREAM_CATEGORIES.items():
+            object_ids = [
+                object_id for object_id in self.objects if object_id in category
+            ]
+            for index, first_object_id in enumerate(object_ids):
+                responses[read_code, first_object_id] = self._encode_objects(
+                    read_code, object_ids[index:]
+                )
+        for object_id in self.objects:
+            responses[INDIVIDUAL_ACCESS, object_id] = self._encode_objects(
+                INDIVIDUAL_ACCESS, [object_id]
+            )
+        return responses
+
+    def _encode_objects(self, read_code, object_ids):
+        encoded_objects = b""
+        number_of_objects = 0
+        more_follows = False
+        next_object_id = 0
+        for object_id in object_ids:
+            value = self.objects[object_id]
+            encoded_object = bytes([object_id, len(value)]) + value
+            if len(encoded_objects) + len(encoded_object) > MAX_OBJECTS_LENGTH:
+                # The client requests the rest starting with next_object_id:
+                more_follows = True
+                next_object_id = object_id
+                break
+            encoded_objects += encoded_object
+            number_of_objects += 1
+        return (
+            IDENTIFICATION_HEADER.pack(
+                MEI_TYPE,
+                read_code,
+                self.conformity_level,
+                0xFF if more_follows else 0x00,
+                next_object_id,
+                number_of_objects,
+            )
+            + encoded_objects
+        )
+
+    def read_device_identification(self, pdu):
+        """Response data for a Read Device Identification request PDU"""
+        if len(pdu) != 4 or pdu[1] != MEI_TYPE:
+            raise ModbusError(1, "Only MEI type 14 (Read Device Identification)")
+        read_code, object_id = pdu[2], pdu[3]
+        response = self.identification_responses.get((read_code, object_id))
+        if response is not None:
+            return response
+        if read_code == INDIVIDUAL_ACCESS:
+            raise ModbusError(2, f"No identification object {object_id:#04x}")
+        if read_code not in STREAM_CATEGORIES:
+            raise ModbusError(3, f"Invalid Read Device ID code {read_code}")
+        # Unknown object IDs restart the stream at the first object:
+        return self.identification_responses[read_code, 0]
+
+    ## Diagnostics (8):
+    ## ================
+
+    def _counters(self):
+        metrics = self.metrics
+        with metrics.lock:
+            messages = sum(metrics.requests_by_function_code.values())
+            exceptions = metrics.exceptions.copy()
+        return {
+            0x0B: messages,  # Bus Message Count
+            0x0D: sum(exceptions.values()),  # Bus Exception Error Count
+            0x0E: messages,  # Server Message Count
+            0x10: sum(n for (_, code), n in exceptions.items() if code == 7),  # NAK
+            0x11: sum(n for (_, code), n in exceptions.items() if code == 6),  # Busy
+        }
+
+    def clear_counters(self):
+        if self.metrics is not None:
+            self._counter_baseline = self._counters()
+
+    def diagnostics(self, pdu):
+        """Response data for a Diagnostics request PDU"""
+        if len(pdu) < 3:
+            raise ModbusError(3, "Invalid request length")
+        sub_function = pdu[1] << 8 | pdu[2]
+
+        # Return Query Data echoes the request:
+        if sub_function == 0x00:
+            return pdu[1:]
+        if len(pdu) != 5:
+            raise ModbusError(3, "Invalid request length")
+
+        # Restart Communications Option, Clear Counters and Diagnostic Register:
+        if sub_function in (0x01, 0x0A):
+            self.clear_counters()
+            return pdu[1:]
+
+        if self.metrics is None or sub_function not in (0x0B, 0x0D, 0x0E, 0x10, 0x11):
+            raise ModbusError(
+                1, f"Diagnostics sub-function {sub_function} not supported"
+            )
+        count = self._counters()[sub_function]
+        baseline = self._counter_baseline.get(sub_function, 0)
+        if count >= baseline:  # Otherwise the metrics were reset since
+            count -= baseline
+        return SUB_FUNCTION_AND_DATA.pack(sub_function, count & 0xFFFF)
+
+    def process_request(self, pdu):
+        """Response data (following the function code) for an FC 8 or FC 43 request PDU"""
+        if pdu[0] == 43:
+            return self.read_device_identification(pdu)
+        return self.diagnostics(pdu)
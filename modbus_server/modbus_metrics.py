@@ -0,0 +1,227 @@
+import time
+import bisect
+import threading
+
+# Upper bounds of the latency histogram buckets in seconds:
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    float("inf"),
+)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            yield bucket, total
+
+
+class Metrics:
+    """Request counters and latency histograms of a Server
+
+    Requests are counted per function code, unit ID and client address, exception
+    responses per function code and exception code. Request and datastore call
+    latencies are collected in histograms per function code and datastore method.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests_by_function_code = {}
+        self.requests_by_unit_id = {}
+        self.requests_by_client = {}
+        self.exceptions = {}  # (function_code, exception_code) -> count
+        self.request_latency = {}  # function_code -> Histogram
+        self.datastore_latency = {}  # datastore method -> Histogram
+
+    def record_request(self, function_code, unit_id, client, duration, exception_code):
+        with self.lock:
+            self.requests_by_function_code[function_code] = (
+                self.requests_by_function_code.get(function_code, 0) + 1
+            )
+            self.requests_by_unit_id[unit_id] = (
+                self.requests_by_unit_id.get(unit_id, 0) + 1
+            )
+            self.requests_by_client[client] = self.requests_by_client.get(client, 0) + 1
+            if exception_code is not None:
+                key = (function_code, exception_code)
+                self.exceptions[key] = self.exceptions.get(key, 0) + 1
+            if function_code not in self.request_latency:
+                self.request_latency[function_code] = Histogram()
+            self.request_latency[function_code].observe(duration)
+
+    def record_datastore_call(self, method, duration):
+        with self.lock:
+            if method not in self.datastore_latency:
+                self.datastore_latency[method] = Histogram()
+            self.datastore_latency[method].observe(duration)
+
+    def reset(self):
+        with self.lock:
+            for values in (
+                self.requests_by_function_code,
+                self.requests_by_unit_id,
+                self.requests_by_client,
+                self.exceptions,
+                self.request_latency,
+                self.datastore_latency,
+            ):
+                values.clear()
+
+    def export_prometheus(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def counter(name, help_text, label_names, values):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for label_values, value in sorted(values.items()):
+                if not isinstance(label_values, tuple):
+                    label_values = (label_values,)
+                labels = ",".join(
+                    f'{label}="{label_value}"'
+                    for label, label_value in zip(label_names, label_values)
+                )
+                lines.append(f"{name}{{{labels}}} {value}")
+
+        def histograms(name, help_text, label_name, values):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for label_value, histogram in sorted(values.items()):
+                label = f'{label_name}="{label_value}"'
+                for bucket, count in histogram.cumulative_counts():
+                    le = "+Inf" if bucket == float("inf") else repr(bucket)
+                    lines.append(f'{name}_bucket{{{label},le="{le}"}} {count}')
+                lines.append(f"{name}_sum{{{label}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{label}}} {histogram.count}")
+
+        with self.lock:
+            counter(
+                "modbus_requests_total",
+                "Requests by function code",
+                ("function_code",),
+                self.requests_by_function_code,
+            )
+            counter(
+                "modbus_unit_requests_total",
+                "Requests by unit ID",
+                ("unit_id",),
+                self.requests_by_unit_id,
+            )
+            counter(
+                "modbus_client_requests_total",
+                "Requests by client address",
+                ("client",),
+                self.requests_by_client,
+            )
+            counter(
+                "modbus_exceptions_total",
+                "Exception responses by function code and exception code",
+                ("function_code", "exception_code"),
+                self.exceptions,
+            )
+            histograms(
+                "modbus_request_duration_seconds",
+                "Request processing time by function code",
+                "function_code",
+                self.request_latency,
+            )
+            histograms(
+                "modbus_datastore_call_duration_seconds",
+                "Datastore call time by method",
+                "method",
+                self.datastore_latency,
+            )
+        return "\n".join(lines) + "\n"
+
+
+class InstrumentedDatastore:
+    """Wraps a datastore and records the duration of its read and write calls"""
+
+    INSTRUMENTED_METHODS = (
+        "read",
+        "read_bytes",
+        "write",
+        "write_bits",
+        "write_registers",
+    )
+
+    def __init__(self, datastore, metrics):
+        self.datastore = datastore
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        # Raises AttributeError for methods the datastore doesn't have, so hasattr() works:
+        attribute = getattr(self.datastore, name)
+        if name not in self.INSTRUMENTED_METHODS:
+            return attribute
+
+        metrics = self.metrics
+
+        def timed_call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                metrics.record_datastore_call(name, time.perf_counter() - start)
+
+        # Cache the wrapper, __getattr__ is only called for missing attributes:
+        self.__dict__[name] = timed_call
+        return timed_call
+
+
+class MetricsHTTPServer:
+    """Serves Metrics.export_prometheus() on http://host:port/metrics from a daemon thread"""
+
+    def __init__(self, metrics, host="localhost", port=9502):
+        import http.server
+
+        class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] != "/metrics":
+                    handler.send_error(404)
+                    return
+                body = metrics.export_prometheus().encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(
+            (host, port), MetricsRequestHandler
+        )
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join(timeout=2)
@@ -0,0 +1,367 @@
+"""Transport-independent processing of Modbus request PDUs
+
+The framing of requests and responses (MBAP for Modbus/TCP, RTU with CRC) is done by
+the transports in modbus_server and modbus_rtu, which all share process_pdu().
+"""
+
+import struct
+import logging
+import contextlib
+import itertools
+
+logger = logging.getLogger("modbus_server_logger")
+
+# Constants:
+
+FUNCTION_CODE_MAP = {
+    1: "coils",
+    2: "discrete_inputs",
+    4: "input_registers",
+    3: "holding_registers",
+}
+
+
+ADDRESS_AND_COUNT = struct.Struct("!HH")
+READ_WRITE_REQUEST = struct.Struct("!HHHHB")
+
+# Byte value for every chunk of up to 8 bools (first bool -> least significant bit):
+BOOLS_TO_BYTE = {
+    bools: sum(1 << i for i, b in enumerate(bools) if b)
+    for chunk_length in range(1, 9)
+    for bools in itertools.product((False, True), repeat=chunk_length)
+}
+
+# The 8 bools for every byte value (least significant bit -> first bool):
+BYTE_TO_BOOLS = [tuple(bool(value >> i & 1) for i in range(8)) for value in range(256)]
+
+
+def pack_bools_to_bytes(bool_list):
+    try:
+        return bytes(
+            [
+                BOOLS_TO_BYTE[tuple(bool_list[j : j + 8])]
+                for j in range(0, len(bool_list), 8)
+            ]
+        )
+    except KeyError:
+        # Custom datastores may return any truthy value for a set coil, like "on":
+        return pack_bools_to_bytes([bool(value) for value in bool_list])
+
+
+def unpack_bytes_to_bools(data_bytes, number_of_bools):
+    return list(
+        itertools.chain.from_iterable(BYTE_TO_BOOLS[value] for value in data_bytes)
+    )[:number_of_bools]
+
+
+class ModbusError(Exception):
+    """Raised while processing a request, is answered with the Modbus exception_code"""
+
+    def __init__(self, exception_code, message=""):
+        super().__init__(message)
+        self.exception_code = exception_code
+
+
+class DatastoreUnavailableError(ModbusError):
+    """Raised by datastores whose backend (e.g. redis) can't be reached right now
+
+    The request is answered with exception 04 (Server Device Failure) and the connection
+    stays open, later requests are tried again.
+    """
+
+    def __init__(self, message=""):
+        super().__init__(4, message)
+
+
+def read_from_datastore(datastore, object_reference, first_address, number_of_records):
+    """Read a range from the datastore in wire format (register bytes or packed bits)"""
+    if hasattr(datastore, "read_bytes"):
+        # Datastore delivers the data already in wire format:
+        return datastore.read_bytes(object_reference, first_address, number_of_records)
+
+    data = datastore.read(object_reference, first_address, number_of_records)
+    if object_reference in ("coils", "discrete_inputs"):
+        return pack_bools_to_bytes(data)
+    return b"".join(data)
+
+
+def write_bits_to_datastore(datastore, object_reference, first_address, values):
+    """Write a list of bools with the batched write_bits(), or with write() per address"""
+    if hasattr(datastore, "write_bits"):
+        datastore.write_bits(object_reference, first_address, values)
+        return
+    # Datastores with only the basic interface (read, write, dump):
+    for address, value in enumerate(values, first_address):
+        datastore.write(object_reference, address, value, None)
+
+
+def write_registers_to_datastore(datastore, object_reference, first_address, values):
+    """Write register bytes with the batched write_registers(), or with write() per register"""
+    if hasattr(datastore, "write_registers"):
+        datastore.write_registers(object_reference, first_address, values)
+        return
+    for i in range(0, len(values), 2):
+        value = values[i] << 8 | values[i + 1]
+        datastore.write(object_reference, first_address + i // 2, value, "H")
+
+
+def process_write_request(function_code, pdu, datastore):
+    """Execute a write request and return the response data following the function code"""
+
+    ## Write Single Coil (5), Write Single Register (6), Mask Write Register (22):
+    ## ===========================================================================
+    # Request: Address (2 Bytes), Value or AND-Mask (2 Bytes), [OR-Mask (2 Bytes)]
+    # The response echoes the request
+
+    if function_code in (5, 6, 22):
+        if len(pdu) != (7 if function_code == 22 else 5):
+            raise ModbusError(3, "Invalid request length")
+        address, value = ADDRESS_AND_COUNT.unpack_from(pdu, 1)
+
+        if function_code == 5:
+            if value not in (0xFF00, 0x0000):
+                raise ModbusError(3, f"Invalid coil value {value:#06x}")
+            write_bits_to_datastore(datastore, "coils", address, [value == 0xFF00])
+
+        elif function_code == 6:
+            write_registers_to_datastore(
+                datastore, "holding_registers", address, pdu[3:5]
+            )
+
+        elif function_code == 22:
+            and_mask, or_mask = ADDRESS_AND_COUNT.unpack_from(pdu, 3)
+            # No other write may land between the read and the write of the register:
+            batch = getattr(datastore, "batch", None)
+            with batch() if batch is not None else contextlib.nullcontext():
+                current_bytes = read_from_datastore(
+                    datastore, "holding_registers", address, 1
+                )
+                current_value = int.from_bytes(current_bytes, "big")
+                value = (current_value & and_mask) | (or_mask & ~and_mask & 0xFFFF)
+                write_registers_to_datastore(
+                    datastore, "holding_registers", address, value.to_bytes(2, "big")
+                )
+
+        return pdu[1:]
+
+    ## Write Multiple Coils (15), Write Multiple Registers (16):
+    ## =========================================================
+    # Request: Address (2 Bytes), Quantity (2 Bytes), Byte Count (1 Byte), Values
+    # The response contains Address and Quantity
+
+    if function_code in (15, 16):
+        if len(pdu) < 6:
+            raise ModbusError(3, "Invalid request length")
+        first_address, quantity = ADDRESS_AND_COUNT.unpack_from(pdu, 1)
+        byte_count = pdu[5]
+        values = pdu[6:]
+
+        if function_code == 15:
+            if quantity < 1 or quantity > 1968 or byte_count != (quantity + 7) // 8:
+                raise ModbusError(3, f"Invalid quantity {quantity}")
+        else:
+            if quantity < 1 or quantity > 123 or byte_count != 2 * quantity:
+                raise ModbusError(3, f"Invalid quantity {quantity}")
+        if len(values) != byte_count:
+            raise ModbusError(3, "Byte count does not match the request length")
+        if first_address + quantity > 65536:
+            raise ModbusError(2, "Address range exceeds 65535")
+
+        if function_code == 15:
+            bools = unpack_bytes_to_bools(values, quantity)
+            write_bits_to_datastore(datastore, "coils", first_address, bools)
+        else:
+            write_registers_to_datastore(
+                datastore, "holding_registers", first_address, values
+            )
+
+        return pdu[1:5]
+
+    ## Read/Write Multiple Registers (23):
+    ## ===================================
+    # Request: Read Address, Read Quantity, Write Address, Write Quantity (2 Bytes each),
+    #          Byte Count (1 Byte), Values
+    # The write is executed before the read, the response contains the read registers
+
+    if function_code == 23:
+        if len(pdu) < 10:
+            raise ModbusError(3, "Invalid request length")
+        (
+            read_address,
+            read_quantity,
+            write_address,
+            write_quantity,
+            byte_count,
+        ) = READ_WRITE_REQUEST.unpack_from(pdu, 1)
+        values = pdu[10:]
+
+        if read_quantity < 1 or read_quantity > 125:
+            raise ModbusError(3, f"Invalid read quantity {read_quantity}")
+        if write_quantity < 1 or write_quantity > 121:
+            raise ModbusError(3, f"Invalid write quantity {write_quantity}")
+        if byte_count != 2 * write_quantity or len(values) != byte_count:
+            raise ModbusError(3, "Byte count does not match the request length")
+        if (
+            read_address + read_quantity > 65536
+            or write_address + write_quantity > 65536
+        ):
+            raise ModbusError(2, "Address range exceeds 65535")
+
+        write_registers_to_datastore(
+            datastore, "holding_registers", write_address, values
+        )
+        data_bytes = read_from_datastore(
+            datastore, "holding_registers", read_address, read_quantity
+        )
+        return bytes([len(data_bytes)]) + data_bytes
+
+    raise ModbusError(1, f"Function code {function_code} is not a write function code")
+
+
+def process_pdu(
+    pdu, transaction_id, unit_id, addr, units, response_buffer, device_information=None
+):
+    """Process one request PDU and append the response (if any) to response_buffer
+
+    Independent of the transport: the framing of the response is up to the response
+    buffer (MBAP for Modbus/TCP, unit ID and CRC for RTU), transaction_id is only echoed
+    by transports that have one. units is a list of 256 datastores, indexed by unit ID
+    (None for unit IDs that are not served). device_information (a DeviceInformation)
+    answers Diagnostics (8) and Read Device Identification (43), otherwise they are illegal.
+
+    Returns the exception code of an exception response, otherwise None.
+    """
+    function_code = pdu[0]
+
+    # Route to the datastore of the unit:
+    datastore = units[unit_id]
+    if datastore is None:
+        # Respond with exception 0A - Gateway Path Unavailable:
+        logger.warning(
+            f"Request from {addr[0]} for unit {unit_id} -> Modbus Error 10: Gateway Path Unavailable"
+        )
+        response_buffer.append_error(transaction_id, unit_id, function_code, 10)
+        return 10
+
+    ## Diagnostics (8), Read Device Identification (43):
+    ## ================================================
+
+    if function_code in (8, 43) and device_information is not None:
+        try:
+            pdu_data = device_information.process_request(pdu)
+        except ModbusError as e:
+            logger.warning(
+                f"Request from {addr[0]} with function code {function_code} -> Modbus Error {e.exception_code}: {e}"
+            )
+            response_buffer.append_error(
+                transaction_id, unit_id, function_code, e.exception_code
+            )
+            return e.exception_code
+        response_buffer.append_pdu(transaction_id, unit_id, function_code, pdu_data)
+        return
+
+    ## Write Function Codes:
+    ## =====================
+
+    if function_code in (5, 6, 15, 16, 22, 23):
+        try:
+            pdu_data = process_write_request(function_code, pdu, datastore)
+        except ModbusError as e:
+            logger.warning(
+                f"Request from {addr[0]} with function code {function_code} -> Modbus Error {e.exception_code}: {e}"
+            )
+            response_buffer.append_error(
+                transaction_id, unit_id, function_code, e.exception_code
+            )
+            return e.exception_code
+        except KeyError:
+            # Address not in datastore -> Respond with exception 02 - Illegal Data Address:
+            logger.warning(
+                f"Request from {addr[0]} with function code {function_code} -> Modbus Error 2: Illegal Data Address"
+            )
+            response_buffer.append_error(transaction_id, unit_id, function_code, 2)
+            return 2
+        response_buffer.append_pdu(transaction_id, unit_id, function_code, pdu_data)
+        return
+
+    # Check if Function Code is valid:
+    if function_code not in (1, 2, 3, 4):
+        # Respond with exception 01 - Illegal Function:
+        response_buffer.append_error(transaction_id, unit_id, function_code, 1)
+        return 1
+
+    if function_code in (1, 2, 3, 4):  # -> The 4 'Read' Function Codes
+        if len(pdu) != 5:
+            response_buffer.append_error(transaction_id, unit_id, function_code, 3)
+            return 3
+        first_address, number_of_registers = ADDRESS_AND_COUNT.unpack_from(pdu, 1)
+
+    object_reference = FUNCTION_CODE_MAP[function_code]
+
+    ## Validate number of objects requested and respond with exception 3 if invalid:
+    ## =============================================================================
+
+    if object_reference in ("coils", "discrete_inputs"):
+        if number_of_registers < 1 or number_of_registers > 2000:
+            response_buffer.append_error(transaction_id, unit_id, function_code, 3)
+            return 3
+
+    if object_reference in ("input_registers", "holding_registers"):
+        if number_of_registers < 1 or number_of_registers > 125:
+            response_buffer.append_error(transaction_id, unit_id, function_code, 3)
+            return 3
+
+    ## Validate the requested range against the address space of the datastore:
+    ## ==========================================================================
+
+    address_space = getattr(datastore, "address_space", None)
+    if address_space is not None and not address_space.is_mapped(
+        object_reference, first_address, number_of_registers
+    ):
+        # Address not in datastore -> Respond with exception 02 - Illegal Data Address:
+        logger.warning(
+            f"Request from {addr[0]} for {object_reference}:{first_address} -> Modbus Error 2: Illegal Data Address"
+        )
+        response_buffer.append_error(transaction_id, unit_id, function_code, 2)
+        return 2
+
+    ## Read addresses from datastore
+    ## =============================
+
+    try:
+        data_bytes = read_from_datastore(
+            datastore, object_reference, first_address, number_of_registers
+        )
+    except KeyError:
+        # Address not in datastore -> Respond with exception 02 - Illegal Data Address:
+        logger.warning(
+            f"Request from {addr[0]} for {object_reference}:{first_address} -> Modbus Error 2: Illegal Data Address"
+        )
+        response_buffer.append_error(transaction_id, unit_id, function_code, 2)
+        return 2
+    except ModbusError as e:
+        # e.g. DatastoreUnavailableError -> Respond with its exception code:
+        logger.warning(
+            f"Request from {addr[0]} for {object_reference}:{first_address} -> Modbus Error {e.exception_code}: {e}"
+        )
+        response_buffer.append_error(
+            transaction_id, unit_id, function_code, e.exception_code
+        )
+        return e.exception_code
+    except Exception as e:
+        # Other Error -> Respond with exception 04 - Slave Device Failure:
+        logger.error(
+            f"Request from {addr[0]} for {object_reference}:{first_address} -> Modbus Error 4: Slave Device Failure"
+        )
+        # This is probably a bug in datastore.read(), so raise:
+        raise
+
+    ## Compose response
+    ## ================
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            f"Request from {addr[0]} for {object_reference}:{first_address}+{number_of_registers} -> Response {bytes(data_bytes)}"
+        )
+
+    response_buffer.append_response(transaction_id, unit_id, function_code, data_bytes)
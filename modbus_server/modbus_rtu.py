@@ -0,0 +1,236 @@
+"""Modbus RTU framing, used for RTU-over-TCP and serial lines
+
+RTU frames are Unit ID + PDU + CRC16 (little endian), without a length field. The end
+of a request is derived from its function code, on serial lines a silent interval of
+3.5 characters also ends every frame. The requests are processed by the same
+process_pdu() as Modbus/TCP requests.
+"""
+
+import time
+import struct
+import logging
+
+from .modbus_pdu import process_pdu
+from .modbus_metrics import InstrumentedDatastore
+from .modbus_changes import NotifyingDatastore
+
+logger = logging.getLogger("modbus_server_logger")
+
+
+def _crc16_table():
+    # CRC of every byte value for the reflected polynomial 0xA001 (CRC-16/MODBUS):
+    table = []
+    for value in range(256):
+        crc = value
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data):
+    """CRC-16/MODBUS of data, one table lookup per byte
+
+    The CRC of a frame that includes its own (little endian) CRC is 0.
+    """
+    crc = 0xFFFF
+    table = CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+# Total length of requests (Unit ID + PDU + CRC) with a fixed length, by function code:
+FIXED_REQUEST_LENGTHS = {
+    1: 8,
+    2: 8,
+    3: 8,
+    4: 8,
+    5: 8,
+    6: 8,
+    7: 4,
+    8: 8,
+    11: 4,
+    12: 4,
+    17: 4,
+    22: 10,
+    24: 6,
+    43: 7,
+}
+
+# Requests with a byte count, by function code: offset of the byte count, length without the counted bytes
+BYTE_COUNT_REQUESTS = {
+    15: (6, 9),
+    16: (6, 9),
+    20: (2, 5),
+    21: (2, 5),
+    23: (10, 13),
+}
+
+# Broadcasts (unit ID 0) can only write, there is no response to read from:
+BROADCAST_FUNCTION_CODES = (5, 6, 15, 16, 22)
+
+RESPONSE_HEADER = struct.Struct("!BBB")
+PDU_HEADER = struct.Struct("!BB")
+
+
+def inter_frame_gap(baudrate):
+    """Silent interval of 3.5 characters (of 11 bits) that separates RTU frames, in seconds"""
+    # Above 19200 baud, the serial line specification recommends a fixed 1.75 ms:
+    if baudrate > 19200:
+        return 0.00175
+    return 3.5 * 11 / baudrate
+
+
+class RTUFramer:
+    """Splits an RTU byte stream into complete requests with a valid CRC
+
+    With inter_frame_gap (in seconds), an incomplete frame is discarded when the next
+    bytes arrive after a silent interval, so the framer resynchronizes after noise.
+    """
+
+    def __init__(self, inter_frame_gap=None):
+        self.buffer = bytearray()
+        self.inter_frame_gap = inter_frame_gap
+        self.last_receive_time = None
+        self.crc_errors = 0
+
+    def feed(self, data, timestamp=None):
+        """Append received bytes to the buffer and return a list of all complete frames"""
+        buffer = self.buffer
+        if self.inter_frame_gap is not None:
+            if timestamp is None:
+                timestamp = time.monotonic()
+            if buffer and timestamp - self.last_receive_time > self.inter_frame_gap:
+                logger.warning(f"Discarding incomplete RTU frame {bytes(buffer)}")
+                buffer.clear()
+            self.last_receive_time = timestamp
+
+        buffer += data
+        frames = []
+        offset = 0
+        # 4 bytes = Unit ID, Function Code, CRC
+        while len(buffer) - offset >= 4:
+            length = self._frame_length(buffer, offset)
+            if length is None:
+                break
+            end = offset + length
+            if end > len(buffer):
+                break
+            frame = bytes(buffer[offset:end])
+            if crc16(frame) != 0:
+                # Without a length field, the stream can't be resynchronized from here:
+                self.crc_errors += 1
+                logger.warning(f"Discarding RTU frame with invalid CRC {frame}")
+                offset = len(buffer)
+                break
+            frames.append(frame)
+            offset = end
+        del buffer[:offset]
+        return frames
+
+    @staticmethod
+    def _frame_length(buffer, offset):
+        function_code = buffer[offset + 1]
+        length = FIXED_REQUEST_LENGTHS.get(function_code)
+        if length is not None:
+            return length
+        if function_code in BYTE_COUNT_REQUESTS:
+            byte_count_offset, length = BYTE_COUNT_REQUESTS[function_code]
+            if len(buffer) - offset <= byte_count_offset:
+                return None  # Byte count not received yet
+            return length + buffer[offset + byte_count_offset]
+        # Unknown function code, the frame is everything received so far:
+        return len(buffer) - offset
+
+
+class RTUResponseBuffer:
+    """Reusable send buffer for RTU responses, with the same interface as ResponseBuffer"""
+
+    def __init__(self, size=512):
+        self.buffer = bytearray(size)
+        self.length = 0
+
+    def _reserve(self, number_of_bytes):
+        start = self.length
+        self.length += number_of_bytes
+        if self.length > len(self.buffer):
+            self.buffer.extend(bytes(max(self.length, len(self.buffer))))
+        return start
+
+    def _append_crc(self, start):
+        with memoryview(self.buffer) as view:
+            crc = crc16(view[start : self.length])
+        crc_start = self._reserve(2)
+        self.buffer[crc_start] = crc & 0xFF
+        self.buffer[crc_start + 1] = crc >> 8
+
+    def append_response(self, transaction_id, unit_id, function_code, data_bytes):
+        # RTU has no transaction ID, it is ignored:
+        number_of_data_bytes = len(data_bytes)
+        start = self._reserve(3 + number_of_data_bytes)
+        RESPONSE_HEADER.pack_into(
+            self.buffer, start, unit_id, function_code, number_of_data_bytes
+        )
+        self.buffer[start + 3 : self.length] = data_bytes
+        self._append_crc(start)
+
+    def append_error(self, transaction_id, unit_id, function_code, exception_code):
+        start = self._reserve(3)
+        RESPONSE_HEADER.pack_into(
+            self.buffer, start, unit_id, function_code + 128, exception_code
+        )
+        self._append_crc(start)
+
+    def append_pdu(self, transaction_id, unit_id, function_code, pdu_data):
+        start = self._reserve(2 + len(pdu_data))
+        PDU_HEADER.pack_into(self.buffer, start, unit_id, function_code)
+        self.buffer[start + 2 : self.length] = pdu_data
+        self._append_crc(start)
+
+    def getvalue(self):
+        return bytes(self.buffer[: self.length])
+
+    def sendall(self, s):
+        with memoryview(self.buffer) as view:
+            s.sendall(view[: self.length])
+        self.length = 0
+
+
+def broadcast_unit_ids(units):
+    """The first unit ID that serves each distinct datastore of units"""
+    unit_ids = {}
+    for unit_id, datastore in enumerate(units):
+        # The Server wraps the datastore of every unit for metrics and change notifications:
+        while isinstance(datastore, (InstrumentedDatastore, NotifyingDatastore)):
+            datastore = datastore.datastore
+        if datastore is not None:
+            unit_ids.setdefault(id(datastore), unit_id)
+    return list(unit_ids.values())
+
+
+def process_rtu_request(frame, addr, units, response_buffer, device_information=None):
+    """Process one RTU request frame (with valid CRC), see process_pdu()"""
+    unit_id = frame[0]
+    if unit_id != 0:
+        return process_pdu(
+            frame[1:-2], 0, unit_id, addr, units, response_buffer, device_information
+        )
+
+    # Broadcast: written to every served datastore once, but never answered
+    pdu = frame[1:-2]
+    if pdu[0] not in BROADCAST_FUNCTION_CODES:
+        logger.warning(f"Ignoring broadcast with function code {pdu[0]} from {addr[0]}")
+        return
+    response_start = response_buffer.length
+    exception_code = None
+    for broadcast_unit_id in broadcast_unit_ids(units):
+        unit_exception_code = process_pdu(
+            pdu, 0, broadcast_unit_id, addr, units, response_buffer, device_information
+        )
+        exception_code = exception_code or unit_exception_code
+        response_buffer.length = response_start
+    return exception_code
@@ -1,172 +1,465 @@
+import os
+import time
 import socket
 import struct
+import signal
+import warnings
+import selectors
 import threading
 import logging
 
 from . import modbus_datastore
+from . import modbus_changes
+from . import modbus_device
+from .modbus_codec import get_codec
+from . import modbus_metrics
+from . import modbus_rtu
+from .modbus_pdu import process_pdu
 
-# Constants:
-
-FUNCTION_CODE_MAP = {
-    1: "coils",
-    2: "discrete_inputs",
-    4: "input_registers",
-    3: "holding_registers",
-}
+# Lived in this module before modbus_pdu, still imported from here:
+from .modbus_pdu import FUNCTION_CODE_MAP, pack_bools_to_bytes
 
+try:
+    import tty
+    import termios
+except ImportError:
+    logging.info("Could not import termios, SerialServer is not available")
 
 logger = logging.getLogger("modbus_server_logger")
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(levelname)-10s: %(message)s")
-streamhandler = logging.StreamHandler()
-streamhandler.setLevel(logging.DEBUG)
-streamhandler.setFormatter(formatter)
-logger.addHandler(streamhandler)
-logger.propagate = False  # prevent double logging
+streamhandler = (
+    None  # Installed by the first Server, importing the package configures nothing
+)
 
 
-def pack_bools_to_bytes(bool_list):
-    chars = []
-    for j in range(0, len(bool_list), 8):
-        bool_chunk = bool_list[j : j + 8]
-        equivalent_char = 0
-        for i, b in enumerate(bool_chunk):
-            if b:
-                equivalent_char += 2 ** i
-        chars.append(equivalent_char)
+def setup_logging(loglevel):
+    """Log to stderr at loglevel, with one handler shared by all Servers"""
+    global streamhandler
+    if streamhandler is None:
+        streamhandler = logging.StreamHandler()
+        streamhandler.setFormatter(logging.Formatter("%(levelname)-10s: %(message)s"))
+        logger.addHandler(streamhandler)
+        logger.propagate = False  # prevent double logging
+    streamhandler.setLevel(loglevel)
+    # Also set the level of the logger, so that disabled debug messages cost nothing:
+    logger.setLevel(loglevel)
 
-    return struct.pack(f"!{len(chars)}B", *chars)
 
+# Precompiled structs for the MBAP header:
+# Request:  Transaction ID, Protocol, Length, Unit ID, Function Code
+# Response: Transaction ID, Protocol, Length, Unit ID, Function Code, Byte Count or Exception Code
+REQUEST_HEADER = struct.Struct("!HHHBB")
+RESPONSE_HEADER = struct.Struct("!HHHBBB")
+PDU_HEADER = struct.Struct("!HHHBB")
 
-def build_error_response(header_items, exception_code):
-    response_items = list(header_items)
+# In asyncio mode, threads for the requests of a datastore with blocking I/O, unless it
+# has a connection pool of max_connections:
+BLOCKING_IO_THREADS = 10
 
-    # Error Response Function Code -> Function Code + 128
-    response_items[4] = header_items[4] + 128
 
-    # In an error message, the data contains the Exception Code
-    response_items.append(exception_code)
+class ResponseBuffer:
+    """Reusable per-connection send buffer, responses are packed into it in place"""
 
-    return struct.pack(f"!HHHBBB", *response_items)
+    def __init__(self, size=4096):
+        self.buffer = bytearray(size)
+        self.length = 0
 
+    def _reserve(self, number_of_bytes):
+        start = self.length
+        self.length += number_of_bytes
+        if self.length > len(self.buffer):
+            self.buffer.extend(bytes(max(self.length, len(self.buffer))))
+        return start
 
-def handle_requests(s, addr, datastore):
+    def append_response(self, transaction_id, unit_id, function_code, data_bytes):
+        # Response length is 3 fixed bytes (unit_id, function_code, number_of_data_bytes) plus the data bytes:
+        number_of_data_bytes = len(data_bytes)
+        start = self._reserve(9 + number_of_data_bytes)
+        RESPONSE_HEADER.pack_into(
+            self.buffer,
+            start,
+            transaction_id,
+            0,
+            3 + number_of_data_bytes,
+            unit_id,
+            function_code,
+            number_of_data_bytes,
+        )
+        self.buffer[start + 9 : self.length] = data_bytes
 
-    while True:
+    def append_error(self, transaction_id, unit_id, function_code, exception_code):
+        # Error Response Function Code -> Function Code + 128, the data contains the Exception Code
+        start = self._reserve(9)
+        RESPONSE_HEADER.pack_into(
+            self.buffer,
+            start,
+            transaction_id,
+            0,
+            3,
+            unit_id,
+            function_code + 128,
+            exception_code,
+        )
 
-        # Recv max 255 bytes, the maximal length for a Modbus frame:
-        data = s.recv(256)
-        if not data:
-            break
-        if len(data) < 12:
-            logger.error(
-                f'Received less than 12 bytes, Header: {struct.unpack("!HHHBB", data[:8])}'
-            )
-            s.close()
-            break
-
-        ## Extract Header + Function Code:
-        # Transaction ID:   (2 Bytes)   Identifies the request-response-pair, is echoed in the response
-        # Protocol:         (2 Bytes)   Always 0 ("reserved for future use", lol)
-        # Length:           (2 Bytes)   Length of the remaining frame in bytes (Total Length - 6)
-        # Unit ID:          (1 Byte)    "Slave ID", inner identifier to route to different units (typically 0)
-        # Function Code:    (1 Byte)    1,2,3,4,5,6,15,16,43: Read/Write input/register etc.
-        try:
-            (
-                transaction_id,
-                protocol,
-                length,
-                unit_id,
-                function_code,
-            ) = struct.unpack("!HHHBB", data[:8])
-        except struct.error:
-            logger.error(f"Received incompatible header bytes {data}")
-            continue
-
-        # Pack header items into a tuple which can more easily be passed around:
-        header_items = (transaction_id, protocol, length, unit_id, function_code)
-
-        # Check if Function Code is valid:
-        if function_code not in (1, 2, 3, 4):
-            # Respond with exception 01 - Illegal Function:
-            response = build_error_response(header_items, exception_code=1)
-            s.sendall(response)
-            continue
-
-        if function_code in (1, 2, 3, 4):  # -> The 4 'Read' Function Codes
-            first_address = struct.unpack("!H", data[8:10])[0]
-            number_of_registers = struct.unpack("!H", data[10:12])[0]
-
-        object_reference = FUNCTION_CODE_MAP[function_code]
-
-        ## Validate number of objects requested and respond with exception 3 if invalid:
-        ## =============================================================================
+    def append_pdu(self, transaction_id, unit_id, function_code, pdu_data):
+        # pdu_data is everything that follows the function code:
+        start = self._reserve(8 + len(pdu_data))
+        PDU_HEADER.pack_into(
+            self.buffer,
+            start,
+            transaction_id,
+            0,
+            2 + len(pdu_data),
+            unit_id,
+            function_code,
+        )
+        self.buffer[start + 8 : self.length] = pdu_data
 
-        if object_reference in ("coils", "discrete_inputs"):
-            if number_of_registers < 1 or number_of_registers > 2000:
-                response = build_error_response(header_items, exception_code=3)
-                s.sendall(response)
-                continue
+    def getvalue(self):
+        return bytes(self.buffer[: self.length])
 
-        if object_reference in ("input_registers", "holding_registers"):
-            if number_of_registers < 1 or number_of_registers > 125:
-                s.sendall(build_error_response(header_items, exception_code=3))
-                continue
+    def sendall(self, s):
+        with memoryview(self.buffer) as view:
+            s.sendall(view[: self.length])
+        self.length = 0
 
-        ## Read addresses from datastore
-        ## =============================
 
-        try:
-            data = datastore.read(object_reference, first_address, number_of_registers)
-        except KeyError:
-            # Address not in datastore -> Respond with exception 02 - Illegal Data Address:
-            logger.warning(
-                f"Request from {addr[0]} for {object_reference}:{first_address} -> Modbus Error 2: Illegal Data Address"
-            )
-            response = build_error_response(header_items, exception_code=2)
-            s.sendall(response)
-            continue
-        except Exception as e:
-            # Other Error -> Respond with exception 04 - Slave Device Failure:
-            logger.error(
-                f"Request from {addr[0]} for {object_reference}:{first_address} -> Modbus Error 4: Slave Device Failure"
-            )
-            # This is probably a bug in datastore.read(), so raise:
-            raise
-            response = build_error_response(header_items, exception_code=4)
-            s.sendall(response)
-            continue
+class MBAPFramer:
+    """Splits a Modbus/TCP byte stream into complete ADUs using the Length field of the MBAP header"""
 
-        ## Compose response
-        ## ================
+    def __init__(self):
+        self.buffer = bytearray()
 
-        if object_reference in ("coils", "discrete_inputs"):
-            data_bytes = pack_bools_to_bytes(data)
+    def feed(self, data):
+        """Append received bytes to the buffer and return a list of all complete frames"""
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        offset = 0
+        # 7 bytes = MBAP header (Transaction ID, Protocol, Length, Unit ID)
+        while len(buffer) - offset >= 7:
+            length = (buffer[offset + 4] << 8) | buffer[offset + 5]
+            # Length counts Unit ID + PDU, the PDU has at most 253 bytes:
+            if length < 2 or length > 254:
+                raise ValueError(f"Invalid MBAP length field {length}")
+            end = offset + 6 + length
+            if end > len(buffer):
+                break
+            frames.append(bytes(buffer[offset:end]))
+            offset = end
+        del buffer[:offset]
+        return frames
 
-        if object_reference in ("input_registers", "holding_registers"):
-            data_bytes = b"".join(data)
 
-        # Response length is 3 fixed bytes (unit_id, function_code, number_of_data_bytes) plus the data bytes:
-        response_message_length = 3 + len(data_bytes)
-        number_of_data_bytes = len(data_bytes)
+def process_request(data, addr, units, response_buffer, device_information=None):
+    """Process one Modbus/TCP request ADU, see process_pdu()"""
 
-        # Compose response header:
-        response_header_items = [
+    ## Extract Header + Function Code:
+    # Transaction ID:   (2 Bytes)   Identifies the request-response-pair, is echoed in the response
+    # Protocol:         (2 Bytes)   Always 0 ("reserved for future use", lol)
+    # Length:           (2 Bytes)   Length of the remaining frame in bytes (Total Length - 6)
+    # Unit ID:          (1 Byte)    "Slave ID", inner identifier to route to different units (typically 0)
+    # Function Code:    (1 Byte)    1,2,3,4,5,6,15,16,43: Read/Write input/register etc.
+    try:
+        (
             transaction_id,
             protocol,
-            response_message_length,
+            length,
             unit_id,
             function_code,
-            number_of_data_bytes,
-        ]
+        ) = REQUEST_HEADER.unpack_from(data)
+    except struct.error:
+        logger.error(f"Received incompatible header bytes {data}")
+        return
+
+    if protocol != 0:
+        logger.error(f"Received frame with unknown protocol identifier {protocol}")
+        return
+
+    return process_pdu(
+        data[7:],
+        transaction_id,
+        unit_id,
+        addr,
+        units,
+        response_buffer,
+        device_information,
+    )
+
+
+def process_request_with_metrics(
+    data,
+    addr,
+    units,
+    response_buffer,
+    metrics,
+    process=process_request,
+    pdu_offset=7,
+    device_information=None,
+):
+    """process_request() (or process for other framings), recording the request and its outcome in metrics"""
+    start = time.perf_counter()
+    exception_code = process(data, addr, units, response_buffer, device_information)
+    duration = time.perf_counter() - start
+    metrics.record_request(
+        data[pdu_offset], data[pdu_offset - 1], addr[0], duration, exception_code
+    )
+
+
+class RateLimiter:
+    """Token bucket per client: rate requests per second, in bursts of up to burst requests"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.buckets = {}  # client -> (tokens, time of the last update)
+        self.lock = threading.Lock()
+
+    def allow(self, client):
+        now = time.monotonic()
+        with self.lock:
+            tokens, last_update = self.buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last_update) * self.rate)
+            if tokens < 1:
+                self.buckets[client] = (tokens, now)
+                return False
+            self.buckets[client] = (tokens - 1, now)
+            if len(self.buckets) > 4096:
+                self._prune(now)
+            return True
 
-        logger.debug(
-            f"Request from {addr[0]} for {object_reference}:{first_address}+{number_of_registers} -> Response {data_bytes}"
+    def _prune(self, now):
+        # Clients whose bucket is full again don't need an entry:
+        refill_time = self.burst / self.rate
+        self.buckets = {
+            client: bucket
+            for client, bucket in self.buckets.items()
+            if now - bucket[1] < refill_time
+        }
+
+
+def append_busy_error(frame, addr, response_buffer, metrics, pdu_offset):
+    """Answer a request with exception 06 (Server Device Busy), without processing it"""
+    unit_id = frame[pdu_offset - 1]
+    function_code = frame[pdu_offset]
+    if pdu_offset == 1 and unit_id == 0:
+        return  # RTU broadcasts are never answered
+    transaction_id = (frame[0] << 8 | frame[1]) if pdu_offset == 7 else 0
+    response_buffer.append_error(transaction_id, unit_id, function_code, 6)
+    if metrics is not None:
+        metrics.record_request(function_code, unit_id, addr[0], 0.0, 6)
+
+
+def process_frames(
+    frames,
+    addr,
+    units,
+    response_buffer,
+    metrics,
+    process,
+    pdu_offset,
+    rate_limiter,
+    device_information=None,
+):
+    for frame in frames:
+        if rate_limiter is not None and not rate_limiter.allow(addr[0]):
+            append_busy_error(frame, addr, response_buffer, metrics, pdu_offset)
+        elif metrics is None:
+            process(frame, addr, units, response_buffer, device_information)
+        else:
+            process_request_with_metrics(
+                frame,
+                addr,
+                units,
+                response_buffer,
+                metrics,
+                process,
+                pdu_offset,
+                device_information,
+            )
+
+
+def create_framing(framing):
+    """Framer, response buffer, request processing function and PDU offset for a framing"""
+    if framing == "rtu":
+        return (
+            modbus_rtu.RTUFramer(),
+            modbus_rtu.RTUResponseBuffer(),
+            modbus_rtu.process_rtu_request,
+            1,
         )
+    return MBAPFramer(), ResponseBuffer(), process_request, 7
+
+
+def connection_timeout(framer, idle_timeout, read_timeout):
+    # Waiting for the rest of a frame is limited by read_timeout, waiting for a new frame by idle_timeout:
+    if framer.buffer and read_timeout is not None:
+        return read_timeout
+    return idle_timeout
+
+
+def handle_requests(
+    s,
+    addr,
+    units,
+    metrics=None,
+    framing="mbap",
+    idle_timeout=None,
+    read_timeout=None,
+    rate_limiter=None,
+    device_information=None,
+):
+    framer, response_buffer, process, pdu_offset = create_framing(framing)
+    current_timeout = None
 
-        # Pack response items into binary format and append data_bytes:
-        response = struct.pack(f"!HHHBBB", *response_header_items) + data_bytes
-        s.sendall(response)
+    try:
+        while True:
+
+            timeout = connection_timeout(framer, idle_timeout, read_timeout)
+            if timeout != current_timeout:
+                s.settimeout(timeout)
+                current_timeout = timeout
+
+            # A recv can contain several pipelined frames, or only a part of a frame:
+            try:
+                data = s.recv(4096)
+            except socket.timeout:
+                logger.info(
+                    f"Closing connection to {addr[0]} after {timeout} s timeout"
+                )
+                break
+            if not data:
+                break
+            try:
+                frames = framer.feed(data)
+            except ValueError as e:
+                logger.error(f"Closing connection to {addr[0]}: {e}")
+                break
+
+            # Answer all complete frames in order, with one sendall:
+            process_frames(
+                frames,
+                addr,
+                units,
+                response_buffer,
+                metrics,
+                process,
+                pdu_offset,
+                rate_limiter,
+                device_information,
+            )
+            if response_buffer.length:
+                response_buffer.sendall(s)
+    except OSError:
+        pass  # Connection reset, or closed by the server (e.g. evicted)
+    finally:
+        s.close()
+
+
+def group_frames_by_executor(frames, pdu_offset, executor_for):
+    """Split frames into runs of consecutive frames with the same executor_for(unit_id)"""
+    if executor_for is None:
+        return [(None, frames)]
+    groups = []
+    for frame in frames:
+        executor = executor_for(frame[pdu_offset - 1])
+        if groups and groups[-1][0] is executor:
+            groups[-1][1].append(frame)
+        else:
+            groups.append((executor, [frame]))
+    return groups
+
+
+async def handle_requests_async(
+    reader,
+    writer,
+    units,
+    metrics=None,
+    framing="mbap",
+    idle_timeout=None,
+    read_timeout=None,
+    rate_limiter=None,
+    device_information=None,
+    executor_for=None,
+):
+    """Serve one connection in the event loop
+
+    executor_for(unit_id) returns the executor for requests to a datastore with blocking
+    I/O (e.g. redis), or None for requests that are processed in the event loop. So a slow
+    datastore only delays the requests for its own units.
+    """
+    import asyncio
+
+    addr = writer.get_extra_info("peername")
+    framer, response_buffer, process, pdu_offset = create_framing(framing)
+    loop = asyncio.get_running_loop()
+
+    try:
+        while True:
+
+            # A read can contain several pipelined frames, or only a part of a frame:
+            timeout = connection_timeout(framer, idle_timeout, read_timeout)
+            if timeout is None:
+                data = await reader.read(4096)
+            else:
+                try:
+                    data = await asyncio.wait_for(reader.read(4096), timeout)
+                except asyncio.TimeoutError:
+                    logger.info(
+                        f"Closing connection to {addr[0]} after {timeout} s timeout"
+                    )
+                    break
+            if not data:
+                break
+            try:
+                frames = framer.feed(data)
+            except ValueError as e:
+                logger.error(f"Closing connection to {addr[0]}: {e}")
+                break
+
+            # Consecutive frames for the same executor are processed together, in order:
+            for executor, executor_frames in group_frames_by_executor(
+                frames, pdu_offset, executor_for
+            ):
+                arguments = (
+                    executor_frames,
+                    addr,
+                    units,
+                    response_buffer,
+                    metrics,
+                    process,
+                    pdu_offset,
+                    rate_limiter,
+                    device_information,
+                )
+                if executor is None:
+                    process_frames(*arguments)
+                else:
+                    await loop.run_in_executor(executor, process_frames, *arguments)
+            if response_buffer.length:
+                # The transport may keep the data queued, so it gets its own copy:
+                writer.write(response_buffer.getvalue())
+                response_buffer.length = 0
+                await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def datastore_encoding(codec):
+    """The encoding argument for the datastores, the str encoding for the default orders
+
+    So datastores that only know the struct format characters keep working, other word
+    and byte orders need a datastore that accepts a Codec (like the included ones).
+    """
+    if codec.word_order == "big" and codec.byte_order == "big":
+        return codec.encoding
+    return codec
+
+
+def check_unit_id(unit_id):
+    if type(unit_id) is not int or unit_id < 0 or unit_id > 255:
+        raise ValueError(f"'unit_id' must be between 0 and 255, not {unit_id}")
 
 
 class Server:
@@ -177,97 +470,551 @@ class Server:
         datastore=None,
         loglevel="INFO",
         autostart=False,
+        mode="threading",
+        backlog=128,
+        metrics=False,
+        workers=1,
+        units=None,
+        framing="mbap",
+        idle_timeout=None,
+        read_timeout=None,
+        max_connections=None,
+        connection_policy="refuse",
+        max_requests_per_second=None,
+        request_burst=None,
+        change_coalesce_interval=0.0,
+        identification=None,
+        word_order="big",
+        byte_order="big",
     ):
-        streamhandler.setLevel(loglevel)
+        setup_logging(loglevel)
         self.host = host
         self.port = port
-        if datastore is None:
+        if datastore is None and units is None:
             self.datastore = modbus_datastore.DictDatastore()
         else:
             self.datastore = datastore
+
+        # Default order of the set_-functions for encodings given as str:
+        get_codec("H", word_order, byte_order)  # Validates the orders
+        self.word_order = word_order
+        self.byte_order = byte_order
+
+        # Routing table from unit ID to datastore, without units one datastore serves all:
+        self.units = [self.datastore] * 256
+        for unit_id, unit_datastore in (units or {}).items():
+            check_unit_id(unit_id)
+            self.units[unit_id] = unit_datastore
+        if mode not in ("threading", "asyncio"):
+            raise ValueError(f'mode must be "threading" or "asyncio", not {mode}')
+        self.mode = mode
+        if framing not in ("mbap", "rtu"):
+            raise ValueError(f'framing must be "mbap" or "rtu", not {framing}')
+        self.framing = framing
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        if connection_policy not in ("refuse", "evict_oldest"):
+            raise ValueError(
+                f'connection_policy must be "refuse" or "evict_oldest", not {connection_policy}'
+            )
+        self.max_connections = max_connections
+        self.connection_policy = connection_policy
+        self.rate_limiter = None
+        if max_requests_per_second is not None:
+            self.rate_limiter = RateLimiter(max_requests_per_second, request_burst)
+        if workers > 1:
+            if not hasattr(socket, "SO_REUSEPORT"):
+                raise ValueError("workers > 1 requires SO_REUSEPORT (Linux, BSD)")
+            for unit_datastore in self._unit_datastores():
+                if not getattr(unit_datastore, "process_shared", False):
+                    warnings.warn(
+                        f"{type(unit_datastore).__name__} is copied into every worker process, "
+                        "use a RedisDatastore or ArrayDatastore(shared=True) to share data"
+                    )
+        self.workers = workers
+        self._worker_processes = []
+        self.metrics = None
+        self.metrics_server = None
+        if metrics:
+            self.metrics = modbus_metrics.Metrics()
+        # Identification responses are encoded once, diagnostics counters come from the metrics:
+        self.device_information = modbus_device.DeviceInformation(
+            identification, self.metrics
+        )
+        # Created by the first subscribe(), without it the request path is unchanged:
+        self.change_notifier = None
+        self.change_coalesce_interval = change_coalesce_interval
+        # The table that requests are routed with, with instrumented datastores for metrics:
+        self._instrumented_datastores = {}
+        self._serving_units = [
+            self._serving(datastore, unit_id)
+            for unit_id, datastore in enumerate(self.units)
+        ]
+        self.accepted_connections = 0
+        self.refused_connections = 0
+        self.evicted_connections = 0
+        self._connections = (
+            {}
+        )  # Open connections (socket or asyncio task), oldest first
+        self._connections_lock = threading.Lock()
         self.server_thread = None
         self.stop_server = False
+        self._listening_socket = None
+        self._wakeup_sockets = None
+        self._loop = None
+        self._executors = (
+            {}
+        )  # id(datastore) -> executor, for datastores with blocking I/O
+        self._async_stop_event = None
+        self._async_ready = threading.Event()
         if autostart:
             self.start()
 
     def start(self):
-        self.server_thread = threading.Thread(target=self._start_accepting)
-        # self.server_thread.daemon = True
-        self.server_thread.start()
-        logger.info(f"Modbus Server started on port {self.port}")
+        self.stop_server = False
+        if self.change_notifier is not None:
+            self.change_notifier.start()
+        if self.workers > 1:
+            self._start_workers()
+            return
+        self._listening_socket = self._create_listening_socket()
+        if self.mode == "asyncio":
+            self._async_ready.clear()
+            self.server_thread = threading.Thread(target=self._start_accepting_async)
+            self.server_thread.start()
+            self._async_ready.wait(timeout=2)
+        else:
+            self._wakeup_sockets = socket.socketpair()
+            self.server_thread = threading.Thread(target=self._start_accepting)
+            # self.server_thread.daemon = True
+            self.server_thread.start()
+        logger.info(f"Modbus Server started on port {self.port} ({self.mode})")
+
+    def _create_listening_socket(self, reuse_port=False, listen=True):
+        # One listening socket lives as long as the server, so the backlog keeps
+        # queueing connections while others are being accepted:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            s.bind((self.host, self.port))
+            if listen:
+                s.listen(self.backlog)
+            s.setblocking(False)
+        except OSError:
+            s.close()
+            raise
+        # Port 0 binds to a free port chosen by the OS:
+        self.port = s.getsockname()[1]
+        return s
+
+    def _start_workers(self):
+        # The parent only binds (without listening) to reserve the port and resolve port 0,
+        # the kernel distributes new connections among the listening worker sockets:
+        self._listening_socket = self._create_listening_socket(
+            reuse_port=True, listen=False
+        )
+        import multiprocessing
+
+        context = multiprocessing.get_context("fork")
+        ready = context.Semaphore(0)
+        self._worker_processes = [
+            context.Process(target=self._run_worker, args=(ready,), daemon=True)
+            for _ in range(self.workers)
+        ]
+        for process in self._worker_processes:
+            process.start()
+        for _ in self._worker_processes:
+            ready.acquire(timeout=5)
+        logger.info(
+            f"Modbus Server started on port {self.port} ({self.workers} {self.mode} workers)"
+        )
+
+    def _run_worker(self, ready):
+        # Runs in the forked worker process:
+        self._listening_socket.close()
+        self._listening_socket = self._create_listening_socket(reuse_port=True)
+        self._worker_processes = []
+        for unit_datastore in self._unit_datastores():
+            if hasattr(unit_datastore, "after_fork"):
+                unit_datastore.after_fork()
+        self._wakeup_sockets = socket.socketpair()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._wake_up_accepting())
+        ready.release()
+        if self.mode == "asyncio":
+            self._start_accepting_async()
+        else:
+            self._start_accepting()
+
+    def _stop_workers(self):
+        for process in self._worker_processes:
+            process.terminate()
+        for process in self._worker_processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self._worker_processes = []
 
     def _start_accepting(self):
-        while not self.stop_server:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                s.bind((self.host, self.port))
-                s.listen(20)
-                con, addr = s.accept()
-                # logger.debug(f"Connected to {addr[0]} on port {addr[1]}")
-                handling_thread = threading.Thread(
-                    target=handle_requests, args=(con, addr, self.datastore)
-                )
-                handling_thread.daemon = True
-                handling_thread.start()
+        wakeup_receiver = self._wakeup_sockets[0]
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._listening_socket, selectors.EVENT_READ)
+            selector.register(wakeup_receiver, selectors.EVENT_READ)
+            while not self.stop_server:
+                for key, _ in selector.select():
+                    if key.fileobj is wakeup_receiver:
+                        return
+                    self._accept_pending_connections()
 
-    def stop(self):
-        self.stop_server = True
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+    def _accept_pending_connections(self):
+        # Drain the whole backlog on every wakeup to keep up with reconnect storms:
+        while True:
+            try:
+                con, addr = self._listening_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            con.setblocking(True)
+            with self._connections_lock:
+                if not self._make_room_for_connection(addr):
+                    con.close()
+                    continue
+                self._connections[con] = con
+            self.accepted_connections += 1
+            # logger.debug(f"Connected to {addr[0]} on port {addr[1]}")
+            handling_thread = threading.Thread(
+                target=self._handle_connection, args=(con, addr)
+            )
+            handling_thread.daemon = True
+            handling_thread.start()
+
+    def _handle_connection(self, con, addr):
+        try:
+            handle_requests(
+                con,
+                addr,
+                self._serving_units,
+                self.metrics,
+                self.framing,
+                self.idle_timeout,
+                self.read_timeout,
+                self.rate_limiter,
+                self.device_information,
+            )
+        finally:
+            with self._connections_lock:
+                self._connections.pop(con, None)
+
+    def _make_room_for_connection(self, addr):
+        """Apply the connection_policy, returns False if the new connection is refused"""
+        if (
+            self.max_connections is None
+            or len(self._connections) < self.max_connections
+        ):
+            return True
+        if self.connection_policy == "refuse":
+            self.refused_connections += 1
+            logger.warning(
+                f"Refused connection from {addr[0]}, {self.max_connections} connections are open"
+            )
+            return False
+        oldest_key, oldest_connection = next(iter(self._connections.items()))
+        del self._connections[oldest_key]
+        self.evicted_connections += 1
+        logger.warning(f"Closing the oldest connection for a connection from {addr[0]}")
+        if self.mode == "asyncio":
+            oldest_connection.transport.abort()
+        else:
+            # Wakes up the handler thread from its recv(), which then closes the socket:
             try:
-                s.connect((self.host, self.port))
-            except ConnectionRefusedError:
+                oldest_connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
                 pass
+        return True
+
+    @property
+    def open_connections(self):
+        return len(self._connections)
+
+    def _start_accepting_async(self):
+        # All connections are multiplexed in one event loop, running in the server thread.
+        # asyncio is only imported here, it is the largest part of the package import time:
+        import asyncio
+
+        asyncio.run(self._serve_async())
+
+    async def _serve_async(self):
+        import asyncio
+
+        self._loop = asyncio.get_running_loop()
+        self._async_tasks = set()  # Also the handlers of evicted connections
+        self._async_stop_event = asyncio.Event()
+        try:
+            server = await asyncio.start_server(
+                self._handle_connection_async, sock=self._listening_socket
+            )
+        finally:
+            self._async_ready.set()
+        async with server:
+            if not self.stop_server:
+                await self._async_stop_event.wait()
+            # Close open connections, so that their handlers return cleanly:
+            for writer in self._connections.values():
+                writer.close()
+            await asyncio.gather(*self._async_tasks, return_exceptions=True)
+        for executor in self._executors.values():
+            executor.shutdown(wait=False)
+        self._executors = {}
+        self._loop = None
+
+    def _executor_for(self, unit_id):
+        # Requests for datastores with blocking I/O are processed in one executor per
+        # datastore, with a thread per connection of its pool:
+        datastore = self.units[unit_id]
+        if unit_id == 0 and self.framing == "rtu":
+            # RTU broadcasts are written to every datastore:
+            datastore = next(
+                (
+                    unit_datastore
+                    for unit_datastore in self._unit_datastores()
+                    if getattr(unit_datastore, "blocking_io", False)
+                ),
+                None,
+            )
+        if not getattr(datastore, "blocking_io", False):
+            return None
+        executor = self._executors.get(id(datastore))
+        if executor is None:
+            import concurrent.futures
+
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=getattr(datastore, "max_connections", BLOCKING_IO_THREADS),
+                thread_name_prefix=type(datastore).__name__,
+            )
+            self._executors[id(datastore)] = executor
+        return executor
+
+    async def _handle_connection_async(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        if not self._make_room_for_connection(addr):
+            writer.close()
+            return
+        import asyncio
+
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        self._async_tasks.add(task)
+        self.accepted_connections += 1
+        try:
+            await handle_requests_async(
+                reader,
+                writer,
+                self._serving_units,
+                self.metrics,
+                self.framing,
+                self.idle_timeout,
+                self.read_timeout,
+                self.rate_limiter,
+                self.device_information,
+                executor_for=self._executor_for,
+            )
+        finally:
+            self._connections.pop(task, None)
+            self._async_tasks.discard(task)
+
+    def _wake_up_accepting(self):
+        self.stop_server = True
+        if self.mode == "asyncio":
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._async_stop_event.set)
+        elif self._wakeup_sockets is not None:
+            # Wake up the accepting thread from its select() call:
+            self._wakeup_sockets[1].send(b"\x00")
+
+    def stop(self):
+        if self._worker_processes:
+            self.stop_server = True
+            self._stop_workers()
+        else:
+            self._wake_up_accepting()
         if self.server_thread:
             self.server_thread.join(timeout=2)
             self.server_thread = None
+        if self._wakeup_sockets is not None:
+            for s in self._wakeup_sockets:
+                s.close()
+            self._wakeup_sockets = None
+        if self._listening_socket is not None:
+            self._listening_socket.close()
+            self._listening_socket = None
+        self.stop_metrics_server()
+        if self.change_notifier is not None:
+            self.change_notifier.stop()
         logger.info("Modbus Server stopped")
 
-    def dump_datastore(self):
-        return self.datastore.dump()
+    def start_metrics_server(self, port=9502, host="localhost"):
+        """Serve the metrics in the Prometheus text format on http://host:port/metrics"""
+        if self.metrics is None:
+            raise RuntimeError("Server was created without metrics=True")
+        self.metrics_server = modbus_metrics.MetricsHTTPServer(self.metrics, host, port)
+        logger.info(f"Metrics served on port {self.metrics_server.port}")
+
+    def stop_metrics_server(self):
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    ## Unit ID routing:
+    ## ================
+
+    def add_unit(self, unit_id, datastore):
+        """Serve requests for unit_id from datastore
+
+        Takes effect immediately for a running server, but not in already started workers.
+        """
+        check_unit_id(unit_id)
+        self.units[unit_id] = datastore
+        self._serving_units[unit_id] = self._serving(datastore, unit_id)
+
+    def remove_unit(self, unit_id):
+        """Answer requests for unit_id with exception 0A (Gateway Path Unavailable)"""
+        self.add_unit(unit_id, None)
+
+    def _unit_datastores(self):
+        # Every routed datastore once:
+        unit_datastores = {}
+        for datastore in self.units:
+            if datastore is not None:
+                unit_datastores[id(datastore)] = datastore
+        return list(unit_datastores.values())
+
+    def _serving(self, datastore, unit_id):
+        if datastore is None:
+            return None
+        if self.metrics is not None:
+            if id(datastore) not in self._instrumented_datastores:
+                self._instrumented_datastores[id(datastore)] = (
+                    modbus_metrics.InstrumentedDatastore(datastore, self.metrics)
+                )
+            datastore = self._instrumented_datastores[id(datastore)]
+        if self.change_notifier is not None:
+            datastore = modbus_changes.NotifyingDatastore(
+                datastore, self.change_notifier, unit_id
+            )
+        return datastore
+
+    def _datastore_for(self, unit_id):
+        datastore = self.datastore if unit_id is None else self.units[unit_id]
+        if datastore is None:
+            raise ValueError(f"No datastore for unit {unit_id}")
+        return datastore
+
+    def dump_datastore(self, unit_id=None):
+        return self._datastore_for(unit_id).dump()
+
+    ## Change notifications:
+    ## =====================
+
+    def subscribe(
+        self,
+        callback,
+        object_reference=None,
+        first_address=0,
+        number_of_records=65536,
+        unit_id=None,
+    ):
+        """Call callback(change) for the ranges that Modbus requests write
+
+        change is a Change(unit_id, object_reference, first_address, number_of_records).
+        The callbacks run in a dispatcher thread, writes within change_coalesce_interval
+        are merged. Values set with the set_-functions are not reported.
+        """
+        return self._subscribe(
+            modbus_changes.Subscription(
+                callback, object_reference, first_address, number_of_records, unit_id
+            )
+        )
+
+    def subscribe_queue(
+        self,
+        object_reference=None,
+        first_address=0,
+        number_of_records=65536,
+        unit_id=None,
+    ):
+        """Put the changes into an asyncio.Queue of the running event loop, see subscribe()
+
+        The queue is available as subscription.queue.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        subscription = modbus_changes.Subscription(
+            lambda change: loop.call_soon_threadsafe(queue.put_nowait, change),
+            object_reference,
+            first_address,
+            number_of_records,
+            unit_id,
+        )
+        subscription.queue = queue
+        return self._subscribe(subscription)
+
+    def unsubscribe(self, subscription):
+        if self.change_notifier is not None:
+            self.change_notifier.unsubscribe(subscription)
+
+    def _subscribe(self, subscription):
+        if self.workers > 1:
+            raise ValueError(
+                "Change notifications are not available with workers > 1, "
+                "the requests are processed in the worker processes"
+            )
+        if self.change_notifier is None:
+            self.change_notifier = modbus_changes.ChangeNotifier(
+                self.change_coalesce_interval
+            )
+            # Route requests through NotifyingDatastores, in place for running handlers:
+            self._serving_units[:] = [
+                self._serving(datastore, unit_id)
+                for unit_id, datastore in enumerate(self.units)
+            ]
+        return self.change_notifier.subscribe(subscription)
 
     ## Convenience Functions for direct access to object reference (single + multiple):
     ## ================================================================================
 
-    def set_coil(self, address, value):
-        self._set_value("coils", address, value)
+    def set_coil(self, address, value, unit_id=None):
+        self._set_value("coils", address, value, None, unit_id)
 
-    def set_coils(self, start_address, values):
-        address = start_address
-        for value in values:
-            self._set_value("coils", address, value)
-            address += 1
+    def set_coils(self, start_address, values, unit_id=None):
+        self._set_values("coils", start_address, values, None, unit_id)
 
-    def set_discrete_input(self, address, value):
-        self._set_value("discrete_inputs", address, value)
+    def set_discrete_input(self, address, value, unit_id=None):
+        self._set_value("discrete_inputs", address, value, None, unit_id)
 
-    def set_discrete_inputs(self, start_address, values):
-        address = start_address
-        for value in values:
-            self._set_value("discrete_inputs", address, value)
-            address += 1
+    def set_discrete_inputs(self, start_address, values, unit_id=None):
+        self._set_values("discrete_inputs", start_address, values, None, unit_id)
 
-    def set_input_register(self, address, value, encoding):
-        self._set_value("input_registers", address, value, encoding)
+    def set_input_register(self, address, value, encoding, unit_id=None):
+        self._set_value("input_registers", address, value, encoding, unit_id)
 
-    def set_input_registers(self, start_address, values, encoding):
-        address = start_address
-        for value in values:
-            self._set_value("input_registers", address, value, encoding)
-            address += struct.calcsize(encoding) // 2
+    def set_input_registers(self, start_address, values, encoding, unit_id=None):
+        self._set_values("input_registers", start_address, values, encoding, unit_id)
 
-    def set_holding_register(self, address, value, encoding):
-        self._set_value("holding_registers", address, value, encoding)
+    def set_holding_register(self, address, value, encoding, unit_id=None):
+        self._set_value("holding_registers", address, value, encoding, unit_id)
 
-    def set_holding_registers(self, start_address, values, encoding):
-        address = start_address
-        for value in values:
-            self._set_value("holding_registers", address, value, encoding)
-            address += struct.calcsize(encoding) // 2
+    def set_holding_registers(self, start_address, values, encoding, unit_id=None):
+        self._set_values("holding_registers", start_address, values, encoding, unit_id)
 
     # Actually set the value:
     # =======================
 
-    def _set_value(self, object_reference, address, value, encoding=None):
+    def _set_value(self, object_reference, address, value, encoding=None, unit_id=None):
+        datastore = self._datastore_for(unit_id)
 
         # Verify address:
         if type(address) is not int:
@@ -285,16 +1032,182 @@ class Server:
         # Verify if value can be converted to float for input_registers and holding_registers:
         # This works for float, int, and string with valid number inside
         if object_reference in ("input_registers", "holding_registers"):
-
-            # Verify encoding:
-            if encoding not in ("h", "H", "e", "f"):
+            # Verify encoding, the codec packs the value once in the datastore:
+            codec = get_codec(encoding, self.word_order, self.byte_order)
+            if address + codec.registers > 65536:
                 raise ValueError(
-                    f'encoding must be "h" (short), "H" (unsigned short), "e" (float16), or "f" (float32) not {encoding}'
+                    f"{codec.registers} registers from 'address' {address} exceed 65535"
                 )
+            encoding = datastore_encoding(codec)
 
-            if encoding in ("f"):
-                value_bytes12 = value
-                self.datastore.write(object_reference, address, value, encoding)
-                self.datastore.write(object_reference, address + 1, value, encoding)
+        datastore.write(object_reference, address, value, encoding)
+
+    def _set_values(
+        self, object_reference, start_address, values, encoding=None, unit_id=None
+    ):
+        datastore = self._datastore_for(unit_id)
 
-        self.datastore.write(object_reference, address, value, encoding)
+        # NumPy arrays (and array.array) are converted to Python values in one call:
+        if hasattr(values, "tolist"):
+            values = values.tolist()
+
+        # Verify the whole range once instead of every single address:
+        if type(start_address) is not int:
+            raise TypeError(
+                f"type of 'start_address' must be int, not {type(start_address)}"
+            )
+        if object_reference in ("coils", "discrete_inputs"):
+            if not all(type(value) is bool for value in values):
+                raise TypeError(
+                    f"'values' for {object_reference} must all be True or False"
+                )
+            registers_per_value = 1
+        else:
+            codec = get_codec(encoding, self.word_order, self.byte_order)
+            registers_per_value = codec.registers
+            encoding = datastore_encoding(codec)
+        end_address = start_address + len(values) * registers_per_value
+        if start_address < 0 or end_address > 65536:
+            raise ValueError(
+                f"addresses {start_address} to {end_address - 1} must be between 0 and 65535"
+            )
+
+        # Datastores with bulk setters pack the block at once and write it in one go:
+        if object_reference in ("coils", "discrete_inputs"):
+            if hasattr(datastore, "set_bits"):
+                datastore.set_bits(object_reference, start_address, values)
+                return
+        elif hasattr(datastore, "set_registers"):
+            datastore.set_registers(object_reference, start_address, values, encoding)
+            return
+
+        address = start_address
+        for value in values:
+            datastore.write(object_reference, address, value, encoding)
+            address += registers_per_value
+
+
+class SerialServer(Server):
+    """Serves Modbus RTU on a serial device or pseudo-terminal
+
+    Requests are processed like the requests of a Server (same datastores, unit ID
+    routing, set_-functions and metrics). Frames for unit IDs without a datastore are
+    ignored, because other devices on the serial line may answer them.
+    """
+
+    def __init__(
+        self,
+        device,
+        baudrate=19200,
+        parity="E",
+        stopbits=1,
+        datastore=None,
+        loglevel="INFO",
+        autostart=False,
+        metrics=False,
+        units=None,
+        identification=None,
+    ):
+        if parity not in ("N", "E", "O"):
+            raise ValueError(f'parity must be "N", "E" or "O", not {parity}')
+        self.device = device
+        self.baudrate = baudrate
+        self.parity = parity
+        self.stopbits = stopbits
+        self._fd = None
+        super().__init__(
+            host=None,
+            port=None,
+            datastore=datastore,
+            loglevel=loglevel,
+            autostart=autostart,
+            metrics=metrics,
+            units=units,
+            framing="rtu",
+            identification=identification,
+        )
+
+    def _open_device(self):
+        fd = os.open(self.device, os.O_RDWR | os.O_NOCTTY)
+        try:
+            tty.setraw(fd)
+            attributes = termios.tcgetattr(fd)
+            speed = getattr(termios, f"B{self.baudrate}")
+            attributes[4] = attributes[5] = speed  # ispeed, ospeed
+            cflag = attributes[2] & ~(termios.PARENB | termios.PARODD | termios.CSTOPB)
+            if self.parity != "N":
+                cflag |= termios.PARENB
+            if self.parity == "O":
+                cflag |= termios.PARODD
+            if self.stopbits == 2:
+                cflag |= termios.CSTOPB
+            attributes[2] = cflag | termios.CLOCAL | termios.CREAD
+            termios.tcsetattr(fd, termios.TCSANOW, attributes)
+        except (OSError, AttributeError, termios.error):
+            os.close(fd)
+            raise
+        return fd
+
+    def start(self):
+        self.stop_server = False
+        if self.change_notifier is not None:
+            self.change_notifier.start()
+        self._fd = self._open_device()
+        self._wakeup_sockets = socket.socketpair()
+        self.server_thread = threading.Thread(target=self._serve_serial)
+        self.server_thread.start()
+        logger.info(
+            f"Modbus RTU Server started on {self.device} ({self.baudrate} baud)"
+        )
+
+    def _serve_serial(self):
+        framer = modbus_rtu.RTUFramer(modbus_rtu.inter_frame_gap(self.baudrate))
+        response_buffer = modbus_rtu.RTUResponseBuffer()
+        units = self._serving_units
+        addr = (self.device, None)
+        wakeup_receiver = self._wakeup_sockets[0]
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._fd, selectors.EVENT_READ)
+            selector.register(wakeup_receiver, selectors.EVENT_READ)
+            while not self.stop_server:
+                for key, _ in selector.select():
+                    if key.fileobj is wakeup_receiver:
+                        return
+                    try:
+                        data = os.read(self._fd, 512)
+                    except OSError as e:
+                        logger.error(f"Stopped reading from {self.device}: {e}")
+                        return
+                    for frame in framer.feed(data, time.monotonic()):
+                        if frame[0] != 0 and units[frame[0]] is None:
+                            continue  # Another device on the line
+                        if self.metrics is None:
+                            modbus_rtu.process_rtu_request(
+                                frame,
+                                addr,
+                                units,
+                                response_buffer,
+                                self.device_information,
+                            )
+                        else:
+                            process_request_with_metrics(
+                                frame,
+                                addr,
+                                units,
+                                response_buffer,
+                                self.metrics,
+                                modbus_rtu.process_rtu_request,
+                                1,
+                                self.device_information,
+                            )
+                    if response_buffer.length:
+                        response = response_buffer.getvalue()
+                        response_buffer.length = 0
+                        while response:
+                            response = response[os.write(self._fd, response) :]
+
+    def stop(self):
+        super().stop()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
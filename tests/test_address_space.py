@@ -0,0 +1,80 @@
+import json
+import time
+import pytest
+import modbus_server
+from modbus_server.modbus_datastore import AddressSpace
+from pyModbusTCP.client import ModbusClient
+
+
+def test_map_and_check_ranges():
+    address_space = AddressSpace()
+    address_space.map("coils", 10, 2000)
+    assert address_space.is_mapped("coils", 10, 2000)
+    assert address_space.is_mapped("coils", 500, 1)
+    assert not address_space.is_mapped("coils", 9, 2)
+    assert not address_space.is_mapped("coils", 2000, 11)
+    assert not address_space.is_mapped("discrete_inputs", 10, 1)
+    address_space.unmap("coils", 1000)
+    assert not address_space.is_mapped("coils", 10, 2000)
+    with pytest.raises(KeyError):
+        address_space.check("coils", 10, 2000)
+
+
+def test_range_beyond_address_space():
+    address_space = AddressSpace()
+    address_space.map("holding_registers", 65530, 6)
+    assert address_space.is_mapped("holding_registers", 65530, 6)
+    assert not address_space.is_mapped("holding_registers", 65530, 7)
+    assert address_space.mapped_addresses("holding_registers") == list(
+        range(65530, 65536)
+    )
+
+
+def test_dict_datastore_address_space():
+    datastore = modbus_server.DictDatastore()
+    datastore.write("holding_registers", 0, 1.5, "f")
+    datastore.set_bits("coils", 5, [True, False])
+    assert datastore.address_space.is_mapped("holding_registers", 0, 2)
+    assert datastore.address_space.is_mapped("coils", 5, 2)
+    with pytest.raises(KeyError):
+        datastore.read("coils", 4, 2)
+    datastore.empty()
+    assert not datastore.address_space.is_mapped("coils", 5, 1)
+    assert datastore.dump()["coils"] == {}
+
+
+def test_redis_datastore_address_space():
+    fakeredis = pytest.importorskip("fakeredis")
+    with open("tests/example_modbus_address_map.json") as f:
+        modbus_address_map = json.load(f)
+    datastore = modbus_server.RedisDatastore(
+        modbus_address_map, redis_client=fakeredis.FakeRedis()
+    )
+    for address in modbus_address_map["input_registers"]:
+        assert datastore.address_space.is_mapped("input_registers", int(address), 1)
+    datastore.write("coils", 1000, True, None)
+    assert datastore.address_space.is_mapped("coils", 1000, 1)
+
+
+class CountingDatastore(modbus_server.DictDatastore):
+    reads = 0
+
+    def read(self, *args):
+        self.reads += 1
+        return super().read(*args)
+
+
+def test_unmapped_range_is_rejected_without_reading():
+    datastore = CountingDatastore()
+    s = modbus_server.Server(port=5031, datastore=datastore, autostart=True)
+    time.sleep(0.1)
+    try:
+        s.set_coils(0, [True] * 1999)
+        client = ModbusClient(host="localhost", port=5031, auto_open=True)
+        assert client.read_coils(0, 2000) is None
+        assert client.last_except == 2
+        assert datastore.reads == 0
+        assert client.read_coils(0, 1999) == [True] * 1999
+        assert datastore.reads == 1
+    finally:
+        s.stop()
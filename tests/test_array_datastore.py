@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import threading
+import multiprocessing
+import pytest
+import modbus_server
+from pyModbusTCP.client import ModbusClient
+
+
+@pytest.fixture()
+def modbus_server_instance():
+    datastore = modbus_server.ArrayDatastore()
+    s = modbus_server.Server(port=5025, datastore=datastore, autostart=True)
+    time.sleep(0.1)
+    yield s
+    s.stop()
+
+
+@pytest.fixture()
+def modbus_client():
+    return ModbusClient(host="localhost", port=5025, auto_open=True)
+
+
+def test_array_read_coils(modbus_server_instance, modbus_client):
+    values = [bool(i % 3) for i in range(2000)]
+    modbus_server_instance.set_coils(3, values)
+    assert modbus_client.read_coils(3, 2000) == values
+    assert modbus_client.read_coils(10, 13) == values[7:20]
+
+
+def test_array_read_discrete_input(modbus_server_instance, modbus_client):
+    modbus_server_instance.set_discrete_input(65535, True)
+    assert modbus_client.read_discrete_inputs(65535, 1) == [True]
+
+
+def test_array_read_input_registers(modbus_server_instance, modbus_client):
+    modbus_server_instance.set_input_registers(0, list(range(125)), "H")
+    assert modbus_client.read_input_registers(0, 125) == list(range(125))
+
+
+def test_array_read_holding_register(modbus_server_instance, modbus_client):
+    modbus_server_instance.set_holding_register(0, -2, "h")
+    assert modbus_client.read_holding_registers(0, 1) == [65534]
+
+
+def test_array_unmapped_address(modbus_server_instance, modbus_client):
+    modbus_server_instance.set_holding_registers(0, [1, 2], "h")
+    assert modbus_client.read_holding_registers(0, 3) is None
+    assert modbus_client.last_except == 2
+
+
+def test_array_matches_dict_datastore():
+    array_datastore = modbus_server.ArrayDatastore()
+    dict_datastore = modbus_server.DictDatastore()
+    for datastore in (array_datastore, dict_datastore):
+        datastore.write("coils", 5, True, None)
+        datastore.write("coils", 6, False, None)
+        datastore.write("input_registers", 7, 1.5, "f")
+        datastore.write("holding_registers", 0, 513, "H")
+    assert array_datastore.read("coils", 5, 2) == dict_datastore.read("coils", 5, 2)
+    assert array_datastore.read("input_registers", 7, 2) == dict_datastore.read(
+        "input_registers", 7, 2
+    )
+    assert array_datastore.dump() == dict_datastore.dump()
+    array_datastore.empty()
+    with pytest.raises(KeyError):
+        array_datastore.read("coils", 5, 1)
+
+
+def test_array_concurrent_bit_writes():
+    datastore = modbus_server.ArrayDatastore()
+    datastore.set_bits("coils", 0, [False] * 8)
+    barrier = threading.Barrier(8)
+
+    def toggle(address):
+        # Every thread changes its own coil, all coils share one byte:
+        barrier.wait()
+        for i in range(2000):
+            datastore.write_bits("coils", address, [i % 2 == 0])
+        datastore.write_bits("coils", address, [True])
+
+    switch_interval = sys.getswitchinterval()
+    # Switch threads as often as possible, so that unguarded writes would get lost:
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [
+            threading.Thread(target=toggle, args=(address,)) for address in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert datastore.read("coils", 0, 8) == [True] * 8
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="worker processes are forked")
+def test_shared_array_writes_wait_for_other_processes():
+    datastore = modbus_server.ArrayDatastore(shared=True)
+    datastore.set_bits("coils", 0, [False] * 8)
+    context = multiprocessing.get_context("fork")
+    in_batch = context.Event()
+    done = context.Event()
+
+    def write_in_batch():
+        datastore.after_fork()
+        with datastore.batch():
+            in_batch.set()
+            done.wait(5)
+            datastore.write_bits("coils", 0, [True])
+
+    process = context.Process(target=write_in_batch)
+    process.start()
+    try:
+        assert in_batch.wait(5)
+        # A bit write in this process waits for the batch of the worker process:
+        writer = threading.Thread(
+            target=datastore.write_bits, args=("coils", 1, [True])
+        )
+        writer.start()
+        writer.join(0.2)
+        assert writer.is_alive()
+        done.set()
+        writer.join(5)
+        assert not writer.is_alive()
+    finally:
+        done.set()
+        process.join()
+    assert datastore.read("coils", 0, 2) == [True, True]
@@ -0,0 +1,48 @@
+import time
+import pytest
+import modbus_server
+from pyModbusTCP.client import ModbusClient
+
+
+@pytest.fixture()
+def modbus_server_instance():
+    s = modbus_server.Server(port=5022, mode="asyncio", autostart=True)
+    time.sleep(0.1)
+    yield s
+    s.stop()
+
+
+@pytest.fixture()
+def modbus_client():
+    return ModbusClient(host="localhost", port=5022, auto_open=True)
+
+
+def test_asyncio_read_coil(modbus_server_instance, modbus_client):
+    modbus_server_instance.set_coil(0, True)
+    assert modbus_client.read_coils(0, 1) == [True]
+
+
+def test_asyncio_read_holding_register(modbus_server_instance, modbus_client):
+    modbus_server_instance.set_holding_register(0, 1234, "h")
+    assert modbus_client.read_holding_registers(0, 1) == [1234]
+
+
+def test_asyncio_illegal_data_address(modbus_server_instance, modbus_client):
+    assert modbus_client.read_input_registers(0, 1) is None
+    assert modbus_client.last_except == 2
+
+
+def test_asyncio_many_concurrent_clients(modbus_server_instance):
+    modbus_server_instance.set_input_registers(0, list(range(10)), "H")
+    clients = [ModbusClient(host="localhost", port=5022) for _ in range(200)]
+    for c in clients:
+        assert c.open()
+    for c in clients:
+        assert c.read_input_registers(0, 10) == list(range(10))
+    for c in clients:
+        c.close()
+
+
+def test_invalid_mode():
+    with pytest.raises(ValueError):
+        modbus_server.Server(port=5022, mode="forking")
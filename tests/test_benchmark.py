@@ -0,0 +1,39 @@
+from modbus_server import benchmark
+
+
+def test_benchmark_smoke():
+    results = list(
+        benchmark.run_benchmarks(
+            datastores=("ArrayDatastore",),
+            modes=("threading",),
+            function_codes=(3, 16),
+            clients=2,
+            duration=0.05,
+        )
+    )
+    assert [r["benchmark"] for r in results] == ["memory", "accept"] + ["load"] * 6
+    for result in results[2:]:
+        assert result["requests"] > 0
+        assert 0 < result["p50_ms"] <= result["p99_ms"]
+        assert benchmark.format_result(result)
+
+
+def test_startup_benchmark_smoke():
+    results = list(benchmark.run_startup_benchmarks(runs=1))
+    assert [r["stage"] for r in results] == list(benchmark.STARTUP_STAGES)
+    for result in results:
+        assert result["seconds"] > 0
+        assert benchmark.format_result(result)
+
+
+def test_concurrency_benchmark_smoke():
+    results = list(
+        benchmark.run_concurrency_benchmarks(
+            datastores=("DictDatastore",), readers=(2,), duration=0.05
+        )
+    )
+    assert [r["write_rate"] for r in results] == [0, 1000]
+    for result in results:
+        assert result["reads_per_second"] > 0
+        assert result["torn_reads"] == 0
+        assert benchmark.format_result(result)
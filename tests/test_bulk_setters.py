@@ -0,0 +1,111 @@
+import array
+import struct
+import pytest
+import modbus_server
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+class CountingRedis(fakeredis.FakeRedis):
+    """fakeredis client that counts the commands sent to the server"""
+
+    commands = []
+
+    def execute_command(self, *args, **options):
+        self.commands.append(args[0])
+        return super().execute_command(*args, **options)
+
+
+def create_datastore(name):
+    if name == "RedisDatastore":
+        client = CountingRedis()
+        client.flushdb()
+        return modbus_server.RedisDatastore({}, redis_client=client)
+    return getattr(modbus_server, name)()
+
+
+@pytest.fixture(params=["DictDatastore", "ArrayDatastore", "RedisDatastore"])
+def server(request):
+    # Not started, the setters work on the datastore directly:
+    return modbus_server.Server(port=0, datastore=create_datastore(request.param))
+
+
+def register_bytes(server, object_reference, first_address, number_of_records):
+    return b"".join(
+        server.datastore.read(object_reference, first_address, number_of_records)
+    )
+
+
+def test_set_registers_block(server):
+    values = list(range(1000))
+    server.set_holding_registers(100, values, "H")
+    assert register_bytes(server, "holding_registers", 100, 1000) == struct.pack(
+        "!1000H", *values
+    )
+
+
+def test_set_float_registers(server):
+    server.set_input_registers(10, [1.5, -2.25, 3.0], "f")
+    assert register_bytes(server, "input_registers", 10, 6) == struct.pack(
+        "!3f", 1.5, -2.25, 3.0
+    )
+    # Single registers of a float can be read on their own:
+    assert (
+        register_bytes(server, "input_registers", 13, 1) == struct.pack("!f", -2.25)[2:]
+    )
+
+
+def test_set_bits_block(server):
+    values = [bool(i % 3) for i in range(2000)]
+    server.set_coils(5, values)
+    assert server.datastore.read("coils", 5, 2000) == values
+
+
+def test_set_from_array(server):
+    server.set_holding_registers(0, array.array("h", [-1, 0, 1]), "h")
+    assert register_bytes(server, "holding_registers", 0, 3) == struct.pack(
+        "!3h", -1, 0, 1
+    )
+
+
+def test_set_from_numpy_array(server):
+    numpy = pytest.importorskip("numpy")
+    server.set_input_registers(0, numpy.arange(0.0, 2.0, 0.5), "f")
+    assert register_bytes(server, "input_registers", 0, 8) == struct.pack(
+        "!4f", 0.0, 0.5, 1.0, 1.5
+    )
+    server.set_discrete_inputs(0, numpy.array([True, False, True]))
+    assert server.datastore.read("discrete_inputs", 0, 3) == [True, False, True]
+
+
+def test_range_is_validated_before_writing(server):
+    with pytest.raises(ValueError):
+        server.set_holding_registers(65534, [1.0, 2.0], "f")
+    with pytest.raises(ValueError):
+        server.set_holding_registers(0, [1, 2], "b")  # Not whole registers
+    with pytest.raises(TypeError):
+        server.set_coils(0, [True, 1])
+    with pytest.raises(KeyError):
+        server.datastore.read("coils", 0, 1)
+
+
+def test_redis_block_is_one_round_trip():
+    server = modbus_server.Server(port=0, datastore=create_datastore("RedisDatastore"))
+    CountingRedis.commands.clear()
+    server.set_holding_registers(0, list(range(500)), "H")
+    server.set_coils(0, [True] * 500)
+    assert CountingRedis.commands == ["MSET", "MSET"]
+
+
+def test_datastore_setters_reject_addresses_beyond_65535(server):
+    # Producers call the datastore directly, without the checks of the Server:
+    datastore = server.datastore
+    with pytest.raises(ValueError):
+        datastore.set_registers("holding_registers", 65535, [0xFFFFFFFF], "I")
+    with pytest.raises(ValueError):
+        datastore.set_bits("coils", 65530, [True] * 7)
+    with pytest.raises(ValueError):
+        datastore.write("input_registers", 65535, 1.5, "f")
+    for object_reference in ("coils", "input_registers", "holding_registers"):
+        assert not datastore.address_space.is_mapped(object_reference, 0, 1)
+        assert not datastore.address_space.is_mapped(object_reference, 65535, 1)
@@ -0,0 +1,110 @@
+import time
+import queue
+import asyncio
+import pytest
+import modbus_server
+from modbus_server.modbus_changes import Change, ChangeNotifier, Subscription
+from pyModbusTCP.client import ModbusClient
+
+
+@pytest.fixture()
+def modbus_server_instance():
+    s = modbus_server.Server(port=5035, autostart=True, change_coalesce_interval=0.05)
+    s.set_holding_registers(0, list(range(100)), "H")
+    s.set_coils(0, [False] * 100)
+    time.sleep(0.1)
+    yield s
+    s.stop()
+
+
+@pytest.fixture()
+def modbus_client():
+    return ModbusClient(host="localhost", port=5035, auto_open=True)
+
+
+def test_writes_are_notified(modbus_server_instance, modbus_client):
+    changes = queue.Queue()
+    modbus_server_instance.subscribe(changes.put)
+    assert modbus_client.write_multiple_registers(10, [1, 2, 3])
+    assert changes.get(timeout=1) == Change(1, "holding_registers", 10, 3)
+    assert modbus_client.write_single_coil(5, True)
+    assert changes.get(timeout=1) == Change(1, "coils", 5, 1)
+
+
+def test_bursts_are_coalesced(modbus_server_instance, modbus_client):
+    changes = queue.Queue()
+    modbus_server_instance.subscribe(changes.put, "holding_registers")
+    for address in (20, 21, 22, 30):
+        assert modbus_client.write_single_register(address, 1)
+    time.sleep(0.2)
+    received = []
+    while not changes.empty():
+        received.append(changes.get())
+    received_ranges = sorted(
+        address
+        for change in received
+        for address in range(
+            change.first_address, change.first_address + change.number_of_records
+        )
+    )
+    assert received_ranges == [20, 21, 22, 30]
+    assert len(received) < 4
+
+
+def test_subscription_filters(modbus_server_instance, modbus_client):
+    changes = queue.Queue()
+    subscription = modbus_server_instance.subscribe(
+        changes.put, "holding_registers", 50, 10
+    )
+    assert modbus_client.write_single_register(40, 1)
+    assert modbus_client.write_single_coil(55, True)
+    assert modbus_client.write_multiple_registers(58, [1, 2, 3, 4])
+    assert changes.get(timeout=1) == Change(1, "holding_registers", 58, 4)
+    modbus_server_instance.unsubscribe(subscription)
+    assert modbus_client.write_single_register(55, 1)
+    time.sleep(0.2)
+    assert changes.empty()
+
+
+def test_set_functions_and_failed_writes_are_not_notified(
+    modbus_server_instance, modbus_client
+):
+    changes = queue.Queue()
+    modbus_server_instance.subscribe(changes.put)
+    modbus_server_instance.set_holding_register(0, 5, "H")
+    assert not modbus_client.write_single_register(1000, 1)  # Unmapped
+    time.sleep(0.2)
+    assert changes.empty()
+
+
+def test_subscribe_queue(modbus_server_instance, modbus_client):
+    async def wait_for_change():
+        subscription = modbus_server_instance.subscribe_queue()
+        await asyncio.get_running_loop().run_in_executor(
+            None, modbus_client.write_single_register, 3, 7
+        )
+        return await asyncio.wait_for(subscription.queue.get(), 1)
+
+    assert asyncio.run(wait_for_change()) == Change(1, "holding_registers", 3, 1)
+
+
+def test_failing_callback_does_not_stop_notifications():
+    notifier = ChangeNotifier()
+    received = queue.Queue()
+
+    def failing_callback(change):
+        raise RuntimeError("callback failed")
+
+    notifier.subscribe(Subscription(failing_callback))
+    notifier.subscribe(Subscription(received.put))
+    notifier.record(1, "coils", 0, 8)
+    assert received.get(timeout=1) == Change(1, "coils", 0, 8)
+    notifier.stop()
+
+
+def test_no_subscriptions_with_workers():
+    s = modbus_server.Server(
+        port=0, workers=2, datastore=modbus_server.ArrayDatastore(shared=True)
+    )
+    with pytest.raises(ValueError):
+        s.subscribe(print)
@@ -0,0 +1,115 @@
+import struct
+import pytest
+import modbus_server
+from modbus_server.modbus_codec import Codec, get_codec
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.mark.parametrize(
+    "word_order, byte_order, expected",
+    [
+        ("big", "big", b"\x01\x02\x03\x04"),  # ABCD
+        ("little", "big", b"\x03\x04\x01\x02"),  # CDAB
+        ("big", "little", b"\x02\x01\x04\x03"),  # BADC
+        ("little", "little", b"\x04\x03\x02\x01"),  # DCBA
+    ],
+)
+def test_word_and_byte_order(word_order, byte_order, expected):
+    codec = get_codec("I", word_order, byte_order)
+    assert codec.encode(0x01020304) == expected
+    assert codec.decode(expected) == 0x01020304
+    assert codec.encode_many([0x01020304] * 3) == expected * 3
+    assert codec.decode_many(expected * 3) == [0x01020304] * 3
+
+
+def test_16_bit_values_ignore_word_order():
+    assert get_codec("H", "little", "big").encode(0x0102) == b"\x01\x02"
+    assert get_codec("H", "little", "little").encode(0x0102) == b"\x02\x01"
+
+
+def test_64_bit_values():
+    codec = get_codec("d")
+    assert codec.registers == 4
+    assert codec.encode(1.5) == struct.pack("!d", 1.5)
+    assert get_codec("q").decode_many(struct.pack("!2q", -1, 2**40)) == [-1, 2**40]
+
+
+def test_strings():
+    codec = get_codec("5s")
+    assert codec.registers == 3
+    assert codec.encode("abcde") == b"abcde\x00"
+    assert codec.decode(b"abc\x00\x00\x00") == "abc"
+    assert codec.decode_many(b"ab\x00\x00\x00\x00xyz\x00\x00\x00") == ["ab", "xyz"]
+    swapped = get_codec("4s", byte_order="little")
+    assert swapped.encode("abcd") == b"badc"
+    assert swapped.decode_many(b"badcdcba") == ["abcd", "cdab"]
+
+
+def test_codecs_are_compiled_once():
+    assert get_codec("f") is get_codec("f")
+    codec = Codec("f", word_order="little")
+    assert get_codec(codec) is codec
+
+
+@pytest.mark.parametrize("encoding", ["b", "x", "0s", "ff", None])
+def test_invalid_encodings(encoding):
+    with pytest.raises(ValueError):
+        get_codec(encoding)
+    with pytest.raises(ValueError):
+        Codec("f", word_order="middle")
+
+
+@pytest.mark.parametrize("name", ["DictDatastore", "ArrayDatastore", "RedisDatastore"])
+def test_datastores_encode_alike(name):
+    if name == "RedisDatastore":
+        datastore = modbus_server.RedisDatastore({}, redis_client=fakeredis.FakeRedis())
+    else:
+        datastore = getattr(modbus_server, name)()
+    server = modbus_server.Server(port=0, datastore=datastore, word_order="little")
+    server.set_input_register(0, 1.5, "f")
+    server.set_input_registers(2, [2**40, -3], "q")
+    server.set_input_register(10, "Pump", "4s")
+    expected = (
+        get_codec("f", "little").encode(1.5)
+        + get_codec("q", "little").encode_many([2**40, -3])
+        + b"Pump"
+    )
+    assert b"".join(datastore.read("input_registers", 0, 12)) == expected
+
+
+def test_set_register_writes_once(monkeypatch):
+    server = modbus_server.Server(port=0)
+    writes = []
+    original_write = server.datastore.write
+    monkeypatch.setattr(
+        server.datastore,
+        "write",
+        lambda *args: writes.append(args) or original_write(*args),
+    )
+    server.set_holding_register(0, 1.5, "f")
+    assert len(writes) == 1
+    assert b"".join(server.datastore.read("holding_registers", 0, 2)) == (
+        struct.pack("!f", 1.5)
+    )
+
+
+class StructDatastore(modbus_server.DictDatastore):
+    """Datastore written for str encodings, like before the codecs"""
+
+    def write(self, object_reference, address, value, encoding):
+        register_bytes = struct.pack(f"!{encoding}", value)
+        for i in range(0, len(register_bytes), 2):
+            super().write(
+                object_reference, address + i // 2, register_bytes[i : i + 2], "2s"
+            )
+
+
+def test_custom_datastores_get_str_encodings():
+    s = modbus_server.Server(port=0, datastore=StructDatastore())
+    s.set_holding_register(0, 1.5, "f")
+    s.set_input_register(0, -2, modbus_server.Codec("h"))
+    assert b"".join(s.datastore.read("holding_registers", 0, 2)) == struct.pack(
+        "!f", 1.5
+    )
+    assert s.datastore.read("input_registers", 0, 1) == [struct.pack("!h", -2)]
@@ -0,0 +1,119 @@
+import time
+import socket
+import struct
+import pytest
+import modbus_server
+
+
+def read_request(transaction_id=1):
+    return struct.pack("!HHHBBHH", transaction_id, 0, 6, 1, 3, 0, 1)
+
+
+def receive(client, number_of_bytes=11):
+    data = b""
+    while len(data) < number_of_bytes:
+        chunk = client.recv(number_of_bytes - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture(params=["threading", "asyncio"])
+def start_server(request):
+    servers = []
+
+    def start(**kwargs):
+        s = modbus_server.Server(port=5033, mode=request.param, **kwargs)
+        s.set_holding_register(0, 1, "H")
+        s.start()
+        servers.append(s)
+        return s
+
+    yield start
+    for s in servers:
+        s.stop()
+
+
+def test_idle_timeout_closes_connection(start_server):
+    s = start_server(idle_timeout=0.2)
+    with socket.create_connection(("localhost", 5033)) as client:
+        client.sendall(read_request())
+        assert len(receive(client)) == 11
+        client.settimeout(2)
+        assert client.recv(1) == b""
+    assert wait_for(lambda: s.open_connections == 0)
+
+
+def test_read_timeout_closes_incomplete_frame(start_server):
+    start_server(read_timeout=0.2)
+    with socket.create_connection(("localhost", 5033)) as client:
+        client.sendall(read_request()[:5])
+        client.settimeout(2)
+        assert client.recv(1) == b""
+
+
+def test_refuse_connections_above_limit(start_server):
+    s = start_server(max_connections=2)
+    clients = [socket.create_connection(("localhost", 5033)) for _ in range(3)]
+    try:
+        for client in clients[:2]:
+            client.sendall(read_request())
+            assert len(receive(client)) == 11
+        clients[2].settimeout(2)
+        clients[2].sendall(read_request())
+        try:
+            response = receive(clients[2])
+        except ConnectionResetError:
+            # Closing a socket with an unread request sends a reset instead of a FIN:
+            response = b""
+        assert response == b""
+        assert wait_for(lambda: s.refused_connections == 1)
+        assert s.open_connections == 2
+    finally:
+        for client in clients:
+            client.close()
+
+
+def test_evict_oldest_connection(start_server):
+    s = start_server(max_connections=2, connection_policy="evict_oldest")
+    clients = []
+    try:
+        for _ in range(3):
+            client = socket.create_connection(("localhost", 5033))
+            client.settimeout(2)
+            client.sendall(read_request())
+            assert len(receive(client)) == 11
+            clients.append(client)
+        assert receive(clients[0]) == b""
+        assert s.evicted_connections == 1
+        clients[2].sendall(read_request())
+        assert len(receive(clients[2])) == 11
+    finally:
+        for client in clients:
+            client.close()
+
+
+def test_rate_limit_answers_busy(start_server):
+    start_server(max_requests_per_second=1, request_burst=3)
+    with socket.create_connection(("localhost", 5033)) as client:
+        # Pipelined in one segment, the fourth request exceeds the burst:
+        client.sendall(b"".join(read_request(i) for i in range(4)))
+        responses = receive(client, 3 * 11 + 9)
+        assert responses[33:] == struct.pack("!HHHBBB", 3, 0, 3, 1, 0x83, 6)
+
+
+def test_rate_limiter_refills():
+    limiter = modbus_server.modbus_server.RateLimiter(rate=100, burst=2)
+    assert limiter.allow("a") and limiter.allow("a")
+    assert not limiter.allow("a")
+    assert limiter.allow("b")
+    time.sleep(0.02)
+    assert limiter.allow("a")
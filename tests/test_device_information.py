@@ -0,0 +1,107 @@
+import time
+import pytest
+import modbus_server
+from modbus_server.modbus_device import DeviceInformation
+from pyModbusTCP.client import ModbusClient
+
+
+@pytest.fixture()
+def modbus_server_instance():
+    s = modbus_server.Server(
+        port=5036,
+        autostart=True,
+        metrics=True,
+        identification={
+            "VendorName": "ACME",
+            "ProductCode": "PLC-1",
+            "MajorMinorRevision": "1.2",
+            "ProductName": "Pump Controller",
+            0x80: b"\x01\x02",
+        },
+    )
+    s.set_holding_registers(0, [0] * 10, "H")
+    time.sleep(0.1)
+    yield s
+    s.stop()
+
+
+@pytest.fixture()
+def modbus_client():
+    return ModbusClient(host="localhost", port=5036, auto_open=True)
+
+
+def test_read_device_identification_basic(modbus_server_instance, modbus_client):
+    response = modbus_client.read_device_identification(1)
+    assert response.conformity_level == 0x83
+    assert response.objects_by_id == {0: b"ACME", 1: b"PLC-1", 2: b"1.2"}
+
+
+def test_read_device_identification_regular_and_extended(
+    modbus_server_instance, modbus_client
+):
+    assert modbus_client.read_device_identification(2).objects_by_id[4] == (
+        b"Pump Controller"
+    )
+    assert 0x80 not in modbus_client.read_device_identification(2).objects_by_id
+    assert modbus_client.read_device_identification(3).objects_by_id[0x80] == (
+        b"\x01\x02"
+    )
+
+
+def test_read_device_identification_individual(modbus_server_instance, modbus_client):
+    assert modbus_client.read_device_identification(4, 1).objects_by_id == {1: b"PLC-1"}
+    assert modbus_client.read_device_identification(4, 5) is None
+    assert modbus_client.last_except == 2
+
+
+def test_diagnostics(modbus_server_instance, modbus_client):
+    assert modbus_client.custom_request(b"\x08\x00\x00\x12\x34") == (
+        b"\x08\x00\x00\x12\x34"
+    )
+    assert modbus_client.custom_request(b"\x08\x00\x0a\x00\x00")
+    for _ in range(3):
+        modbus_client.read_holding_registers(0, 1)
+    modbus_client.read_holding_registers(100, 1)
+    # Bus Message Count: the clear request, 3 reads and 1 failed read
+    assert modbus_client.custom_request(b"\x08\x00\x0b\x00\x00") == (
+        b"\x08\x00\x0b\x00\x05"
+    )
+    # Bus Exception Error Count:
+    assert modbus_client.custom_request(b"\x08\x00\x0d\x00\x00") == (
+        b"\x08\x00\x0d\x00\x01"
+    )
+    assert modbus_client.custom_request(b"\x08\x00\x04\x00\x00") is None
+    assert modbus_client.last_except == 1
+
+
+def test_without_metrics_counters_are_illegal():
+    device_information = DeviceInformation()
+    assert device_information.process_request(b"\x08\x00\x00\xab\xcd") == (
+        b"\x00\x00\xab\xcd"
+    )
+    with pytest.raises(modbus_server.modbus_pdu.ModbusError):
+        device_information.process_request(b"\x08\x00\x0b\x00\x00")
+
+
+def test_long_identification_is_split():
+    device_information = DeviceInformation(
+        {object_id: "x" * 100 for object_id in range(0x80, 0x84)}
+    )
+    response = device_information.process_request(b"\x2b\x0e\x03\x00")
+    more_follows, next_object_id, number_of_objects = response[3:6]
+    assert (more_follows, next_object_id) == (0xFF, 0x82)
+    assert number_of_objects == 5  # 3 basic objects, 0x80 and 0x81
+    rest = device_information.process_request(b"\x2b\x0e\x03\x82")
+    assert rest[3:6] == b"\x00\x00\x02"
+    assert len(response) <= 252
+
+
+def test_invalid_identification_requests():
+    device_information = DeviceInformation()
+    with pytest.raises(modbus_server.modbus_pdu.ModbusError) as e:
+        device_information.process_request(b"\x2b\x0e\x05\x00")
+    assert e.value.exception_code == 3
+    # Unknown object IDs restart the stream:
+    assert device_information.process_request(
+        b"\x2b\x0e\x01\x42"
+    ) == device_information.process_request(b"\x2b\x0e\x01\x00")
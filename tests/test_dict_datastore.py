@@ -1,4 +1,6 @@
+import sys
 import time
+import threading
 import pytest
 import modbus_server
 from pyModbusTCP.client import ModbusClient
@@ -35,3 +37,51 @@ def test_dict_read_input_register(modbus_server_instance, modbus_client):
 def test_dict_read_holding_register(modbus_server_instance, modbus_client):
     modbus_server_instance.set_holding_register(0, 1234, "h")
     assert modbus_client.read_holding_registers(0, 1) == [1234]
+
+
+def test_dict_no_torn_reads_while_writing():
+    datastore = modbus_server.DictDatastore()
+    switch_interval = sys.getswitchinterval()
+    # Switch threads as often as possible, so that unguarded writes would be read half-done:
+    sys.setswitchinterval(1e-6)
+    try:
+        result = modbus_server.benchmark.measure_concurrent_reads(
+            datastore, readers=2, duration=0.3
+        )
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert result["writes"] > 0
+    assert result["torn_reads"] == 0
+
+
+def test_dict_batch():
+    datastore = modbus_server.DictDatastore()
+    datastore.write("input_registers", 0, 1.5, "f")
+    with datastore.batch():
+        datastore.write("input_registers", 0, 2.5, "f")
+        datastore.set_bits("coils", 0, [True])
+        # Writes in progress, readers wait until the batch ends:
+        assert datastore._sequence & 1
+    assert not datastore._sequence & 1
+    assert b"".join(datastore.read("input_registers", 0, 2)) == b"\x40\x20\x00\x00"
+    assert datastore.read("coils", 0, 1) == [True]
+
+
+def test_dict_read_inside_batch(tmp_path):
+    datastore = modbus_server.DictDatastore()
+    datastore.set_registers("holding_registers", 0, [1], "H")
+
+    def read_modify_write():
+        with datastore.batch():
+            (value,) = datastore.read("holding_registers", 0, 1)
+            datastore.write(
+                "holding_registers", 0, int.from_bytes(value, "big") + 1, "H"
+            )
+            datastore.snapshot(str(tmp_path / "snapshot"))
+
+    # A read that waited for its own batch would never return:
+    thread = threading.Thread(target=read_modify_write, daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert datastore.read("holding_registers", 0, 1) == [b"\x00\x02"]
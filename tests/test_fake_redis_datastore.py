@@ -0,0 +1,102 @@
+import json
+import time
+import struct
+import pytest
+import modbus_server
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+class CountingRedis(fakeredis.FakeRedis):
+    """fakeredis client that counts the commands sent to the server"""
+
+    commands = []
+
+    def execute_command(self, *args, **options):
+        self.commands.append(args[0])
+        return super().execute_command(*args, **options)
+
+
+@pytest.fixture()
+def datastore(monkeypatch):
+    monkeypatch.setattr(modbus_server.modbus_datastore.redis, "Redis", CountingRedis)
+    with open("tests/example_modbus_address_map.json") as f:
+        modbus_address_map = json.load(f)
+    datastore = modbus_server.RedisDatastore(modbus_address_map)
+    datastore.r.flushdb()
+    datastore.apply_initial_values()
+    CountingRedis.commands.clear()
+    return datastore
+
+
+def test_read_range_with_one_round_trip(datastore):
+    data = datastore.read("input_registers", 0, 4)
+    assert data[:2] == [b"\x00\x00", struct.pack("!H", 50000)]
+    assert b"".join(data[2:]) == struct.pack("!f", 1.234)
+    # The float spanning registers 2 and 3 is fetched only once:
+    assert CountingRedis.commands == ["MGET"]
+
+
+def test_read_bits(datastore):
+    assert datastore.read("discrete_inputs", 0, 2) == [False, True]
+
+
+def test_read_unmapped_address(datastore):
+    with pytest.raises(KeyError):
+        datastore.read("input_registers", 3, 2)
+    assert CountingRedis.commands == []
+
+
+def test_read_missing_key(datastore):
+    datastore.r.delete("example_coil_0")
+    with pytest.raises(KeyError):
+        datastore.read("coils", 0, 1)
+
+
+def test_rebuild_index_after_map_change(datastore):
+    datastore.modbus_address_map["holding_registers"]["7"] = {
+        "key": "new_holding_register",
+        "encoding": "H",
+    }
+    with pytest.raises(KeyError):
+        datastore.read("holding_registers", 7, 1)
+    datastore.rebuild_index()
+    datastore.r.set("new_holding_register", 65535)
+    assert datastore.read("holding_registers", 7, 1) == [b"\xff\xff"]
+
+
+def test_cache_with_ttl(monkeypatch):
+    monkeypatch.setattr(modbus_server.modbus_datastore.redis, "Redis", CountingRedis)
+    datastore = modbus_server.RedisDatastore(
+        {"holding_registers": {"0": {"key": "ttl_value", "encoding": "H"}}},
+        cache_ttl=0.2,
+    )
+    datastore.r.set("ttl_value", 1)
+    assert datastore.read("holding_registers", 0, 1) == [b"\x00\x01"]
+    datastore.r.set("ttl_value", 2)
+    assert datastore.read("holding_registers", 0, 1) == [b"\x00\x01"]
+    assert (datastore.cache_hits, datastore.cache_misses) == (1, 1)
+    time.sleep(0.25)
+    assert datastore.read("holding_registers", 0, 1) == [b"\x00\x02"]
+    # Writes through the datastore invalidate the cache immediately:
+    datastore.write_registers("holding_registers", 0, b"\x00\x03")
+    assert datastore.read("holding_registers", 0, 1) == [b"\x00\x03"]
+
+
+def test_cache_with_keyspace_notifications(monkeypatch):
+    monkeypatch.setattr(modbus_server.modbus_datastore.redis, "Redis", CountingRedis)
+    datastore = modbus_server.RedisDatastore(
+        {"coils": {"0": {"key": "notified_coil"}}}, cache_keyspace_notifications=True
+    )
+    datastore.r.set("notified_coil", "1")
+    time.sleep(0.2)
+    CountingRedis.commands.clear()
+    for _ in range(10):
+        assert datastore.read("coils", 0, 1) == [True]
+    assert CountingRedis.commands.count("MGET") == 1
+    assert (datastore.cache_hits, datastore.cache_misses) == (9, 1)
+
+    datastore.r.set("notified_coil", "0")
+    time.sleep(0.3)
+    assert datastore.read("coils", 0, 1) == [False]
+    datastore.close()
@@ -0,0 +1,56 @@
+import time
+import socket
+import struct
+import pytest
+import modbus_server
+from modbus_server.modbus_server import MBAPFramer
+
+
+def read_request(transaction_id, function_code, address, count):
+    return struct.pack(
+        "!HHHBBHH", transaction_id, 0, 6, 0, function_code, address, count
+    )
+
+
+def recv_exactly(sock, n):
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+def test_framer_split_and_merged_frames():
+    framer = MBAPFramer()
+    stream = read_request(1, 3, 0, 1) + read_request(2, 3, 0, 2)
+    assert framer.feed(stream[:5]) == []
+    assert framer.feed(stream[5:15]) == [read_request(1, 3, 0, 1)]
+    assert framer.feed(stream[15:]) == [read_request(2, 3, 0, 2)]
+    assert framer.buffer == bytearray()
+
+
+def test_framer_invalid_length():
+    framer = MBAPFramer()
+    with pytest.raises(ValueError):
+        framer.feed(struct.pack("!HHHB", 1, 0, 1000, 0))
+
+
+@pytest.mark.parametrize("mode", ["threading", "asyncio"])
+def test_pipelined_requests(mode):
+    s = modbus_server.Server(port=5024, mode=mode, autostart=True)
+    s.set_holding_registers(0, [10, 11, 12], "H")
+    with socket.create_connection(("localhost", 5024)) as sock:
+        requests = b"".join(read_request(i, 3, i, 1) for i in range(3))
+        # Send three pipelined requests, the last one split across two sends:
+        sock.sendall(requests[:-3])
+        time.sleep(0.05)
+        sock.sendall(requests[-3:])
+        responses = recv_exactly(sock, 3 * 11)
+    for i in range(3):
+        transaction_id, _, length, _, function_code, byte_count, value = struct.unpack(
+            "!HHHBBBH", responses[i * 11 : (i + 1) * 11]
+        )
+        assert (transaction_id, length, function_code, byte_count) == (i, 5, 3, 2)
+        assert value == 10 + i
+    s.stop()
@@ -0,0 +1,48 @@
+import sys
+import subprocess
+
+
+def run_python(statement):
+    return subprocess.run(
+        [sys.executable, "-c", statement], check=True, capture_output=True, text=True
+    ).stdout
+
+
+def test_import_is_lazy():
+    output = run_python(
+        "import sys, logging, modbus_server; "
+        "print(sorted(m for m in ('redis', 'asyncio', 'multiprocessing', 'http.server') if m in sys.modules)); "
+        "print(logging.getLogger('modbus_server_logger').handlers)"
+    )
+    assert output.splitlines() == ["[]", "[]"]
+
+
+def test_server_installs_log_handler_once():
+    output = run_python(
+        "import logging, modbus_server; "
+        "modbus_server.Server(port=0, loglevel='WARNING'); "
+        "modbus_server.Server(port=0, loglevel='ERROR'); "
+        "logger = logging.getLogger('modbus_server_logger'); "
+        "print(len(logger.handlers), logging.getLevelName(logger.level))"
+    )
+    assert output.strip() == "1 ERROR"
+
+
+def test_lazy_attributes():
+    import modbus_server
+
+    assert modbus_server.DictDatastore is modbus_server.modbus_datastore.DictDatastore
+    assert "RedisDatastore" in dir(modbus_server)
+    assert modbus_server.modbus_datastore.redis.__name__ == "redis"
+
+
+def test_all_submodules_are_listed():
+    import pkgutil
+    import modbus_server
+
+    submodules = {
+        module.name for module in pkgutil.iter_modules(modbus_server.__path__)
+    }
+    assert submodules == set(modbus_server._SUBMODULES)
+    assert submodules <= set(dir(modbus_server))
+    assert modbus_server.modbus_device.DeviceInformation
@@ -0,0 +1,55 @@
+import urllib.request
+import pytest
+import modbus_server
+from pyModbusTCP.client import ModbusClient
+
+
+@pytest.fixture(params=["threading", "asyncio"])
+def modbus_server_instance(request):
+    s = modbus_server.Server(port=5027, mode=request.param, metrics=True)
+    s.start()
+    yield s
+    s.stop()
+
+
+@pytest.fixture()
+def modbus_client():
+    return ModbusClient(host="localhost", port=5027, unit_id=3, auto_open=True)
+
+
+def test_request_metrics(modbus_server_instance, modbus_client):
+    modbus_server_instance.set_holding_registers(0, [1, 2], "H")
+    assert modbus_client.read_holding_registers(0, 2) == [1, 2]
+    assert modbus_client.read_holding_registers(0, 2) == [1, 2]
+    assert modbus_client.read_input_registers(0, 1) is None
+
+    metrics = modbus_server_instance.metrics
+    assert metrics.requests_by_function_code == {3: 2, 4: 1}
+    assert metrics.requests_by_unit_id == {3: 3}
+    assert metrics.requests_by_client == {"127.0.0.1": 3}
+    assert metrics.exceptions == {(4, 2): 1}
+    assert metrics.request_latency[3].count == 2
+    # The unmapped input register is rejected by the address space, without a read:
+    assert metrics.datastore_latency["read"].count == 2
+
+
+def test_prometheus_endpoint(modbus_server_instance, modbus_client):
+    modbus_server_instance.start_metrics_server(port=0)
+    modbus_server_instance.set_coil(0, True)
+    assert modbus_client.read_coils(0, 1) == [True]
+
+    port = modbus_server_instance.metrics_server.port
+    with urllib.request.urlopen(f"http://localhost:{port}/metrics") as response:
+        text = response.read().decode()
+    assert 'modbus_requests_total{function_code="1"} 1' in text
+    assert (
+        'modbus_request_duration_seconds_bucket{function_code="1",le="+Inf"} 1' in text
+    )
+    assert 'modbus_datastore_call_duration_seconds_count{method="read"} 1' in text
+
+
+def test_metrics_disabled():
+    s = modbus_server.Server(port=5027)
+    assert s.metrics is None
+    with pytest.raises(RuntimeError):
+        s.start_metrics_server()
@@ -0,0 +1,161 @@
+import time
+import socket
+import struct
+import pytest
+import modbus_server
+from modbus_server.modbus_pdu import DatastoreUnavailableError
+from pyModbusTCP.client import ModbusClient
+
+fakeredis = pytest.importorskip("fakeredis")
+
+MODBUS_ADDRESS_MAP = {
+    "coils": {"0": {"key": "coil_0"}},
+    "holding_registers": {
+        "0": {"key": "setpoint", "encoding": "H"},
+        "1": {"key": "temperature", "encoding": "f", "part": 1},
+        "2": {"key": "temperature", "encoding": "f", "part": 2},
+    },
+}
+
+
+@pytest.fixture()
+def fake_server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture()
+def datastore(fake_server):
+    datastore = modbus_server.PooledRedisDatastore(
+        MODBUS_ADDRESS_MAP,
+        redis_client=fakeredis.FakeRedis(server=fake_server),
+    )
+    datastore.r.mset({"coil_0": "True", "setpoint": 7, "temperature": 21.5})
+    yield datastore
+    datastore.close()
+
+
+@pytest.fixture()
+def modbus_server_instance(datastore):
+    s = modbus_server.Server(
+        port=5037, datastore=datastore, mode="asyncio", autostart=True
+    )
+    time.sleep(0.1)
+    yield s
+    s.stop()
+
+
+@pytest.fixture()
+def modbus_client():
+    return ModbusClient(host="localhost", port=5037, auto_open=True)
+
+
+def test_pooled_redis_read_and_write(modbus_server_instance, modbus_client, datastore):
+    assert modbus_client.read_coils(0, 1) == [True]
+    assert modbus_client.read_holding_registers(0, 1) == [7]
+    assert modbus_client.write_single_register(0, 42)
+    assert datastore.r.get("setpoint") == b"42"
+    modbus_server_instance.set_holding_register(1, 1.5, "f")
+    assert datastore.r.get("temperature") == b"1.5"
+
+
+def test_pooled_redis_unavailable_keeps_connection_open(
+    modbus_server_instance, modbus_client, fake_server
+):
+    fake_server.connected = False
+    assert modbus_client.read_holding_registers(0, 1) is None
+    assert modbus_client.last_except == 4
+    assert not modbus_client.write_single_register(0, 1)
+    assert modbus_client.last_except == 4
+    assert modbus_client.is_open
+
+    # Redis is back, the same connection is served again:
+    fake_server.connected = True
+    assert modbus_client.read_holding_registers(0, 1) == [7]
+
+
+def test_pooled_redis_unreachable_host():
+    datastore = modbus_server.PooledRedisDatastore(
+        MODBUS_ADDRESS_MAP, redis_port=1, retries=1, max_backoff=0.01
+    )
+    try:
+        with pytest.raises(DatastoreUnavailableError):
+            datastore.read("holding_registers", 0, 1)
+    finally:
+        datastore.close()
+
+
+class SlowDatastore(modbus_server.DictDatastore):
+    """DictDatastore that waits for its backend like a slow redis"""
+
+    blocking_io = True
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def read(self, object_reference, first_address, number_of_records):
+        time.sleep(self.delay)
+        return super().read(object_reference, first_address, number_of_records)
+
+
+def read_request(unit_id, transaction_id=1):
+    return struct.pack("!HHHBBHH", transaction_id, 0, 6, unit_id, 3, 0, 1)
+
+
+def test_saturated_blocking_datastore_does_not_stall_other_units():
+    units = {
+        1: SlowDatastore(delay=0.5),
+        2: modbus_server.DictDatastore(),
+        3: SlowDatastore(delay=0),
+    }
+    s = modbus_server.Server(port=5038, mode="asyncio", units=units, autostart=True)
+    time.sleep(0.1)
+    slow_clients = []
+    try:
+        for unit_id in units:
+            s.set_holding_register(0, unit_id, "H", unit_id=unit_id)
+        # Many more requests in flight than the unit has threads:
+        for _ in range(40):
+            client = socket.create_connection(("localhost", 5038))
+            client.sendall(read_request(1))
+            slow_clients.append(client)
+        time.sleep(0.1)
+
+        for unit_id in (2, 3):
+            client = ModbusClient(host="localhost", port=5038, unit_id=unit_id)
+            start = time.monotonic()
+            assert client.read_holding_registers(0, 1) == [unit_id]
+            assert time.monotonic() - start < 0.3
+            client.close()
+    finally:
+        for client in slow_clients:
+            client.close()
+        s.stop()
+
+
+def test_pipelined_requests_for_several_units_keep_their_order():
+    units = {1: SlowDatastore(delay=0.05), 2: modbus_server.DictDatastore()}
+    s = modbus_server.Server(port=5038, mode="asyncio", units=units, autostart=True)
+    time.sleep(0.1)
+    try:
+        for unit_id in units:
+            s.set_holding_register(0, unit_id, "H", unit_id=unit_id)
+        unit_ids = [1, 2, 2, 1, 2]
+        with socket.create_connection(("localhost", 5038)) as client:
+            client.sendall(
+                b"".join(
+                    read_request(unit_id, transaction_id)
+                    for transaction_id, unit_id in enumerate(unit_ids)
+                )
+            )
+            client.settimeout(2)
+            responses = b""
+            while len(responses) < 11 * len(unit_ids):
+                responses += client.recv(1024)
+        for transaction_id, unit_id in enumerate(unit_ids):
+            response = responses[11 * transaction_id : 11 * (transaction_id + 1)]
+            assert response == struct.pack(
+                "!HHHBBBH", transaction_id, 0, 5, unit_id, 3, 2, unit_id
+            )
+    finally:
+        s.stop()
@@ -0,0 +1,28 @@
+import random
+import struct
+from modbus_server.modbus_server import ResponseBuffer, pack_bools_to_bytes
+
+
+def test_pack_bools_to_bytes():
+    assert pack_bools_to_bytes([True]) == b"\x01"
+    assert pack_bools_to_bytes([False, True, True]) == b"\x06"
+    bools = [random.random() > 0.5 for _ in range(2000)]
+    expected = bytes(
+        sum(1 << i for i, b in enumerate(bools[j : j + 8]) if b)
+        for j in range(0, 2000, 8)
+    )
+    assert pack_bools_to_bytes(bools) == expected
+    # Like the baseline packer, any truthy value is a set bit:
+    assert pack_bools_to_bytes(["on", "", 2, 0, None]) == b"\x05"
+
+
+def test_response_buffer_reuse_and_growth():
+    response_buffer = ResponseBuffer(size=16)
+    response_buffer.append_response(1, 0, 3, b"\x00\x01")
+    response_buffer.append_error(2, 5, 4, 2)
+    response_buffer.append_response(3, 0, 4, bytes(250))
+    value = response_buffer.getvalue()
+    assert value[:11] == struct.pack("!HHHBBBH", 1, 0, 5, 0, 3, 2, 1)
+    assert value[11:20] == struct.pack("!HHHBBB", 2, 0, 3, 5, 132, 2)
+    assert value[20:29] == struct.pack("!HHHBBB", 3, 0, 253, 0, 4, 250)
+    assert len(value) == 29 + 250
@@ -0,0 +1,133 @@
+import os
+import time
+import socket
+import struct
+import select
+import pytest
+import modbus_server
+from modbus_server.modbus_rtu import RTUFramer, crc16
+
+
+def rtu_frame(unit_id, pdu):
+    frame = bytes([unit_id]) + pdu
+    return frame + struct.pack("<H", crc16(frame))
+
+
+def test_crc16():
+    # Read 10 holding registers from unit 1, the CRC from the specification examples:
+    assert crc16(bytes.fromhex("01030000000a")) == 0xCDC5
+    assert crc16(rtu_frame(1, bytes.fromhex("030000000a"))) == 0
+
+
+def test_framer_splits_frames_by_function_code():
+    read_request = rtu_frame(1, struct.pack("!BHH", 3, 0, 10))
+    write_request = rtu_frame(
+        2, struct.pack("!BHHB", 16, 0, 2, 4) + b"\x00\x01\x00\x02"
+    )
+    framer = RTUFramer()
+    stream = read_request + write_request
+    assert framer.feed(stream[:5]) == []
+    assert framer.feed(stream[5:13]) == [read_request]
+    assert framer.feed(stream[13:]) == [write_request]
+
+
+def test_framer_drops_invalid_crc():
+    framer = RTUFramer()
+    request = bytearray(rtu_frame(1, struct.pack("!BHH", 3, 0, 10)))
+    request[-1] ^= 0xFF
+    assert framer.feed(bytes(request)) == []
+    assert framer.crc_errors == 1
+    valid_request = rtu_frame(1, struct.pack("!BHH", 3, 0, 10))
+    assert framer.feed(valid_request) == [valid_request]
+
+
+def test_framer_resynchronizes_after_silent_interval():
+    framer = RTUFramer(inter_frame_gap=0.002)
+    request = rtu_frame(1, struct.pack("!BHH", 3, 0, 10))
+    assert framer.feed(b"\x01\x03\x00", timestamp=1.0) == []
+    # The rest of the broken frame never arrives, the next frame starts after a gap:
+    assert framer.feed(request, timestamp=1.1) == [request]
+
+
+def read_response(fd_or_socket, length):
+    data = b""
+    while len(data) < length:
+        if isinstance(fd_or_socket, socket.socket):
+            chunk = fd_or_socket.recv(length - len(data))
+        else:
+            assert select.select([fd_or_socket], [], [], 2)[0]
+            chunk = os.read(fd_or_socket, length - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+def test_rtu_over_tcp():
+    s = modbus_server.Server(port=5032, framing="rtu", autostart=True)
+    time.sleep(0.1)
+    try:
+        s.set_holding_registers(0, [1, 2, 3], "H")
+        with socket.create_connection(("localhost", 5032)) as client:
+            client.sendall(rtu_frame(1, struct.pack("!BHH", 3, 0, 3)))
+            response = read_response(client, 11)
+            assert response == rtu_frame(1, b"\x03\x06\x00\x01\x00\x02\x00\x03")
+
+            # Unmapped address -> exception 02
+            client.sendall(rtu_frame(1, struct.pack("!BHH", 3, 100, 1)))
+            assert read_response(client, 5) == rtu_frame(1, b"\x83\x02")
+    finally:
+        s.stop()
+
+
+@pytest.fixture()
+def serial_server():
+    pytest.importorskip("termios")
+    master, slave = os.openpty()
+    s = modbus_server.SerialServer(
+        os.ttyname(slave), baudrate=38400, units={1: modbus_server.DictDatastore()}
+    )
+    s.start()
+    yield s, master
+    s.stop()
+    os.close(slave)
+    os.close(master)
+
+
+def test_serial_read_and_write(serial_server):
+    s, master = serial_server
+    s.set_coils(0, [True, False, True], unit_id=1)
+    os.write(master, rtu_frame(1, struct.pack("!BHH", 1, 0, 3)))
+    assert read_response(master, 6) == rtu_frame(1, b"\x01\x01\x05")
+
+    os.write(master, rtu_frame(1, struct.pack("!BHH", 5, 1, 0xFF00)))
+    assert read_response(master, 8) == rtu_frame(1, struct.pack("!BHH", 5, 1, 0xFF00))
+    assert s.units[1].read("coils", 0, 3) == [True, True, True]
+
+
+def test_serial_ignores_other_units_and_answers_no_broadcasts(serial_server):
+    s, master = serial_server
+    s.set_coils(0, [False], unit_id=1)
+    # Unit 2 is another device on the line, unit 0 is a broadcast:
+    os.write(master, rtu_frame(2, struct.pack("!BHH", 1, 0, 1)))
+    os.write(master, rtu_frame(0, struct.pack("!BHH", 5, 0, 0xFF00)))
+    assert select.select([master], [], [], 0.3)[0] == []
+    # The broadcast was executed anyway:
+    assert s.units[1].read("coils", 0, 1) == [True]
+
+
+def test_rtu_broadcast_writes_every_unit():
+    units = {1: modbus_server.DictDatastore(), 2: modbus_server.ArrayDatastore()}
+    s = modbus_server.Server(port=5032, framing="rtu", units=units, autostart=True)
+    time.sleep(0.1)
+    try:
+        for unit_id in units:
+            s.set_coils(0, [False], unit_id=unit_id)
+        with socket.create_connection(("localhost", 5032)) as client:
+            client.sendall(rtu_frame(0, struct.pack("!BHH", 5, 0, 0xFF00)))
+            # Not answered, the next response is the one for unit 1:
+            client.sendall(rtu_frame(1, struct.pack("!BHH", 1, 0, 1)))
+            assert read_response(client, 6) == rtu_frame(1, b"\x01\x01\x01")
+        for datastore in units.values():
+            assert datastore.read("coils", 0, 1) == [True]
+    finally:
+        s.stop()
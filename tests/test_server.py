@@ -0,0 +1,40 @@
+import time
+import socket
+import pytest
+import modbus_server
+from pyModbusTCP.client import ModbusClient
+
+
+@pytest.mark.parametrize("mode", ["threading", "asyncio"])
+def test_reconnect_storm(mode):
+    s = modbus_server.Server(port=5023, mode=mode, backlog=256, autostart=True)
+    s.set_coil(0, True)
+    sockets = [socket.create_connection(("localhost", 5023)) for _ in range(500)]
+    for sock in sockets:
+        sock.close()
+    time.sleep(0.1)
+    assert s.accepted_connections == 500
+    assert ModbusClient(host="localhost", port=5023).read_coils(0, 1) == [True]
+    s.stop()
+
+
+@pytest.mark.parametrize("mode", ["threading", "asyncio"])
+def test_stop_and_restart(mode):
+    s = modbus_server.Server(port=5023, mode=mode, autostart=True)
+    s.set_coil(0, True)
+    t = time.time()
+    s.stop()
+    assert time.time() - t < 1
+    with pytest.raises(ConnectionRefusedError):
+        socket.create_connection(("localhost", 5023))
+    s.start()
+    assert ModbusClient(host="localhost", port=5023).read_coils(0, 1) == [True]
+    s.stop()
+
+
+def test_ephemeral_port():
+    s = modbus_server.Server(port=0, autostart=True)
+    assert s.port != 0
+    s.set_coil(0, True)
+    assert ModbusClient(host="localhost", port=s.port).read_coils(0, 1) == [True]
+    s.stop()
@@ -0,0 +1,122 @@
+import os
+import struct
+import threading
+import multiprocessing
+import pytest
+import modbus_server
+from pyModbusTCP.client import ModbusClient
+
+pytest.importorskip("fcntl")
+
+
+def produce(path, iterations):
+    # Runs in a separate producer process, which only knows the path:
+    datastore = modbus_server.SharedMemoryDatastore(path, create=False)
+    for i in range(iterations):
+        # Both halves of the double always carry the same counter:
+        datastore.set_registers("input_registers", 0, [i, i, i, i], "H")
+    datastore.close()
+
+
+def die_in_batch(path):
+    # Producer process that is killed in the middle of a batch():
+    datastore = modbus_server.SharedMemoryDatastore(path, create=False)
+    datastore._begin_write()
+    datastore.set_registers("input_registers", 0, [9, 9], "H")
+    os._exit(1)
+
+
+@pytest.fixture()
+def datastore(tmp_path):
+    datastore = modbus_server.SharedMemoryDatastore(str(tmp_path / "modbus_shm"))
+    yield datastore
+    datastore.close()
+
+
+def test_producer_updates_are_never_torn(datastore):
+    datastore.set_registers("input_registers", 0, [0, 0, 0, 0], "H")
+    producer = multiprocessing.get_context("spawn").Process(
+        target=produce, args=(datastore.path, 20000)
+    )
+    producer.start()
+    reads = 0
+    while producer.is_alive() or reads == 0:
+        values = struct.unpack("!4H", datastore.read_bytes("input_registers", 0, 4))
+        assert len(set(values)) == 1
+        reads += 1
+    producer.join()
+    assert producer.exitcode == 0
+    assert (
+        struct.unpack("!4H", datastore.read_bytes("input_registers", 0, 4))
+        == ((20000 - 1),) * 4
+    )
+
+
+def test_served_by_server(datastore):
+    s = modbus_server.Server(port=5029, datastore=datastore, autostart=True)
+    datastore.set_registers("holding_registers", 10, [1.5], "f")
+    datastore.set_bits("coils", 0, [True, False, True])
+    client = ModbusClient(host="localhost", port=5029, auto_open=True)
+    registers = client.read_holding_registers(10, 2)
+    assert struct.unpack("!f", struct.pack("!2H", *registers))[0] == 1.5
+    assert client.read_coils(0, 3) == [True, False, True]
+    assert client.write_single_coil(1, True)
+    assert datastore.read("coils", 0, 3) == [True, True, True]
+    s.stop()
+
+
+def test_batch_and_reopen(datastore):
+    with datastore.batch():
+        datastore.set_registers("input_registers", 0, [1], "h")
+        datastore.set_bits("discrete_inputs", 5, [True])
+    reopened = modbus_server.SharedMemoryDatastore(datastore.path, create=False)
+    assert reopened.read("input_registers", 0, 1) == [b"\x00\x01"]
+    assert reopened.read("discrete_inputs", 5, 1) == [True]
+    with pytest.raises(KeyError):
+        reopened.read("discrete_inputs", 4, 1)
+    reopened.close()
+
+
+def test_read_inside_batch(datastore, tmp_path):
+    datastore.set_registers("holding_registers", 0, [1], "H")
+
+    def read_modify_write():
+        with datastore.batch():
+            (value,) = datastore.read("holding_registers", 0, 1)
+            datastore.write(
+                "holding_registers", 0, int.from_bytes(value, "big") + 1, "H"
+            )
+            datastore.snapshot(str(tmp_path / "snapshot"))
+
+    # A read that waited for its own batch would never return:
+    thread = threading.Thread(target=read_modify_write, daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert datastore.read("holding_registers", 0, 1) == [b"\x00\x02"]
+
+
+@pytest.mark.parametrize("first_access", ["read", "write"])
+def test_writer_dies_in_batch(datastore, first_access):
+    datastore.set_registers("input_registers", 0, [1, 2], "H")
+    producer = multiprocessing.get_context("spawn").Process(
+        target=die_in_batch, args=(datastore.path,)
+    )
+    producer.start()
+    producer.join()
+    assert producer.exitcode == 1
+    assert datastore._sequence() & 1
+
+    if first_access == "write":
+        datastore.set_registers("input_registers", 2, [3], "H")
+    # Readers don't wait forever for the dead writer:
+    reader = threading.Thread(
+        target=datastore.read_bytes, args=("input_registers", 0, 2)
+    )
+    reader.start()
+    reader.join(5)
+    assert not reader.is_alive()
+    assert not datastore._sequence() & 1
+    datastore.set_registers("input_registers", 0, [4, 5], "H")
+    assert datastore.read("input_registers", 0, 2) == [b"\x00\x04", b"\x00\x05"]
+    assert not datastore._sequence() & 1
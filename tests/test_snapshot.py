@@ -0,0 +1,86 @@
+import time
+import pytest
+import modbus_server
+from pyModbusTCP.client import ModbusClient
+
+
+def populate(datastore):
+    datastore.set_bits("coils", 0, [bool(i % 3) for i in range(2000)])
+    datastore.set_bits("discrete_inputs", 65535, [True])
+    datastore.set_registers("input_registers", 10, [1.5, -2.5], "f")
+    datastore.set_registers("holding_registers", 0, list(range(125)), "H")
+
+
+@pytest.mark.parametrize("name", ["DictDatastore", "ArrayDatastore"])
+def test_snapshot_and_restore(tmp_path, name):
+    datastore = getattr(modbus_server, name)()
+    populate(datastore)
+    datastore.snapshot(tmp_path / "snapshot")
+
+    restored = getattr(modbus_server, name).from_snapshot(tmp_path / "snapshot")
+    assert restored.dump() == datastore.dump()
+    assert restored.address_space.is_mapped("coils", 0, 2000)
+    assert not restored.address_space.is_mapped("coils", 2000, 1)
+
+
+def test_snapshot_format_is_shared(tmp_path):
+    datastore = modbus_server.DictDatastore()
+    populate(datastore)
+    datastore.snapshot(tmp_path / "snapshot")
+    # A DictDatastore snapshot can be served by an ArrayDatastore and vice versa:
+    array_datastore = modbus_server.ArrayDatastore.from_snapshot(tmp_path / "snapshot")
+    assert array_datastore.dump() == datastore.dump()
+    array_datastore.snapshot(tmp_path / "snapshot")
+    dict_datastore = modbus_server.DictDatastore.from_snapshot(tmp_path / "snapshot")
+    assert dict_datastore.dump() == datastore.dump()
+
+
+def test_restore_replaces_values(tmp_path):
+    datastore = modbus_server.DictDatastore()
+    populate(datastore)
+    datastore.snapshot(tmp_path / "snapshot")
+    datastore.write("coils", 5000, True, None)
+    datastore.restore(tmp_path / "snapshot")
+    with pytest.raises(KeyError):
+        datastore.read("coils", 5000, 1)
+
+
+def test_loaded_snapshot_is_copy_on_write(tmp_path):
+    datastore = modbus_server.ArrayDatastore()
+    populate(datastore)
+    datastore.snapshot(tmp_path / "snapshot")
+    loaded = modbus_server.ArrayDatastore.from_snapshot(tmp_path / "snapshot")
+    loaded.write("holding_registers", 0, 999, "H")
+    reloaded = modbus_server.ArrayDatastore.from_snapshot(tmp_path / "snapshot")
+    assert reloaded.read("holding_registers", 0, 1) == [b"\x00\x00"]
+
+
+def test_invalid_snapshot(tmp_path):
+    (tmp_path / "snapshot").write_bytes(b"not a snapshot")
+    with pytest.raises(ValueError):
+        modbus_server.DictDatastore.from_snapshot(tmp_path / "snapshot")
+
+
+def test_snapshot_while_serving(tmp_path):
+    datastore = modbus_server.DictDatastore()
+    s = modbus_server.Server(port=5034, datastore=datastore, autostart=True)
+    time.sleep(0.1)
+    try:
+        s.set_holding_registers(0, [1, 2, 3], "H")
+        client = ModbusClient(host="localhost", port=5034, auto_open=True)
+        assert client.write_multiple_registers(0, [4, 5, 6])
+        datastore.snapshot(tmp_path / "snapshot")
+        assert client.read_holding_registers(0, 3) == [4, 5, 6]
+    finally:
+        s.stop()
+    restarted = modbus_server.Server(
+        port=5034,
+        datastore=modbus_server.DictDatastore.from_snapshot(tmp_path / "snapshot"),
+        autostart=True,
+    )
+    time.sleep(0.1)
+    try:
+        client = ModbusClient(host="localhost", port=5034, auto_open=True)
+        assert client.read_holding_registers(0, 3) == [4, 5, 6]
+    finally:
+        restarted.stop()
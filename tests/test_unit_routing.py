@@ -0,0 +1,70 @@
+import time
+import pytest
+import modbus_server
+from pyModbusTCP.client import ModbusClient
+
+
+@pytest.fixture()
+def gateway():
+    # Odd unit IDs are served, even ones are not:
+    units = {unit_id: modbus_server.ArrayDatastore() for unit_id in range(1, 11, 2)}
+    s = modbus_server.Server(port=5030, units=units, autostart=True)
+    time.sleep(0.1)
+    yield s
+    s.stop()
+
+
+def client(unit_id):
+    return ModbusClient(host="localhost", port=5030, unit_id=unit_id, auto_open=True)
+
+
+def test_requests_are_routed_by_unit_id(gateway):
+    for unit_id in (1, 3, 5):
+        gateway.set_holding_registers(0, [unit_id, 10 * unit_id], "H", unit_id=unit_id)
+    for unit_id in (1, 3, 5):
+        assert client(unit_id).read_holding_registers(0, 2) == [unit_id, 10 * unit_id]
+
+
+def test_writes_are_routed_by_unit_id(gateway):
+    gateway.set_coils(0, [False, False], unit_id=3)
+    gateway.set_coils(0, [False, False], unit_id=5)
+    assert client(3).write_single_coil(1, True)
+    assert gateway.units[3].read("coils", 0, 2) == [False, True]
+    assert gateway.units[5].read("coils", 0, 2) == [False, False]
+
+
+def test_unknown_unit_gets_exception_0A(gateway):
+    unknown_unit_client = client(2)
+    assert unknown_unit_client.read_holding_registers(0, 1) is None
+    assert unknown_unit_client.last_except == 0x0A
+    with pytest.raises(ValueError):
+        gateway.set_coil(0, True)
+
+
+def test_add_and_remove_unit_while_running(gateway):
+    datastore = modbus_server.DictDatastore()
+    gateway.add_unit(200, datastore)
+    gateway.set_coil(7, True, unit_id=200)
+    assert client(200).read_coils(7, 1) == [True]
+    gateway.remove_unit(200)
+    assert client(200).read_coils(7, 1) is None
+
+
+def test_single_datastore_serves_all_units():
+    s = modbus_server.Server(port=5030, autostart=True)
+    s.set_coil(0, True)
+    try:
+        for unit_id in (0, 1, 255):
+            assert client(unit_id).read_coils(0, 1) == [True]
+    finally:
+        s.stop()
+
+
+@pytest.mark.parametrize("unit_id", [-1, 256, "1"])
+def test_invalid_unit_ids_are_rejected(unit_id):
+    datastore = modbus_server.DictDatastore()
+    with pytest.raises(ValueError):
+        modbus_server.Server(port=0, units={unit_id: datastore})
+    s = modbus_server.Server(port=0, datastore=datastore)
+    with pytest.raises(ValueError):
+        s.add_unit(unit_id, datastore)
@@ -0,0 +1,54 @@
+import os
+import pytest
+import modbus_server
+from pyModbusTCP.client import ModbusClient
+from modbus_server.benchmark import BenchmarkClient
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(os, "fork"), reason="worker processes are forked"
+)
+
+
+@pytest.fixture(params=["threading", "asyncio"])
+def modbus_server_instance(request):
+    datastore = modbus_server.ArrayDatastore(shared=True)
+    s = modbus_server.Server(
+        port=5028, datastore=datastore, mode=request.param, workers=3
+    )
+    s.start()
+    yield s
+    s.stop()
+
+
+def test_workers_serve_shared_datastore(modbus_server_instance):
+    # Values set in the parent after the workers were forked are served by all workers:
+    modbus_server_instance.set_holding_registers(0, [1, 2, 3], "H")
+    for _ in range(20):
+        client = ModbusClient(host="localhost", port=5028)
+        assert client.read_holding_registers(0, 3) == [1, 2, 3]
+        client.close()
+
+
+def test_workers_share_modbus_writes(modbus_server_instance):
+    modbus_server_instance.set_coils(0, [False] * 8)
+    writer = ModbusClient(host="localhost", port=5028)
+    assert writer.write_multiple_coils(0, [True, False, True])
+    for _ in range(20):
+        client = ModbusClient(host="localhost", port=5028)
+        assert client.read_coils(0, 3) == [True, False, True]
+        client.close()
+    assert modbus_server_instance.dump_datastore()["coils"][2] is True
+
+
+def test_stop_terminates_workers(modbus_server_instance):
+    processes = list(modbus_server_instance._worker_processes)
+    assert len(processes) == 3
+    modbus_server_instance.stop()
+    assert not any(process.is_alive() for process in processes)
+    with pytest.raises(ConnectionRefusedError):
+        BenchmarkClient("localhost", 5028)
+
+
+def test_unshared_datastore_warns():
+    with pytest.warns(UserWarning):
+        modbus_server.Server(port=5028, workers=2)
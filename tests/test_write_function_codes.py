@@ -0,0 +1,183 @@
+import sys
+import json
+import struct
+import threading
+import pytest
+import modbus_server
+from pyModbusTCP.client import ModbusClient
+from modbus_server.modbus_pdu import process_write_request
+
+
+@pytest.fixture(params=["DictDatastore", "ArrayDatastore"])
+def modbus_server_instance(request):
+    datastore = getattr(modbus_server, request.param)()
+    s = modbus_server.Server(port=5026, datastore=datastore, autostart=True)
+    s.set_coils(0, [False] * 20)
+    s.set_holding_registers(0, [0] * 10, "H")
+    yield s
+    s.stop()
+
+
+@pytest.fixture()
+def modbus_client():
+    return ModbusClient(host="localhost", port=5026, auto_open=True)
+
+
+def test_write_single_coil(modbus_server_instance, modbus_client):
+    assert modbus_client.write_single_coil(3, True)
+    assert modbus_client.read_coils(0, 5) == [False, False, False, True, False]
+    assert modbus_client.write_single_coil(3, False)
+    assert modbus_client.read_coils(3, 1) == [False]
+
+
+def test_write_single_register(modbus_server_instance, modbus_client):
+    assert modbus_client.write_single_register(2, 4321)
+    assert modbus_client.read_holding_registers(0, 3) == [0, 0, 4321]
+
+
+def test_write_multiple_coils(modbus_server_instance, modbus_client):
+    values = [True, False, True, True, False, True, True, True, False, True, True]
+    assert modbus_client.write_multiple_coils(5, values)
+    assert modbus_client.read_coils(5, 11) == values
+    assert modbus_client.read_coils(0, 5) == [False] * 5
+    assert modbus_client.read_coils(16, 4) == [False] * 4
+
+
+def test_write_multiple_registers(modbus_server_instance, modbus_client):
+    assert modbus_client.write_multiple_registers(1, [7, 8, 9])
+    assert modbus_client.read_holding_registers(0, 5) == [0, 7, 8, 9, 0]
+
+
+def test_mask_write_register(modbus_server_instance, modbus_client):
+    modbus_server_instance.set_holding_register(4, 0x12, "H")
+    # Example from the Modbus specification: (0x12 AND 0xF2) OR (0x25 AND NOT 0xF2) = 0x17
+    response = modbus_client.custom_request(struct.pack("!BHHH", 22, 4, 0xF2, 0x25))
+    assert response == struct.pack("!BHHH", 22, 4, 0xF2, 0x25)
+    assert modbus_client.read_holding_registers(4, 1) == [0x17]
+
+
+def test_read_write_multiple_registers(modbus_server_instance, modbus_client):
+    assert modbus_client.write_read_multiple_registers(2, [5, 6], 0, 5) == [
+        0,
+        0,
+        5,
+        6,
+        0,
+    ]
+
+
+def test_write_unmapped_address(modbus_server_instance, modbus_client):
+    assert not modbus_client.write_multiple_registers(8, [1, 2, 3])
+    assert modbus_client.last_except == 2
+    # Nothing is written if a part of the range is unmapped:
+    assert modbus_client.read_holding_registers(8, 2) == [0, 0]
+
+
+def test_write_invalid_coil_value(modbus_server_instance, modbus_client):
+    response = modbus_client.custom_request(struct.pack("!BHH", 5, 0, 0x1234))
+    assert response is None
+    assert modbus_client.last_except == 3
+
+
+def test_redis_write_registers(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    monkeypatch.setattr(
+        modbus_server.modbus_datastore.redis, "Redis", fakeredis.FakeRedis
+    )
+    with open("tests/example_modbus_address_map.json") as f:
+        modbus_address_map = json.load(f)
+    datastore = modbus_server.RedisDatastore(modbus_address_map)
+    datastore.apply_initial_values()
+    float_bytes = struct.pack("!f", 2.5)
+
+    datastore.write_registers("input_registers", 1, b"\x00\x07" + float_bytes)
+    assert datastore.read("input_registers", 1, 3) == [b"\x00\x07"] + [
+        float_bytes[:2],
+        float_bytes[2:],
+    ]
+
+    # Writing only the second part of a float keeps the first part:
+    datastore.write_registers("input_registers", 3, struct.pack("!f", 3.0)[2:])
+    assert struct.unpack("!f", b"".join(datastore.read("input_registers", 2, 2))) == (
+        struct.unpack("!f", float_bytes[:2] + struct.pack("!f", 3.0)[2:])[0],
+    )
+
+    datastore.write_bits("discrete_inputs", 0, [True, False])
+    assert datastore.read("discrete_inputs", 0, 2) == [True, False]
+
+    with pytest.raises(KeyError):
+        datastore.write_registers("holding_registers", 1, b"\x00\x01")
+
+
+class BasicDatastore:
+    """Custom datastore with only the basic interface, values as Python objects"""
+
+    def __init__(self):
+        self.values = {}
+
+    def read(self, object_reference, first_address, number_of_records):
+        values = []
+        for address in range(first_address, first_address + number_of_records):
+            value, encoding = self.values[object_reference, address]
+            if object_reference in ("coils", "discrete_inputs"):
+                values.append(value)
+            else:
+                values.append(struct.pack(f"!{encoding}", value))
+        return values
+
+    def write(self, object_reference, address, value, encoding):
+        self.values[object_reference, address] = (value, encoding)
+
+    def dump(self):
+        return self.values
+
+
+@pytest.mark.parametrize("metrics", [False, True])
+def test_basic_datastore_writes(metrics):
+    datastore = BasicDatastore()
+    s = modbus_server.Server(
+        port=5026, datastore=datastore, metrics=metrics, autostart=True
+    )
+    try:
+        s.set_coils(0, [False] * 4)
+        s.set_holding_registers(0, [0] * 4, "H")
+        client = ModbusClient(host="localhost", port=5026, auto_open=True)
+        assert client.write_single_coil(1, True)
+        assert client.write_multiple_coils(2, [True, True])
+        assert client.read_coils(0, 4) == [False, True, True, True]
+        assert client.write_single_register(0, 4321)
+        assert client.write_multiple_registers(1, [7, 8])
+        assert client.read_holding_registers(0, 4) == [4321, 7, 8, 0]
+        assert datastore.values["holding_registers", 0] == (4321, "H")
+    finally:
+        s.stop()
+
+
+@pytest.mark.parametrize(
+    "datastore_class", [modbus_server.DictDatastore, modbus_server.ArrayDatastore]
+)
+def test_concurrent_mask_writes(datastore_class):
+    datastore = datastore_class()
+    datastore.set_registers("holding_registers", 0, [0], "H")
+    barrier = threading.Barrier(8)
+
+    def toggle_bit(bit):
+        barrier.wait()
+        for i in range(1000):
+            # Clear the bit, then set it again, the other bits must stay as they are:
+            or_mask = (1 << bit) if i % 2 else 0
+            pdu = struct.pack("!BHHH", 22, 0, ~(1 << bit) & 0xFFFF, or_mask)
+            process_write_request(22, pdu, datastore)
+
+    switch_interval = sys.getswitchinterval()
+    # Switch threads as often as possible, so that unguarded mask writes would get lost:
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=toggle_bit, args=(bit,)) for bit in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert datastore.read("holding_registers", 0, 1) == [b"\x00\xff"]